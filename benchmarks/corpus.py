@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+"""Synthetic mailbox of maintenance notices matching ``notification_patterns/*.yml``."""
+import argparse
+import mailbox
+import random
+import string
+from datetime import datetime, timedelta
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime, make_msgid
+
+
+# Share of each kind of message in a generated mailbox
+DEFAULT_MIX = (
+    ("ntt_plain", 0.35),
+    ("ntt_ical", 0.15),
+    ("level3_html", 0.25),
+    ("level3_large", 0.05),
+    ("unrelated", 0.20),
+)
+
+LARGE_ATTACHMENT_SIZE = 64 * 1024
+
+FIRST_WINDOW = datetime(2017, 10, 1)
+
+
+def _maintenance_window(rng):
+    start_time = FIRST_WINDOW + timedelta(days=rng.randrange(365), hours=rng.randrange(24))
+    return start_time, start_time + timedelta(hours=rng.choice((2, 4, 6, 8)))
+
+
+def _ntt_cid(rng):
+    return "{:06d}".format(rng.randrange(1000000))
+
+
+def _level3_cid(rng):
+    return "".join(rng.choice(string.ascii_uppercase) for _ in range(4)) + "{:04d}".format(rng.randrange(10000))
+
+
+def _ntt_body(cid, start_time, end_time):
+    return ("Dear Customer,\n\nNTT Communications will be performing scheduled maintenance.\n\n"
+            "Circuit: {} Tokyo\n*Start Date/Time*: {} UTC\n*End Date/Time*: {} UTC\n\n"
+            "Expected impact: up to 30 minutes of outage.\n\nRegards,\nNTT NOC\n").format(
+                cid, start_time.strftime("%Y-%m-%d %H:%M"), end_time.strftime("%Y-%m-%d %H:%M"))
+
+
+def _level3_html(cid, start_time, end_time, rows=1):
+    window = "{} GMT TO {} GMT".format(start_time.strftime("%d-%b-%Y %H:%M:%S"), end_time.strftime("%d-%b-%Y %H:%M:%S"))
+    table_rows = "".join("<tr><td>{}</td><td>Primary</td><td>Outage</td></tr>".format(cid) for _ in range(rows))
+    return ("<html><body><p>Level 3 Communications scheduled maintenance.</p>"
+            "<p>Maintenance window: {}</p><table>{}</table></body></html>").format(window, table_rows)
+
+
+def _ical(cid, start_time, end_time):
+    return ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//NTT//Maintenance//EN\r\nBEGIN:VEVENT\r\n"
+            "UID:{}-{}\r\nDTSTART:{}\r\nDTEND:{}\r\nSUMMARY:Maintenance {}\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n").format(
+                cid, start_time.strftime("%Y%m%d%H%M"), start_time.strftime("%Y%m%dT%H%M%SZ"), end_time.strftime("%Y%m%dT%H%M%SZ"), cid)
+
+
+def _headers(message, sender, subject, number):
+    message["From"] = sender
+    message["To"] = "netops@example.com"
+    message["Subject"] = subject
+    message["Date"] = format_datetime(FIRST_WINDOW - timedelta(minutes=number))
+    message["Message-ID"] = make_msgid("notice{}".format(number), domain="corpus.example")
+    return message
+
+
+def make_message(kind, rng, number):
+    """Build one raw message of a kind in DEFAULT_MIX."""
+    start_time, end_time = _maintenance_window(rng)
+    if kind == "ntt_plain":
+        cid = _ntt_cid(rng)
+        message = MIMEText(_ntt_body(cid, start_time, end_time))
+        return _headers(message, "NTT NOC <coins@noc.us.ntt.net>", "Maintenance Notice {}".format(cid), number).as_bytes()
+    if kind == "ntt_ical":
+        cid = _ntt_cid(rng)
+        message = MIMEMultipart()
+        message.attach(MIMEText(_ntt_body(cid, start_time, end_time)))
+        message.attach(MIMEText(_ical(cid, start_time, end_time), "calendar"))
+        return _headers(message, "NTT NOC <coins@noc.us.ntt.net>", "Maintenance Notice {}".format(cid), number).as_bytes()
+    if kind == "level3_html":
+        cid = _level3_cid(rng)
+        message = MIMEText(_level3_html(cid, start_time, end_time), "html")
+        return _headers(message, "Level 3 <no-reply@level3.com>", "Initial Maintenance Notification", number).as_bytes()
+    if kind == "level3_large":
+        cid = _level3_cid(rng)
+        message = MIMEMultipart()
+        message.attach(MIMEText("See the HTML part for details.\n" * 20))
+        message.attach(MIMEText(_level3_html(cid, start_time, end_time, rows=50), "html"))
+        message.attach(MIMEApplication(rng.getrandbits(8 * LARGE_ATTACHMENT_SIZE).to_bytes(LARGE_ATTACHMENT_SIZE, "little"), "pdf", Name="maintenance.pdf"))
+        return _headers(message, "Level 3 <no-reply@level3.com>", "Initial Maintenance Notification", number).as_bytes()
+    if kind == "unrelated":
+        message = MIMEText("Weekly report {}.\n".format(number) * 20)
+        return _headers(message, "Reports <reports@example.com>", "Weekly report", number).as_bytes()
+    raise ValueError("Unknown message kind: {}".format(kind))
+
+
+def generate_corpus(count, seed=0, mix=DEFAULT_MIX):
+    """Yield (kind, raw_message) for a reproducible mailbox of ``count`` messages."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    for number in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        yield kind, make_message(kind, rng, number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic maintenance notice mailbox.")
+    parser.add_argument("count", type=int)
+    parser.add_argument("mbox_path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    mbox = mailbox.mbox(args.mbox_path)
+    try:
+        for _, raw_message in generate_corpus(args.count, seed=args.seed):
+            mbox.add(raw_message)
+    finally:
+        mbox.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+"""End-to-end benchmarks of reading maintenance notices and writing them to the calendar.
+
+The mailbox and Calendar API are local stand-ins (see tests/fake_imap_server.py and
+tests/fake_calendar_api.py) with configurable latency. Each case runs in a fresh child process
+so its peak RSS is its own and doesn't include the corpus held by the fake servers.
+
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000 --output results.json
+"""
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks.corpus import generate_corpus
+from tests.fake_calendar_api import FakeCalendarAPI, FakeCalendarServer
+from tests.fake_imap_server import FakeIMAPServer, FakeMailbox
+
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_MODES = ("serial", "pipeline")
+RESULTS_VERSION = 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    return {
+        "count": len(durations),
+        "total_seconds": sum(durations),
+        "p50_seconds": percentile(durations, 0.50),
+        "p90_seconds": percentile(durations, 0.90),
+        "p99_seconds": percentile(durations, 0.99),
+        "max_seconds": durations[-1] if durations else None,
+    }
+
+
+class StageTimer(object):
+    """Times calls to the functions each stage is made of, by wrapping them in place."""
+
+    def __init__(self):
+        self.durations = {}
+        self._patches = []
+
+    def wrap(self, owner, name, stage, when=None):
+        original = owner.__dict__[name]
+        function = original.__func__ if isinstance(original, staticmethod) else original
+        durations = self.durations.setdefault(stage, [])
+
+        def timed(*args, **kwargs):
+            if when and not when(*args, **kwargs):
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.append(time.perf_counter() - started)
+        setattr(owner, name, staticmethod(timed) if isinstance(original, staticmethod) else timed)
+        self._patches.append((owner, name, original))
+
+    def restore(self):
+        for owner, name, original in reversed(self._patches):
+            setattr(owner, name, original)
+        self._patches = []
+
+
+def run_case(case):
+    """Run one benchmark case against already running fake servers and return its results."""
+    import imaplib
+    import manage_maintenance.manage
+    from manage_maintenance.google_calendar import CalendarEventBatch, GoogleCalendar
+    from manage_maintenance.manage import ManageMaintenance
+    from manage_maintenance.pipeline import MaintenancePipeline
+    from manage_maintenance.request_scheduler import RequestScheduler
+    from tests.fake_calendar_api import build_service
+
+    manage_maintenance.manage.config.SCHEDULE_FILE_PATH = case["work_dir"]
+    # The fake API has no quota, so only the client side is measured
+    google_calendar = GoogleCalendar(service=build_service(case["calendar_url"]), mirror_file_path="{}/calendar_mirror.json".format(case["work_dir"]),
+                                     scheduler=RequestScheduler(requests_per_second=None), retry_queue_file="{}/calendar_retry_queue.json".format(case["work_dir"]))
+    manager = ManageMaintenance(imap_username="benchmark", imap_password="benchmark", imap_address="127.0.0.1", imap_folder="INBOX",
+                                imap_port=case["imap_port"], imap_ssl=False, parse_workers=case["parse_workers"], google_calendar=google_calendar,
+                                header_first_fetch=case["header_first_fetch"])
+
+    timer = StageTimer()
+    timer.wrap(ManageMaintenance, "list_new_message_ids", "imap_search")
+    timer.wrap(imaplib.IMAP4, "uid", "imap_fetch", when=lambda imap, command, *args: command == "FETCH")
+    timer.wrap(ManageMaintenance, "extract_maintenances", "parse")
+    timer.wrap(CalendarEventBatch, "flush", "calendar_batch")
+    try:
+        started = time.perf_counter()
+        if case["mode"] == "pipeline":
+            results = MaintenancePipeline(manager, fetch_workers=case["fetch_workers"], parse_workers=max(case["parse_workers"], 1)).run(since="1-Oct-2017")
+        else:
+            results = manager.add_maintenances_to_calendar(manager.list_maintenances(since="1-Oct-2017"))
+        elapsed = time.perf_counter() - started
+    finally:
+        timer.restore()
+        manager.disconnect_imap()
+
+    return {
+        "mode": case["mode"],
+        "mailbox_size": case["mailbox_size"],
+        "parse_workers": case["parse_workers"],
+        "fetch_workers": case["fetch_workers"] if case["mode"] == "pipeline" else 1,
+        "header_first_fetch": case["header_first_fetch"],
+        "imap_latency_seconds": case["imap_latency"],
+        "calendar_latency_seconds": case["calendar_latency"],
+        "notifications": len(results),
+        "elapsed_seconds": elapsed,
+        "messages_per_second": case["mailbox_size"] / elapsed if elapsed else None,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        # Stages that ran in parse worker processes have no timings here
+        "stages": {stage: summarize(durations) for stage, durations in timer.durations.items() if durations},
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, modes=DEFAULT_MODES, imap_latency=0.0, calendar_latency=0.05, parse_workers=0, fetch_workers=2, seed=0,
+                   header_first_fetch=False):
+    results = []
+    for size in sizes:
+        mailbox = FakeMailbox(raw_message for _, raw_message in generate_corpus(size, seed=seed))
+        for mode in modes:
+            calendar_api = FakeCalendarAPI(latency=calendar_latency, page_size=2500)
+            with FakeIMAPServer(mailbox, latency=imap_latency) as imap_server, FakeCalendarServer(calendar_api) as calendar_server, \
+                    tempfile.TemporaryDirectory() as work_dir:
+                case = {"mode": mode, "mailbox_size": size, "imap_port": imap_server.address[1], "calendar_url": calendar_server.url, "work_dir": work_dir,
+                        "imap_latency": imap_latency, "calendar_latency": calendar_latency, "parse_workers": parse_workers, "fetch_workers": fetch_workers,
+                        "header_first_fetch": header_first_fetch}
+                fetched_bytes = mailbox.fetched_bytes
+                output = subprocess.run([sys.executable, "-m", "benchmarks.run_benchmarks", "--case", json.dumps(case)],
+                                        stdout=subprocess.PIPE, check=True).stdout
+                result = json.loads(output.decode("utf-8"))
+                result["calendar_api_calls"] = len(calendar_api.requests)
+                result["calendar_batch_requests"] = calendar_api.batch_requests
+                result["imap_fetched_bytes"] = mailbox.fetched_bytes - fetched_bytes
+                results.append(result)
+                print("{mode:>8} {mailbox_size:>7} messages: {messages_per_second:9.1f} messages/s, {notifications} notifications, "
+                      "peak RSS {peak_rss_mb:.0f} MB".format(peak_rss_mb=result["peak_rss_bytes"] / 2 ** 20, **result), file=sys.stderr)
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark manage-maintenance against local IMAP and Calendar API stand-ins.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Mailbox sizes to benchmark")
+    parser.add_argument("--modes", nargs="+", choices=DEFAULT_MODES, default=DEFAULT_MODES)
+    parser.add_argument("--imap-latency", type=float, default=0.0, help="Seconds added to every IMAP command")
+    parser.add_argument("--calendar-latency", type=float, default=0.05, help="Seconds added to every Calendar API HTTP request")
+    parser.add_argument("--parse-workers", type=int, default=0)
+    parser.add_argument("--fetch-workers", type=int, default=2, help="IMAP connections used by the pipeline mode")
+    parser.add_argument("--header-first-fetch", action="store_true", help="Screen headers before downloading message bodies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        json.dump(run_case(json.loads(args.case)), sys.stdout)
+        return
+
+    results = run_benchmarks(sizes=args.sizes, modes=args.modes, imap_latency=args.imap_latency, calendar_latency=args.calendar_latency,
+                             parse_workers=args.parse_workers, fetch_workers=args.fetch_workers, seed=args.seed, header_first_fetch=args.header_first_fetch)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
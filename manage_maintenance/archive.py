@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+import mmap
+import os
+from email.parser import BytesHeaderParser
+
+from manage_maintenance.metrics import METRICS
+from manage_maintenance.sources import MessageSource
+
+
+LOG = logging.getLogger(__name__)
+
+
+MBOX_SEPARATOR = b"\nFrom "
+
+MAILDIR_SUBDIRECTORIES = ("cur", "new")
+
+
+def is_maildir(path):
+    return os.path.isdir(path) and all(os.path.isdir(os.path.join(path, subdirectory)) for subdirectory in MAILDIR_SUBDIRECTORIES)
+
+
+def scan_mbox(data):
+    """Yield the (start, end) offsets of each message in mbox ``data`` (bytes or an mmap), without its "From " line."""
+    if data[:5] == b"From ":
+        position = 0
+    else:
+        position = data.find(MBOX_SEPARATOR)
+        if position < 0:
+            return
+        position += 1
+    while True:
+        start = data.find(b"\n", position)
+        if start < 0:
+            return
+        start += 1
+        separator = data.find(MBOX_SEPARATOR, start - 1)
+        end = separator if separator >= 0 else len(data)
+        # The line break before the next "From " line belongs to the separator
+        if end > start and data[end - 1:end] == b"\r":
+            end -= 1
+        yield start, max(start, end)
+        if separator < 0:
+            return
+        position = separator + 1
+
+
+class ArchiveMessageSource(MessageSource):
+    """Messages from local mail archives, for replaying notices without a mail server.
+
+    ``paths`` may name mbox files, Maildir directories (with ``cur`` and ``new``), ``.eml`` files
+    or directories of ``.eml`` files, read in the order given. mbox files are memory-mapped and
+    scanned for message boundaries once, so only the offsets of an archive's messages are held
+    and each message is copied out when it is fetched. Message IDs are indexes into that list.
+
+    ``since`` and checkpoints don't apply: every listing covers the whole archive.
+    """
+
+    def __init__(self, paths):
+        self._paths = list(paths)
+        self._maps = []
+        self._index = None   # [(mmap, start, end) or (file path, None, None), ...]
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+        self._index = None
+
+    def list_message_ids(self, since=None):
+        if self._index is None:
+            self._index = []
+            for path in self._paths:
+                self._index_path(path)
+            LOG.info("Indexed %s messages in %s", len(self._index), ", ".join(self._paths))
+        return list(range(len(self._index)))
+
+    def _index_path(self, path):
+        if is_maildir(path):
+            for subdirectory in MAILDIR_SUBDIRECTORIES:
+                directory = os.path.join(path, subdirectory)
+                self._index.extend((os.path.join(directory, file_name), None, None) for file_name in sorted(os.listdir(directory))
+                                   if not file_name.startswith("."))
+        elif os.path.isdir(path):
+            for directory, directory_names, file_names in os.walk(path):
+                directory_names.sort()
+                self._index.extend((os.path.join(directory, file_name), None, None) for file_name in sorted(file_names)
+                                   if file_name.lower().endswith(".eml"))
+        elif path.lower().endswith(".eml"):
+            self._index.append((path, None, None))
+        else:
+            self._index_mbox(path)
+
+    def _index_mbox(self, path):
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        with METRICS.timer("archive_index_seconds"):
+            self._index.extend((mapped, start, end) for start, end in scan_mbox(mapped))
+
+    def _read(self, message_id, header_only=False):
+        location, start, end = self._index[message_id]
+        if start is not None:
+            if header_only:
+                # Headers end at the first blank line
+                header_end = location.find(b"\n\n", start, end)
+                if header_end < 0:
+                    header_end = location.find(b"\n\r\n", start, end)
+                end = header_end + 1 if header_end >= 0 else end
+            return location[start:end]
+        with open(location, "rb") as f:
+            return f.read()
+
+    def fetch_raw_messages(self, message_ids):
+        for message_id in message_ids:
+            raw_message = self._read(message_id)
+            METRICS.increment("archive_read_bytes_total", len(raw_message))
+            yield message_id, raw_message
+
+    def fetch_screening_headers(self, message_ids):
+        header_parser = BytesHeaderParser()
+        return {message_id: header_parser.parsebytes(self._read(message_id, header_only=True)) for message_id in message_ids}
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import json
+import logging
+import os
+
+from apiclient import errors
+
+from manage_maintenance.files import write_atomically
+from manage_maintenance.metrics import METRICS
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Largest page the Calendar API returns for events().list
+LIST_PAGE_SIZE = 2500
+
+
+def _execute(request, method):
+    with METRICS.timer("calendar_api_call_seconds", method=method):
+        return request.execute()
+
+
+class CalendarMirror(object):
+    """Local copy of calendar events keyed by event ID, kept current with incremental syncToken syncs.
+
+    The file on disk always holds a consistent snapshot of events and the sync token they
+    correspond to. Writes made through put/remove only update the in-memory copy; the next
+    incremental sync brings the same changes down from the API.
+    """
+
+    def __init__(self, file_path):
+        self._file_path = os.path.expanduser(file_path)
+        self._calendars = None
+
+        # Bumped on every change so derived indexes know when to rebuild
+        self.version = 0
+
+    def _load(self):
+        if self._calendars is None:
+            try:
+                with open(self._file_path) as f:
+                    self._calendars = json.load(f)
+            except FileNotFoundError:
+                self._calendars = {}
+        return self._calendars
+
+    def _calendar(self, calendarId):
+        return self._load().setdefault(calendarId, {"sync_token": None, "events": {}})
+
+    def save(self):
+        write_atomically(self._file_path, json.dumps(self._load()))
+
+    def sync(self, service, calendarId='primary', execute=None):
+        """Bring the mirror up to date and return the number of changed events.
+
+        The first sync lists every event; later syncs only fetch changes since the stored sync
+        token. A 410 Gone response means the token expired and triggers a full resync.
+        ``execute(request, method)`` sends the list requests, e.g. through a RequestScheduler.
+        """
+        calendar = self._calendar(calendarId)
+        execute = execute or _execute
+        try:
+            items, next_sync_token = self._list_events(service, calendarId, calendar["sync_token"], execute)
+        except errors.HttpError as e:
+            if e.resp.status != 410 or not calendar["sync_token"]:
+                raise
+            LOG.info("Sync token for calendar %s is no longer valid, doing a full resync", calendarId)
+            calendar["sync_token"] = None
+            items, next_sync_token = self._list_events(service, calendarId, None, execute)
+
+        if not calendar["sync_token"]:
+            calendar["events"] = {}
+        for event in items:
+            if event.get("status") == "cancelled":
+                calendar["events"].pop(event["id"], None)
+            else:
+                calendar["events"][event["id"]] = event
+        calendar["sync_token"] = next_sync_token
+        self.version += 1
+        LOG.debug("Synced %s changed events for calendar %s", len(items), calendarId)
+        return len(items)
+
+    @staticmethod
+    def _list_events(service, calendarId, sync_token, execute):
+        items = []
+        page_token = None
+        while True:
+            kwargs = {"calendarId": calendarId, "maxResults": LIST_PAGE_SIZE}
+            if sync_token:
+                kwargs["syncToken"] = sync_token
+            if page_token:
+                kwargs["pageToken"] = page_token
+            result = execute(service.events().list(**kwargs), "list")
+            items.extend(result.get("items", []))
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return items, result.get("nextSyncToken")
+
+    def get(self, eventId, calendarId='primary'):
+        return self._calendar(calendarId)["events"].get(eventId)
+
+    def events(self, calendarId='primary'):
+        return list(self._calendar(calendarId)["events"].values())
+
+    def put(self, event, calendarId='primary'):
+        self._calendar(calendarId)["events"][event["id"]] = event
+        self.version += 1
+
+    def remove(self, eventId, calendarId='primary'):
+        self._calendar(calendarId)["events"].pop(eventId, None)
+        self.version += 1
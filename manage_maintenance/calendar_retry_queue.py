@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import json
+import os
+import threading
+
+from manage_maintenance.files import write_atomically
+
+
+class CalendarRetryQueue(object):
+    """Calendar event writes that ran out of retries, kept on disk until a later run replays them.
+
+    Entries are ``{"action": "insert" | "update" | "delete", "calendarId", "eventId", "event"}``,
+    at most one per event: a later write replaces an earlier one, except that an update of an
+    event whose insert is still queued becomes the insert of the updated event. The file is
+    rewritten atomically on every change, and not created until something is queued.
+    """
+
+    def __init__(self, file_path):
+        self._file_path = os.path.expanduser(file_path)
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self._file_path) as f:
+                    self._entries = json.load(f)
+            except FileNotFoundError:
+                self._entries = []
+        return self._entries
+
+    def _save(self):
+        write_atomically(self._file_path, json.dumps(self._entries))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._load())
+
+    def entries(self, calendarId=None):
+        with self._lock:
+            return [dict(entry) for entry in self._load() if calendarId is None or entry["calendarId"] == calendarId]
+
+    def put(self, action, eventId, event=None, calendarId='primary'):
+        with self._lock:
+            entries = self._load()
+            previous = next((entry for entry in entries if entry["calendarId"] == calendarId and entry["eventId"] == eventId), None)
+            if previous:
+                entries.remove(previous)
+                if previous["action"] == "insert" and action == "update":
+                    action = "insert"
+            entries.append({"action": action, "calendarId": calendarId, "eventId": eventId, "event": event})
+            self._save()
+
+    def remove(self, entries):
+        """Drop replayed entries, unless a newer write for their event was queued since."""
+        with self._lock:
+            current = self._load()
+            for entry in entries:
+                if entry in current:
+                    current.remove(entry)
+            self._save()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import json
+import os
+
+from manage_maintenance.files import write_atomically
+
+
+class IMAPCheckpointStore(object):
+    """Persists the UIDVALIDITY and highest processed UID of each IMAP folder between runs."""
+
+    def __init__(self, file_path):
+        self._file_path = os.path.expanduser(file_path)
+        self._checkpoints = None
+
+    @staticmethod
+    def checkpoint_key(username, address, folder_name):
+        return "{}@{}/{}".format(username, address, folder_name)
+
+    def _load(self):
+        if self._checkpoints is None:
+            try:
+                with open(self._file_path) as f:
+                    self._checkpoints = json.load(f)
+            except FileNotFoundError:
+                self._checkpoints = {}
+        return self._checkpoints
+
+    def get(self, key, uidvalidity):
+        """Return the highest processed UID for a folder, or None if the checkpoint is missing or stale."""
+        checkpoint = self._load().get(key)
+        if not checkpoint or checkpoint["uidvalidity"] != uidvalidity:
+            return None
+        return checkpoint["uid"]
+
+    def set(self, key, uidvalidity, uid):
+        self._load()[key] = {"uidvalidity": uidvalidity, "uid": uid}
+        write_atomically(self._file_path, json.dumps(self._checkpoints, indent=2, sort_keys=True))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+from collections import OrderedDict, namedtuple
+from datetime import timezone
+
+from manage_maintenance.metrics import METRICS
+from manage_maintenance.schedule import to_db_time
+
+
+LOG = logging.getLogger(__name__)
+
+
+# The one calendar write a maintenance needs this run. action is "create", "update", "delete",
+# "unchanged" (already as notified) or "stale" (the schedule has a newer notice); event_id is the
+# calendar event it applies to, and maintenance_notification the final state, carrying that ID
+CalendarWrite = namedtuple("CalendarWrite", ("action", "event_id", "maintenance_notification"))
+
+
+def maintenance_key(maintenance_notification):
+    """Return what identifies a maintenance across its notices.
+
+    With a carrier reference, every notice quoting it for a CID is the same maintenance, so a
+    reschedule updates it. Without one, only notices for the same CID and window (reminders and
+    cancellations restating the window) can be told apart from separate maintenances.
+    """
+    if maintenance_notification.reference:
+        return maintenance_notification.partner, maintenance_notification.reference, maintenance_notification.cid
+    return maintenance_notification.partner, None, maintenance_notification.event_uuid
+
+
+def _sent_key(sent_time):
+    # Naive times (from the schedule, or a Date header without a zone) are taken as UTC
+    if sent_time is None:
+        return None
+    if sent_time.tzinfo is None:
+        sent_time = sent_time.replace(tzinfo=timezone.utc)
+    return sent_time.timestamp()
+
+
+def is_newer(maintenance_notification, other_sent_time):
+    """Whether a notice supersedes one sent at ``other_sent_time``; undated notices go by arrival order."""
+    sent_key, other_sent_key = _sent_key(maintenance_notification.sent_time), _sent_key(other_sent_time)
+    return sent_key is None or other_sent_key is None or sent_key >= other_sent_key
+
+
+def coalesce_notifications(maintenance_notifications):
+    """Reduce notifications to the final state of each maintenance, in order of first appearance.
+
+    The latest notice of each maintenance (by Date, then by arrival) wins, whether it is a
+    reschedule, a reminder or a cancellation.
+    """
+    final_notifications = OrderedDict()
+    count = 0
+    for maintenance_notification in maintenance_notifications:
+        count += 1
+        key = maintenance_key(maintenance_notification)
+        current = final_notifications.get(key)
+        if current is None or is_newer(maintenance_notification, current.sent_time):
+            final_notifications[key] = maintenance_notification
+    METRICS.increment("notifications_coalesced_total", count - len(final_notifications))
+    return list(final_notifications.values())
+
+
+def plan_calendar_writes(maintenance_notifications, schedule, event_exists):
+    """Yield one CalendarWrite per maintenance, comparing its final state with the schedule.
+
+    A maintenance already in the schedule keeps the event it was first created as, even when
+    rescheduled. ``event_exists(event_id)`` tells whether a calendar event exists (e.g. from the
+    calendar mirror), for cancellations of maintenances the schedule doesn't know.
+    """
+    for maintenance_notification in coalesce_notifications(maintenance_notifications):
+        if maintenance_notification.reference:
+            existing = schedule.find_by_reference(maintenance_notification.partner, maintenance_notification.reference, maintenance_notification.cid)
+        else:
+            existing = schedule.get(maintenance_notification.event_uuid)
+
+        if existing and not is_newer(maintenance_notification, existing["sent_time"]):
+            action, event_id = "stale", existing["event_uuid"]
+        elif maintenance_notification.cancelled:
+            event_id = existing["event_uuid"] if existing else maintenance_notification.event_uuid
+            if existing:
+                action = "unchanged" if existing["cancelled"] else "delete"
+            else:
+                action = "delete" if event_exists(event_id) else "unchanged"
+        elif existing and not existing["cancelled"]:
+            event_id = existing["event_uuid"]
+            unchanged = (to_db_time(maintenance_notification.start_time), to_db_time(maintenance_notification.end_time), maintenance_notification.cid) == \
+                (to_db_time(existing["start_time"]), to_db_time(existing["end_time"]), existing["cid"])
+            action = "unchanged" if unchanged else "update"
+        else:
+            action, event_id = "create", maintenance_notification.event_uuid
+        METRICS.increment("calendar_writes_planned_total", action=action)
+        yield CalendarWrite(action, event_id, maintenance_notification._replace(event_uuid=event_id))
@@ -2,10 +2,19 @@
 # Copyright 2017 Netflix
 
 
+# The Calendar API accepts at most 50 calls per batch request. Kept here rather than in google_calendar
+# so callers sizing batches don't have to import the Google API client
+MAX_BATCH_SIZE = 50
+
+
 class BaseConfig(object):
 
     SCHEDULE_FILE_PATH = "~/.manage-maintenance"
-    SCHEDULE_FILE_NAME = "schedule.db"
+    SCHEDULE_FILE_NAME = "schedule.db"     # Legacy TinyDB schedule, see manage_maintenance.schedule for migrating it
+    SCHEDULE_DB_FILE_NAME = "schedule.sqlite3"
+    IMAP_CHECKPOINT_FILE_NAME = "imap_checkpoints.json"
+    CIRCUIT_INVENTORY_INDEX_FILE_NAME = "circuit_inventory.idx"
+    PARSE_CACHE_FILE_NAME = "parse_cache.sqlite3"
 
 
 class TestConfig(BaseConfig):
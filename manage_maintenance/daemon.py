@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+import random
+import signal
+import time
+
+from manage_maintenance.imap import CONNECTION_ERRORS, DEFAULT_IDLE_TIMEOUT, DEFAULT_POLL_INTERVAL
+from manage_maintenance.metrics import METRICS
+
+
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_MIN_BACKOFF = 1
+DEFAULT_MAX_BACKOFF = 300
+
+
+class MaintenanceDaemon(object):
+    """Keeps a ManageMaintenance IMAP session open and pushes new notifications to the calendar as they arrive.
+
+    Each sync's notifications are written in batch requests, or with ``coalesce``, coalesced into
+    one calendar write per maintenance (see ManageMaintenance.sync_maintenances_to_calendar). The
+    IMAP checkpoint only advances once they are written, and not at all if a write failed for now
+    (see ManageMaintenance.commit_checkpoints), so the next sync lists those messages again.
+    """
+
+    def __init__(self, manager, since=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+                 min_backoff=DEFAULT_MIN_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, metrics_file=None, coalesce=False):
+        self._manager = manager
+        self._since = since
+        self._idle_timeout = idle_timeout
+        self._poll_interval = poll_interval
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._metrics_file = metrics_file
+        self._coalesce = coalesce
+        self._stopped = False
+
+    def stop(self):
+        LOG.info("Stopping maintenance daemon")
+        self._stopped = True
+
+    def _handle_signal(self, signum, frame):
+        # Raise to break out of a blocking IDLE; unprocessed UIDs are picked up again on the next start
+        self.stop()
+        raise SystemExit(0)
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def sync(self):
+        """Push every notification that arrived since the last checkpoint to the calendar."""
+        with METRICS.timer("daemon_sync_seconds"):
+            # Writes a throttled or failing Calendar API refused on an earlier sync go first
+            self._manager.replay_failed_calendar_writes()
+            maintenance_notifications = []
+            for maintenance_notification in self._manager.list_maintenances(since=self._since, defer_checkpoint=True):
+                LOG.info("Adding maintenance event: %s %s %s", maintenance_notification.partner, maintenance_notification.cid, maintenance_notification.start_time)
+                maintenance_notifications.append(maintenance_notification)
+            results = []
+            if maintenance_notifications and self._coalesce:
+                results = self._manager.sync_maintenances_to_calendar(maintenance_notifications)
+            elif maintenance_notifications:
+                results = self._manager.add_maintenances_to_calendar(maintenance_notifications)
+            self._manager.commit_checkpoints(results)
+        if self._metrics_file:
+            METRICS.write_prometheus_file(self._metrics_file)
+        return len(maintenance_notifications)
+
+    def run(self):
+        """Sync, then wait for new mail and sync again until stopped, backing off after failures.
+
+        A dropped IMAP connection is re-established; any other failure (an IMAP NO response, the
+        Calendar API still failing after retries, DNS, ...) is logged and the sync tried again.
+        """
+        backoff = self._min_backoff
+        while not self._stopped:
+            try:
+                self.sync()
+                backoff = self._min_backoff
+                while not self._stopped and not self._manager.wait_for_new_messages(timeout=self._idle_timeout, poll_interval=self._poll_interval):
+                    pass
+                continue
+            except CONNECTION_ERRORS as e:
+                METRICS.increment("imap_reconnects_total")
+                delay = random.uniform(backoff / 2, backoff)
+                LOG.warning("IMAP connection lost (%s), reconnecting in %.1f seconds", e, delay)
+                self._manager.disconnect_imap()
+            except Exception:
+                METRICS.increment("daemon_sync_failures_total")
+                delay = random.uniform(backoff / 2, backoff)
+                LOG.exception("Maintenance sync failed, retrying in %.1f seconds", delay)
+            self._sleep(delay)
+            backoff = min(backoff * 2, self._max_backoff)
+
+    def _sleep(self, delay):
+        deadline = time.monotonic() + delay
+        while not self._stopped and time.monotonic() < deadline:
+            time.sleep(min(1, deadline - time.monotonic()))
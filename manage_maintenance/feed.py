@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from email.utils import formatdate
+
+from manage_maintenance.files import write_atomically
+from manage_maintenance.metrics import METRICS
+from manage_maintenance.schedule import FEED_TABLE, ScheduleStore
+
+
+LOG = logging.getLogger(__name__)
+
+
+COMBINED_FEED_FILE_NAME = "maintenances.ics"
+
+# ETag and Last-Modified of every feed, for whatever serves the directory
+FEED_METADATA_FILE_NAME = "feeds.json"
+
+PRODID = "-//Netflix//manage-maintenance//EN"
+
+# Content lines longer than this many octets are folded (RFC 5545 3.1)
+MAX_LINE_OCTETS = 75
+
+# Outcome of publishing one feed: status is "written", "unchanged" or "removed"
+FeedWriteResult = namedtuple("FeedWriteResult", ("file_name", "status", "etag", "events"))
+
+
+def escape_text(value):
+    """Escape a TEXT property value."""
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+
+def fold_line(line):
+    """Fold a content line into lines of at most 75 octets, never splitting a UTF-8 character."""
+    if len(line.encode("utf-8")) <= MAX_LINE_OCTETS:
+        return line
+    lines = []
+    current, octets = [], 0
+    for character in line:
+        size = len(character.encode("utf-8"))
+        # Continuation lines start with a space, which counts towards their 75 octets
+        if octets + size > MAX_LINE_OCTETS - (1 if lines else 0):
+            lines.append("".join(current))
+            current, octets = [], 0
+        current.append(character)
+        octets += size
+    lines.append("".join(current))
+    return "\r\n ".join(lines)
+
+
+def format_utc_time(value):
+    """Format a schedule time (naive UTC, or aware) as a UTC DATE-TIME."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime("%Y%m%dT%H%M%SZ")
+
+
+def partner_feed_file_name(partner):
+    slug = re.sub(r"[^a-z0-9]+", "-", (partner or "").lower()).strip("-")
+    return "maintenances-{}.ics".format(slug or "unknown")
+
+
+def render_event(maintenance):
+    """Render a schedule row as the content lines of a VEVENT, its UID being the calendar event ID."""
+    summary = "Scheduled Maintenance: {} {}".format(maintenance["partner"], maintenance["cid"])
+    description = "{} will be performing maintenance starting {} and ending {} that will affect the following CIDs:\n{}".format(
+        maintenance["partner"], maintenance["start_time"].isoformat(), maintenance["end_time"].isoformat(), maintenance["cid"])
+    if maintenance.get("affected_devices"):
+        description += "\n\nAffected devices:\n{}".format("\n".join("{} {}".format(hostname, interface) for hostname, interface in maintenance["affected_devices"]))
+    if maintenance.get("reference"):
+        description += "\n\nReference: {}".format(maintenance["reference"])
+    # DTSTAMP comes from the notice rather than the clock, so an unchanged schedule renders the same feed
+    stamp = maintenance.get("sent_time") if isinstance(maintenance.get("sent_time"), datetime) else maintenance["start_time"]
+    lines = [
+        "BEGIN:VEVENT",
+        "UID:{}".format(maintenance["event_uuid"]),
+        "DTSTAMP:{}".format(format_utc_time(stamp)),
+        "DTSTART:{}".format(format_utc_time(maintenance["start_time"])),
+        "DTEND:{}".format(format_utc_time(maintenance["end_time"])),
+        "SUMMARY:{}".format(escape_text(summary)),
+        "DESCRIPTION:{}".format(escape_text(description)),
+        "STATUS:{}".format("CANCELLED" if maintenance.get("cancelled") else "CONFIRMED"),
+        "TRANSP:OPAQUE",
+        "END:VEVENT",
+    ]
+    return "".join(fold_line(line) + "\r\n" for line in lines)
+
+
+def render_feed(name, rendered_events):
+    """Wrap rendered VEVENTs in a VCALENDAR and return its UTF-8 bytes."""
+    header = "".join(fold_line(line) + "\r\n" for line in (
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:{}".format(PRODID), "CALSCALE:GREGORIAN", "METHOD:PUBLISH", "X-WR-CALNAME:{}".format(escape_text(name))))
+    return (header + "".join(rendered_events) + "END:VCALENDAR\r\n").encode("utf-8")
+
+
+class ICSFeedPublisher(object):
+    """Publishes the schedule as subscribable iCalendar feeds: one combined and one per partner.
+
+    Each publish renders every feed from the schedule rows given, but only replaces the files
+    whose contents changed, atomically, so subscribers polling with If-None-Match or
+    If-Modified-Since see a change only when there is one. Cancelled maintenances stay in the
+    feeds with STATUS:CANCELLED, so subscribers drop them too. The ETag and Last-Modified of each
+    feed are kept in feeds.json next to them, and Last-Modified is also the file's mtime.
+    """
+
+    def __init__(self, directory):
+        self._directory = os.path.expanduser(directory)
+        self._metadata_file_path = os.path.join(self._directory, FEED_METADATA_FILE_NAME)
+        self._metadata = None
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def _load_metadata(self):
+        if self._metadata is None:
+            try:
+                with open(self._metadata_file_path) as f:
+                    self._metadata = json.load(f)
+            except FileNotFoundError:
+                self._metadata = {}
+        return self._metadata
+
+    def headers(self, file_name):
+        """Return the ETag and Last-Modified headers of a published feed, or None if there is no such feed."""
+        metadata = self._load_metadata().get(file_name)
+        if not metadata:
+            return None
+        return {"ETag": '"{}"'.format(metadata["etag"]), "Last-Modified": formatdate(metadata["last_modified"], usegmt=True)}
+
+    def publish(self, maintenances):
+        """Publish schedule rows (as returned by ScheduleStore) and return a FeedWriteResult per feed."""
+        feeds = OrderedDict([(COMBINED_FEED_FILE_NAME, ("Maintenances", []))])
+        with METRICS.timer("feed_render_seconds"):
+            for maintenance in maintenances:
+                rendered_event = render_event(maintenance)
+                feeds[COMBINED_FEED_FILE_NAME][1].append(rendered_event)
+                file_name = partner_feed_file_name(maintenance["partner"])
+                feeds.setdefault(file_name, ("Maintenances - {}".format(maintenance["partner"]), []))[1].append(rendered_event)
+
+        os.makedirs(self._directory, exist_ok=True)
+        metadata = self._load_metadata()
+        modified_time = int(time.time())
+        results = []
+        for file_name, (name, rendered_events) in feeds.items():
+            data = render_feed(name, rendered_events)
+            etag = hashlib.sha256(data).hexdigest()[:32]
+            if metadata.get(file_name, {}).get("etag") == etag and os.path.exists(os.path.join(self._directory, file_name)):
+                results.append(FeedWriteResult(file_name, "unchanged", etag, len(rendered_events)))
+                continue
+            write_atomically(os.path.join(self._directory, file_name), data, modified_time)
+            metadata[file_name] = {"etag": etag, "last_modified": modified_time, "events": len(rendered_events)}
+            METRICS.increment("feed_bytes_written_total", len(data))
+            results.append(FeedWriteResult(file_name, "written", etag, len(rendered_events)))
+        # Partners with no maintenances left lose their feed
+        for file_name in sorted(set(metadata) - set(feeds)):
+            try:
+                os.remove(os.path.join(self._directory, file_name))
+            except FileNotFoundError:
+                pass
+            del metadata[file_name]
+            results.append(FeedWriteResult(file_name, "removed", None, 0))
+
+        if any(result.status != "unchanged" for result in results):
+            write_atomically(self._metadata_file_path, json.dumps(metadata, indent=2, sort_keys=True))
+        for result in results:
+            METRICS.increment("feed_writes_total", status=result.status)
+        LOG.info("Published %s maintenances to %s: %s of %s feeds changed", len(feeds[COMBINED_FEED_FILE_NAME][1]), self._directory,
+                 sum(1 for result in results if result.status != "unchanged"), len(results))
+        return results
+
+    def publish_schedule(self, schedule):
+        """Publish every maintenance of a ScheduleStore."""
+        return self.publish(schedule.all())
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python -m manage_maintenance.feed FEED_DIRECTORY")
+    with ScheduleStore.from_config(FEED_TABLE) as schedule:
+        ICSFeedPublisher(sys.argv[1]).publish_schedule(schedule)
+
+
+if __name__ == "__main__":
+    main()
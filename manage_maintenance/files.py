@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import os
+import tempfile
+
+
+# Temporary files are created 0600; replaced files get the mode a plain open() would have given them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_atomically(file_path, data, modified_time=None):
+    """Replace a file with str or bytes-like data, creating its directory if needed.
+
+    The data is written and synced to a uniquely named temporary file next to it first, so
+    concurrent writers, readers and crashed runs never see a partly written file.
+    ``modified_time``, in seconds since the epoch, sets its mtime.
+    """
+    directory = os.path.dirname(file_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w" if isinstance(data, str) else "wb", dir=directory, prefix=".{}.".format(os.path.basename(file_path)),
+                                     suffix=".tmp", delete=False) as f:
+        temp_file_path = f.name
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(temp_file_path)
+            raise
+    try:
+        os.chmod(temp_file_path, 0o666 & ~_UMASK)
+        if modified_time is not None:
+            os.utime(temp_file_path, (modified_time, modified_time))
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        os.remove(temp_file_path)
+        raise
+    _sync_directory(directory)
+
+
+def _sync_directory(directory):
+    # Make the rename itself durable; not every platform can open a directory
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
@@ -4,16 +4,23 @@ import errno
 import httplib2
 import os
 from datetime import datetime, timedelta, date
-import dateutil.parser
 import logging
 import argparse
-from imp import reload
+from collections import namedtuple
 from apiclient import discovery
 from apiclient import errors
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
+from manage_maintenance.calendar_mirror import CalendarMirror
+from manage_maintenance.calendar_retry_queue import CalendarRetryQueue
+from manage_maintenance.config import MAX_BATCH_SIZE
+from manage_maintenance.files import write_atomically
+from manage_maintenance.metrics import METRICS
+from manage_maintenance.overlap import OverlapIndex
+from manage_maintenance.request_scheduler import RequestScheduler, is_retryable, is_throttled
+
 SCOPES                  = "https://www.googleapis.com/auth/calendar"
 APPLICATION_NAME        = "Google Calendar API Python Quickstart"
 
@@ -25,8 +32,22 @@ CREDENTIALS_DIR         = os.path.join(HOME_DIR, ".credentials")
 CLIENT_SECRET_FILE      = os.path.join(CREDENTIALS_DIR, "client_secret.json")
 CREDENTIALS_FILENAME    = "oauth_creds.json" # n.b.: no path
 
+# Local mirror of calendar events, kept next to the OAuth credentials
+CALENDAR_MIRROR_FILE    = os.path.join(CREDENTIALS_DIR, "calendar_mirror.json")
+
+# Event writes that ran out of retries, replayed on the next run
+CALENDAR_RETRY_QUEUE_FILE = os.path.join(CREDENTIALS_DIR, "calendar_retry_queue.json")
+
+# Cached Calendar API discovery document, so building the service needs no network
+DISCOVERY_URL           = "https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest"
+DISCOVERY_DOCUMENT_FILE = os.path.join(CREDENTIALS_DIR, "calendar.v3.discovery.json")
+
 LOGGING_FILE            = os.path.join(HOME_DIR, "hackathon_debug.log")
 
+# Outcome of one write in a batch: status is one of "created", "updated", "exists", "deleted", "missing",
+# "queued" (still failing after retries, and kept for the next run) or "failed"
+EventWriteResult = namedtuple("EventWriteResult", ("event_id", "action", "status", "event", "error"))
+
 
 def mkdir_p(path):
     try:
@@ -45,33 +66,47 @@ def get_client_secret_file_path():
 
 
 class GoogleCalendar(object):
-    """ Google Calendar API Wrapper Class """
+    """ Google Calendar API Wrapper Class
 
-    def __init__(self):
+    Nothing touches OAuth or the network until the first API call. Pass ``service`` to use an
+    already built (or fake) Calendar API client instead.
 
-        try:
-            self._flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
-            # Prevent a browser from opening
-            self._flags.noauth_local_webserver = True
-        except ImportError:
-            self._flags = None
+    Every API call goes through ``scheduler`` (a RequestScheduler), which keeps within the quota
+    and retries throttling and server errors. Writes that still fail with a retryable error are
+    kept in a CalendarRetryQueue and sent again by replay_failed_writes.
+    """
 
-        ## Init logging
-        self._logger = self.create_logger(logging_filename=LOGGING_FILE)
-        logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+    def __init__(self, service=None, flags=None, mirror_file_path=CALENDAR_MIRROR_FILE, discovery_document_file=DISCOVERY_DOCUMENT_FILE,
+                 scheduler=None, retry_queue_file=CALENDAR_RETRY_QUEUE_FILE):
 
-        ## Get credentials, build calendar service object
-        mkdir_p(CREDENTIALS_DIR)
-        credentials = self.get_credentials(CLIENT_SECRET_FILE, SCOPES, CREDENTIALS_DIR, CREDENTIALS_FILENAME)
-        self._service = self.get_service(credentials)
+        self._flags = flags
+        self.__service = service
+        self._discovery_document_file = discovery_document_file
+        self.scheduler = scheduler or RequestScheduler()
+        self.retry_queue = CalendarRetryQueue(retry_queue_file)
 
+        ## Init logging
+        self._logger = logging.getLogger(__name__)
+        logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 
-        self.naive_find_event_overlap()
+        ## Local event mirror, synced on first use of each calendar
+        self._mirror = CalendarMirror(mirror_file_path)
+        self._synced_calendars = set()
+        self._overlap_indexes = {}
+
+    # The Calendar API service object, built on first use
+    @property
+    def _service(self):
+        if self.__service is None:
+            ## Get credentials, build calendar service object
+            mkdir_p(CREDENTIALS_DIR)
+            credentials = self.get_credentials(CLIENT_SECRET_FILE, SCOPES, CREDENTIALS_DIR, CREDENTIALS_FILENAME)
+            self.__service = self.get_service(credentials)
+        return self.__service
 
     def create_logger(self, logging_filename):
 
         ## Setup logging
-        reload(logging)
         logger = logging.getLogger(__name__)
         logger.setLevel(logging.DEBUG)
 
@@ -92,8 +127,20 @@ class GoogleCalendar(object):
         logger.addHandler(fhandler_dbg)
         logger.addHandler(chandler)
 
+        self._logger = logger
         return logger
 
+    # Command line flags for the OAuth flow, only needed when there are no valid stored credentials
+    def get_flags(self):
+        if self._flags is None:
+            try:
+                self._flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args([])
+                # Prevent a browser from opening
+                self._flags.noauth_local_webserver = True
+            except ImportError:
+                self._flags = None
+        return self._flags
+
     # Create credentials directory, if necessary
     def get_credentials(self, client_secret_file, scopes, credentials_dir, credentials_file, flags=None):
 
@@ -109,8 +156,9 @@ class GoogleCalendar(object):
         if not credentials or credentials.invalid:
             flow = client.flow_from_clientsecrets(client_secret_file, scopes)
             flow.user_agent = APPLICATION_NAME
-            if self._flags:
-                credentials = tools.run_flow(flow, store, self._flags)
+            flags = flags or self.get_flags()
+            if flags:
+                credentials = tools.run_flow(flow, store, flags)
             else: # Needed only for compatibility with Python 2.6
                 credentials = tools.run(flow, store)
             self._logger.debug("Storing credentials to '{}'".format(credential_path))
@@ -122,19 +170,61 @@ class GoogleCalendar(object):
     # Create a Google Calendar API service object
     def get_service(self, credentials):
         http = credentials.authorize(httplib2.Http())
-        service = discovery.build('calendar', 'v3', http=http)
+        service = discovery.build_from_document(self.get_discovery_document(), http=http)
         self._logger.debug("Created service object")
 
         return service
 
+    # Load the Calendar API discovery document, downloading it to the on-disk cache the first time
+    def get_discovery_document(self):
+        try:
+            with open(self._discovery_document_file) as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        response, content = httplib2.Http().request(DISCOVERY_URL)
+        if response.status != 200:
+            raise Exception("Error downloading the Calendar API discovery document: {} {}".format(response.status, content))
+        write_atomically(self._discovery_document_file, content)
+        self._logger.debug("Cached discovery document at '{}'".format(self._discovery_document_file))
+        return content.decode("utf-8")
+
+    # Execute a Calendar API request through the scheduler
+    def _execute(self, request, method, cost=1):
+        return self.scheduler.execute(request, method, cost=cost)
+
+    # Keep a write that ran out of retries for the next run
+    def _queue_failed_write(self, action, eventId, event, calendarId, error):
+        self._logger.warning("Queueing {} of event {} for retry: {}".format(action, eventId, str(error)))
+        METRICS.increment("calendar_writes_queued_total", action=action)
+        self.retry_queue.put(action, eventId, event=event, calendarId=calendarId)
+
+    # Bring the local event mirror of a calendar up to date with the API
+    def sync_mirror(self, calendarId='primary'):
+        changes = self._mirror.sync(self._service, calendarId, execute=self._execute)
+        self._mirror.save()
+        self._synced_calendars.add(calendarId)
+        self._logger.debug("Synced {} changed events into the local mirror".format(changes))
+        return changes
+
+    # Get the local event mirror, syncing the calendar on first use
+    def get_mirror(self, calendarId='primary'):
+        if calendarId not in self._synced_calendars:
+            self.sync_mirror(calendarId)
+        return self._mirror
+
     # Create a calendar event for a given calendar ID
     def create_calendar_event(self, event, calendarId='primary'):
         # Create event
         try:
-            event = self._service.events().insert(calendarId=calendarId, body=event).execute()
-            self._logger.info("Event created: '{}'".format(event.get('htmlLink')))
-            return event
+            created_event = self._execute(self._service.events().insert(calendarId=calendarId, body=event), 'insert')
+            self._logger.info("Event created: '{}'".format(created_event.get('htmlLink')))
+            self._mirror.put(created_event, calendarId)
+            return created_event
         except errors.HttpError as e:
+            if is_retryable(e) and event.get('id'):
+                self._queue_failed_write('insert', event['id'], event, calendarId, e)
+                return
             self._logger.error("Exception while creating event: {}".format(str(e)))
             return
 
@@ -142,46 +232,72 @@ class GoogleCalendar(object):
     def update_calendar_event(self, eventId, event, calendarId='primary'):
         # Update event
         try:
-            event = self._service.events().update(eventId=eventId, calendarId=calendarId, body=event).execute()
-            self._logger.info("Event updated: '{}'".format(event.get('htmlLink')))
-            return event
+            updated_event = self._execute(self._service.events().update(eventId=eventId, calendarId=calendarId, body=event), 'update')
+            self._logger.info("Event updated: '{}'".format(updated_event.get('htmlLink')))
+            self._mirror.put(updated_event, calendarId)
+            return updated_event
         except errors.HttpError as e:
+            if is_retryable(e):
+                self._queue_failed_write('update', eventId, event, calendarId, e)
+                return
             self._logger.error("Exception while updating event: {}".format(str(e)))
             return
 
     # Delete a calendar event for a given calendar ID and event ID
     def delete_calendar_event(self, eventId, calendarId='primary'):
-        # Delete event
-        self._service.events().delete(calendarId=calendarId, eventId=eventId).execute()
+        # Delete event; other than running out of retries, failures are raised
+        try:
+            self._execute(self._service.events().delete(calendarId=calendarId, eventId=eventId), 'delete')
+        except errors.HttpError as e:
+            if not is_retryable(e):
+                raise
+            self._queue_failed_write('delete', eventId, None, calendarId, e)
+            return
+        self._mirror.remove(eventId, calendarId)
         self._logger.info("Event deleted: '{}'".format(eventId))
 
     # Get a calendar event for a given calendar ID and event ID
     def get_calendar_event(self, eventId, calendarId='primary'):
-        # Get event
-        event = self._service.events().get(calendarId='primary', eventId=eventId).execute()
-        self._logger.info("Got event: {}".format(event['summary']))
+        # Answer from the mirror; only events created elsewhere since the last sync need the API
+        event = self.get_mirror(calendarId).get(eventId, calendarId)
+        if event is None:
+            event = self._execute(self._service.events().get(calendarId=calendarId, eventId=eventId), 'get')
+            self._mirror.put(event, calendarId)
+        self._logger.info("Got event: {}".format(event.get('summary')))
         return event
 
     # A helper method to check if an event ID exists for a given calendar ID
     def is_existing_event_id(self, eventId, calendarId='primary'):
-        try:
-            event = self._service.events().get(calendarId=calendarId, eventId=eventId).execute()
-            self._logger.debug("Got event summary: {}".format(event['summary']))
-            return True
-        except errors.HttpError as he:
-            if "Not Found" in str(he):
-                return False
-            else: # raise he as it may have a different cause
-                raise he
- 
-    # Create a new maintenance event for a given start time, end time, summary, description, location, and calendar ID
-    def create_maintenance_event(self, newEventId, start_time, end_time, event_summary, event_description, event_location, calendarId='primary'):
+        return self.get_mirror(calendarId).get(eventId, calendarId) is not None
 
-        # Check eventId existence
-        if self.is_existing_event_id(newEventId, calendarId):
+    # Create a new maintenance event for a given start time, end time, summary, description, location, and calendar ID
+    def create_maintenance_event(self, newEventId, start_time, end_time, event_summary, event_description, event_location, calendarId='primary', event_cids=None):
+        # Check eventId existence in the local mirror
+        event = self.get_mirror(calendarId).get(newEventId, calendarId)
+        if event is not None:
             self._logger.info("Event with ID {} exists.".format(newEventId))
-            return self.get_calendar_event(eventId=newEventId, calendarId=calendarId)
+            return event
 
+        # Insert straight away; a 409 means the event was created since the last mirror sync
+        newEventBody = self.build_maintenance_event_body(newEventId, start_time, end_time, event_summary, event_description, event_location, event_cids=event_cids)
+        try:
+            event = self._execute(self._service.events().insert(calendarId=calendarId, body=newEventBody), 'insert')
+            self._logger.info("Event created: '{}'".format(event.get('htmlLink')))
+            self._mirror.put(event, calendarId)
+            return event
+        except errors.HttpError as e:
+            if is_retryable(e):
+                self._queue_failed_write('insert', newEventId, newEventBody, calendarId, e)
+                return
+            if e.resp.status != 409:
+                self._logger.error("Exception while creating event: {}".format(str(e)))
+                return
+        self._logger.info("Event with ID {} exists.".format(newEventId))
+        return self.get_calendar_event(eventId=newEventId, calendarId=calendarId)
+
+    # Build the event resource for a maintenance event
+    @staticmethod
+    def build_maintenance_event_body(newEventId, start_time, end_time, event_summary, event_description, event_location, event_cids=None):
         # cf. https://developers.google.com/google-apps/calendar/v3/reference/events
         newEventBody = {
             'id'            : newEventId,
@@ -200,42 +316,192 @@ class GoogleCalendar(object):
                 'useDefault': True
             },
         }
-
-        # Call generic helper
-        return self.create_calendar_event(newEventBody, calendarId=calendarId)
-
-    # A naive helper to check for overlapping events
-    def naive_find_event_overlap(self, calendarId='primary', singleEvents=True):
+        # Record the affected CIDs so overlaps can be looked up by circuit
+        if event_cids:
+            newEventBody['extendedProperties'] = {'private': {'cids': ",".join(event_cids)}}
+        return newEventBody
+
+    # Create a batch that groups event inserts, updates and deletes into Calendar API batch requests
+    def batch(self, calendarId='primary', batch_size=MAX_BATCH_SIZE, queue_failures=True):
+        return CalendarEventBatch(self, calendarId=calendarId, batch_size=batch_size, queue_failures=queue_failures)
+
+    # Send the writes queued by earlier runs again and return their results; those still failing stay queued
+    def replay_failed_writes(self, calendarId='primary', batch_size=MAX_BATCH_SIZE):
+        entries = self.retry_queue.entries(calendarId)
+        if not entries:
+            return []
+        self._logger.info("Replaying {} queued event writes".format(len(entries)))
+        with self.batch(calendarId=calendarId, batch_size=batch_size, queue_failures=False) as batch:
+            for entry in entries:
+                if entry["action"] == 'insert':
+                    batch.insert(entry["event"])
+                elif entry["action"] == 'update':
+                    batch.update(entry["eventId"], entry["event"])
+                else:
+                    batch.delete(entry["eventId"])
+        self.retry_queue.remove([entry for entry, result in zip(entries, batch.results) if not (result.error and is_retryable(result.error))])
+        METRICS.increment("calendar_writes_replayed_total", len(entries))
+        return batch.results
+
+    # Get an interval index over the (mirrored) events of a calendar, rebuilt when the mirror changes
+    def get_overlap_index(self, calendarId='primary'):
+        mirror = self.get_mirror(calendarId)
+        version, index = self._overlap_indexes.get(calendarId, (None, None))
+        if version != mirror.version:
+            index = OverlapIndex(mirror.events(calendarId))
+            self._overlap_indexes[calendarId] = (mirror.version, index)
+        return index
+
+    # Find the events overlapping a time window, optionally restricted to events for some CIDs
+    def find_conflicting_events(self, start_time, end_time, cids=None, calendarId='primary'):
+        return self.get_overlap_index(calendarId).overlapping(start_time, end_time, cids=cids)
+
+    # Log each group of overlapping events once
+    def find_event_overlaps(self, calendarId='primary'):
 
         # Be verbose
-        self._logger.info("Getting the upcoming events")
-
-        # list events
-        eventsResult = self._service.events().list(
-                calendarId=calendarId, singleEvents=singleEvents
-        ).execute()
-
-        events = eventsResult.get('items', [])
-
-        if not events:
-            self._logger.info("No upcoming events found.")
-
-        ## Check for overlapping events, naively
-        # Iterate all n events
-        for i_event1 in events:
-            # Iterate all n events again
-            for i_event2 in events:
-                # For the n(n-1) events
-                if i_event1['id'] != i_event2['id']:
-                    
-                    start1_dt = dateutil.parser.parse(i_event1['start'].get('dateTime'))
-                    start2_dt = dateutil.parser.parse(i_event2['start'].get('dateTime'))
-                    end1_dt   = dateutil.parser.parse(i_event1['end'].get('dateTime'))
-                    end2_dt   = dateutil.parser.parse(i_event2['end'].get('dateTime'))
-
-                    if ((start1_dt == start2_dt) or ((start1_dt > start2_dt and start1_dt <= end2_dt) or (start1_dt <= start2_dt and start2_dt <= end1_dt))):
-                        self._logger.info("overlap1 date: {} - {}; event (ID: {}): '{}'".format(start1_dt, end1_dt, i_event1['id'], i_event1['summary']))
-                        self._logger.info("overlap2 date: {} - {}; event (ID: {}): '{}'".format(start2_dt, end2_dt, i_event2['id'], i_event2['summary']))
+        self._logger.info("Checking events for overlaps")
+
+        index = self.get_overlap_index(calendarId)
+        if not len(index):
+            self._logger.info("No events found.")
+
+        groups = index.find_overlap_groups()
+        for group in groups:
+            self._logger.info("{} overlapping events:".format(len(group)))
+            for interval in group:
+                self._logger.info("overlap date: {} - {}; event (ID: {}): '{}'".format(interval.start, interval.end, interval.event_id, interval.summary))
+        return groups
+
+
+class CalendarEventBatch(object):
+    """Queues event inserts, updates and deletes and sends them in batch requests of up to ``batch_size`` calls.
+
+    Inserts of events already in the local mirror are skipped, and inserts aren't otherwise
+    pre-checked: a 409 response means the event ID is already taken and is reported as "exists".
+    Likewise a 404 or 410 response to a delete means the event is already gone and is reported as
+    "missing". Calls that fail with a retryable error (throttling, 5xx) are sent again in a new
+    batch request after the scheduler's backoff; those still failing after its retries are queued
+    for the next run (reported as "queued") unless ``queue_failures`` is False. Use as a context
+    manager to flush on exit.
+    """
+
+    def __init__(self, google_calendar, calendarId='primary', batch_size=MAX_BATCH_SIZE, queue_failures=True):
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError("batch_size must be between 1 and {}, got {}".format(MAX_BATCH_SIZE, batch_size))
+        self._google_calendar = google_calendar
+        self._calendarId = calendarId
+        self._batch_size = batch_size
+        self._queue_failures = queue_failures
+        self._pending = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    # Queue an event insert; returns the results of any batch this sends
+    def insert(self, event):
+        return self._add('insert', event['id'], event)
+
+    # Queue an event update; returns the results of any batch this sends
+    def update(self, eventId, event):
+        return self._add('update', eventId, event)
+
+    # Queue an event delete; returns the results of any batch this sends
+    def delete(self, eventId):
+        return self._add('delete', eventId, None)
+
+    def _add(self, action, eventId, event):
+        self._pending.append((action, eventId, event))
+        if len(self._pending) >= self._batch_size:
+            return self.flush()
+        return []
+
+    # Send all queued writes and return their results in the order they were queued
+    def flush(self):
+        if not self._pending:
+            return []
+        pending, self._pending = self._pending, []
+        scheduler = self._google_calendar.scheduler
+        mirror = self._google_calendar.get_mirror(self._calendarId)
+        # Inserts of events already in the mirror need no request
+        to_send = [request_id for request_id, (action, eventId, _) in enumerate(pending)
+                   if action != 'insert' or mirror.get(eventId, self._calendarId) is None]
+        responses = {}
+        requests = 0
+        attempt = 0
+        while to_send:
+            responses.update(self._send(pending, to_send))
+            requests += len(to_send)
+            to_send = [request_id for request_id in to_send if is_retryable(responses[str(request_id)][1] or Exception())]
+            if not to_send or attempt >= scheduler.max_retries:
+                break
+            # Calls in a batch are throttled one by one, while the batch request itself succeeds
+            if any(is_throttled(responses[str(request_id)][1]) for request_id in to_send):
+                scheduler.limiter.throttled()
+            METRICS.increment("calendar_api_retries_total", len(to_send), method='batch')
+            scheduler.backoff(attempt)
+            attempt += 1
+
+        results = []
+        for request_id, (action, eventId, event) in enumerate(pending):
+            if str(request_id) not in responses:
+                results.append(EventWriteResult(eventId, action, 'exists', mirror.get(eventId, self._calendarId), None))
+                continue
+            response, exception = responses[str(request_id)]
+            if exception is None and action == 'delete':
+                mirror.remove(eventId, self._calendarId)
+                results.append(EventWriteResult(eventId, action, 'deleted', None, None))
+            elif exception is None:
+                mirror.put(response, self._calendarId)
+                results.append(EventWriteResult(eventId, action, 'created' if action == 'insert' else 'updated', response, None))
+            elif action == 'insert' and isinstance(exception, errors.HttpError) and exception.resp.status == 409:
+                results.append(EventWriteResult(eventId, action, 'exists', None, None))
+            elif action == 'delete' and isinstance(exception, errors.HttpError) and exception.resp.status in (404, 410):
+                mirror.remove(eventId, self._calendarId)
+                results.append(EventWriteResult(eventId, action, 'missing', None, None))
+            elif self._queue_failures and is_retryable(exception):
+                self._google_calendar._queue_failed_write(action, eventId, event, self._calendarId, exception)
+                results.append(EventWriteResult(eventId, action, 'queued', None, exception))
+            else:
+                self._google_calendar._logger.error("Exception during batch {} of event {}: {}".format(action, eventId, str(exception)))
+                results.append(EventWriteResult(eventId, action, 'failed', None, exception))
+        self._google_calendar._logger.info("Batch of {} event writes sent".format(requests))
+        for result in results:
+            METRICS.increment("calendar_batch_writes_total", action=result.action, status=result.status)
+        self.results.extend(results)
+        return results
+
+    # Send some of the pending writes in one batch request and return {request_id: (response, exception)}
+    def _send(self, pending, request_ids):
+        service = self._google_calendar._service
+        responses = {}
+
+        def callback(request_id, response, exception):
+            responses[request_id] = (response, exception)
+
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id in request_ids:
+            action, eventId, event = pending[request_id]
+            if action == 'insert':
+                request = service.events().insert(calendarId=self._calendarId, body=event)
+            elif action == 'delete':
+                request = service.events().delete(calendarId=self._calendarId, eventId=eventId)
+            else:
+                request = service.events().update(calendarId=self._calendarId, eventId=eventId, body=event)
+            batch.add(request, request_id=str(request_id))
+        self._google_calendar._execute(batch, 'batch', cost=len(request_ids))
+        return responses
+
 
 if __name__ == '__main__':
-    bla = GoogleCalendar()
+    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+    # Prevent a browser from opening
+    flags.noauth_local_webserver = True
+    bla = GoogleCalendar(flags=flags)
+    bla.create_logger(logging_filename=LOGGING_FILE)
+    bla.find_event_overlaps()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+import re
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta, timezone
+
+import dateutil.tz
+from icalendar import Calendar
+
+from manage_maintenance.metrics import METRICS
+
+
+LOG = logging.getLogger(__name__)
+
+
+# start_time and end_time are aware datetimes in the zone the calendar gives them in (UTC for "Z" times),
+# or naive for floating times and all-day dates; status is the VEVENT's STATUS (e.g. "CANCELLED"), if any.
+# Times keep their zone, as icalendar gives them, because event UUIDs hash their isoformat()
+ICSEvent = namedtuple("ICSEvent", ("uid", "start_time", "end_time", "sequence", "status"))
+
+_FOLDED_LINE_BREAK = re.compile(r"\r?\n[ \t]")
+
+_DURATION = re.compile(r"^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+_EVENT_PROPERTIES = {"UID", "DTSTART", "DTEND", "DURATION", "SEQUENCE", "STATUS"}
+
+
+class ICSParseError(ValueError):
+    pass
+
+
+def parse_content_line(line):
+    """Split an unfolded content line into its upper-cased name, {parameter: value} and value."""
+    head, separator, value = line.partition(":")
+    if '"' in head:
+        # A quoted parameter value may contain the colon, so find the first one outside quotes
+        quoted = False
+        for position, character in enumerate(line):
+            if character == '"':
+                quoted = not quoted
+            elif character == ":" and not quoted:
+                head, separator, value = line[:position], ":", line[position + 1:]
+                break
+        else:
+            separator = ""
+    if not separator:
+        raise ICSParseError("Malformed content line: {!r}".format(line))
+    name, _, parameter_text = head.partition(";")
+    parameters = {}
+    if parameter_text:
+        for parameter in parameter_text.split(";"):
+            parameter_name, _, parameter_value = parameter.partition("=")
+            parameters[parameter_name.upper()] = parameter_value.strip('"')
+    return name.upper(), parameters, value
+
+
+def parse_date_time(value, parameters):
+    """Convert a DATE or DATE-TIME value to a datetime, aware in its TZID's zone when it has one."""
+    value = value.strip()
+    try:
+        if parameters.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+            return datetime.strptime(value, "%Y%m%d")
+        if value.endswith("Z"):
+            return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        local_time = datetime.strptime(value, "%Y%m%dT%H%M%S")
+    except ValueError:
+        raise ICSParseError("Malformed date-time: {!r}".format(value))
+    tzid = parameters.get("TZID")
+    if not tzid:
+        return local_time   # Floating time
+    tz = dateutil.tz.gettz(tzid)
+    if tz is None:
+        raise ICSParseError("Unknown TZID: {!r}".format(tzid))
+    return local_time.replace(tzinfo=tz)
+
+
+def parse_duration(value):
+    match = _DURATION.match(value.strip())
+    if not match or value.strip() in ("P", "PT"):
+        raise ICSParseError("Malformed duration: {!r}".format(value))
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == "-" else duration
+
+
+def _event_from_properties(properties):
+    if "DTSTART" not in properties:
+        return None
+    start_time = parse_date_time(*properties["DTSTART"])
+    if "DTEND" in properties:
+        end_time = parse_date_time(*properties["DTEND"])
+    elif "DURATION" in properties:
+        end_time = start_time + parse_duration(properties["DURATION"][0])
+    else:
+        return None
+    sequence = properties.get("SEQUENCE", ("0",))[0].strip()
+    if not sequence.isdigit():
+        raise ICSParseError("Malformed SEQUENCE: {!r}".format(sequence))
+    uid = properties["UID"][0].strip() if "UID" in properties else None
+    status = properties["STATUS"][0].strip().upper() if "STATUS" in properties else None
+    return ICSEvent(uid=uid or None, start_time=start_time, end_time=end_time, sequence=int(sequence), status=status)
+
+
+def scan_events(text):
+    """Return the ICSEvents of every VEVENT with a start and an end in ``text``, reading it line by line.
+
+    Only the few properties a maintenance window needs are parsed; other components (VTIMEZONE,
+    VALARM, ...) are skipped. Raises ICSParseError on input it can't read.
+    """
+    events = []
+    components = []
+    properties = None
+    for line in _FOLDED_LINE_BREAK.sub("", text).splitlines():
+        if not line:
+            continue
+        upper_line = line[:6].upper()
+        if upper_line.startswith("BEGIN:"):
+            component = line[6:].strip().upper()
+            components.append(component)
+            if component == "VEVENT":
+                properties = {}
+        elif upper_line.startswith("END:"):
+            component = line[4:].strip().upper()
+            if not components or components[-1] != component:
+                raise ICSParseError("Unbalanced END:{}".format(component))
+            components.pop()
+            if component == "VEVENT":
+                event = _event_from_properties(properties)
+                if event:
+                    events.append(event)
+                properties = None
+        elif components and components[-1] == "VEVENT":
+            name, parameters, value = parse_content_line(line)
+            if name in _EVENT_PROPERTIES:
+                properties[name] = (value, parameters)
+    if components:
+        raise ICSParseError("Unterminated BEGIN:{}".format(components[-1]))
+    return events
+
+
+def _to_datetime(value):
+    # icalendar gives dates for all-day values and datetimes in their own zone otherwise
+    if not isinstance(value, datetime) and isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return value
+
+
+def parse_events(text):
+    """Like scan_events, but with the full icalendar object model; slower, but it reads VTIMEZONE definitions."""
+    events = []
+    for vevent in Calendar.from_ical(text).walk("VEVENT"):
+        if "DTSTART" not in vevent or not ("DTEND" in vevent or "DURATION" in vevent):
+            continue
+        start_time = _to_datetime(vevent["DTSTART"].dt)
+        end_time = _to_datetime(vevent["DTEND"].dt) if "DTEND" in vevent else start_time + vevent["DURATION"].dt
+        status = str(vevent["STATUS"]).upper() if "STATUS" in vevent else None
+        events.append(ICSEvent(uid=str(vevent["UID"]) if "UID" in vevent else None, start_time=start_time, end_time=end_time,
+                               sequence=int(vevent.get("SEQUENCE", 0)), status=status))
+    return events
+
+
+def extract_events(text):
+    """Return the maintenance windows of an ICS calendar, the latest SEQUENCE of each UID, in calendar order.
+
+    The line scanner handles nearly every notice; calendars it can't read (custom VTIMEZONEs,
+    malformed lines) go through icalendar instead, and an empty list is returned if that fails too.
+    """
+    try:
+        events = scan_events(text)
+    except ICSParseError as e:
+        METRICS.increment("ics_parse_fallbacks_total")
+        LOG.debug("Falling back to icalendar: %s", e)
+        try:
+            events = parse_events(text)
+        except Exception as e:  # icalendar raises a variety of exceptions on malformed input
+            LOG.warning("Couldn't parse calendar: %s", e)
+            return []
+    latest = OrderedDict()
+    for index, event in enumerate(events):
+        key = event.uid or index
+        if key not in latest or event.sequence >= latest[key].sequence:
+            latest[key] = event
+    return list(latest.values())
@@ -2,46 +2,340 @@
 # Copyright 2017 Netflix
 import email
 import imaplib
+import re
+import select
+import socket
+import ssl
+import time
 from datetime import datetime
 
+from manage_maintenance.metrics import METRICS
+
+
+# Number of messages requested per pipelined FETCH command
+DEFAULT_FETCH_CHUNK_SIZE = 500
+
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes
+DEFAULT_IDLE_TIMEOUT = 29 * 60
+
+# How often to NOOP-poll the folder when the server doesn't support IDLE
+DEFAULT_POLL_INTERVAL = 60
+
+# Errors that mean the IMAP session is gone and needs to be re-established
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, imaplib.IMAP4.error, socket.error, EOFError)
+
 
 class IMAP(object):
     """IMAP Server Wrapper Class."""
 
-    def __init__(self, username, password, address):
+    def __init__(self, username, password, address, port=None, use_ssl=True):
         self._username = username
         self._password = password
         self._address = address
+        self._port = port
+        self._use_ssl = use_ssl
         self._imap = None
+        self._selected_folder = None
+        self.uidvalidity = None
 
     def connect(self):
-        self._imap = imaplib.IMAP4_SSL(self._address)
+        if self._use_ssl:
+            self._imap = imaplib.IMAP4_SSL(self._address, self._port or imaplib.IMAP4_SSL_PORT)
+        else:
+            self._imap = imaplib.IMAP4(self._address, self._port or imaplib.IMAP4_PORT)
+        self._selected_folder = None
         return_code, data = self._imap.login(self._username, self._password)
         if return_code != "OK":
             raise Exception("Error logging in to IMAP as {}: {} {}".format(self._username, return_code, data))
 
-    def list_message_ids_in_folder(self, folder_name, since=None):
-        # Select the folder
+    def logout(self):
+        if not self._imap:
+            return
+        try:
+            self._imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass    # The connection is being thrown away either way
+        self._imap = None
+        self._selected_folder = None
+
+    @property
+    def connected(self):
+        return self._imap is not None
+
+    @property
+    def selected_folder(self):
+        return self._selected_folder
+
+    def noop(self):
+        """Check the session is still alive; raises one of CONNECTION_ERRORS if it isn't."""
+        return_code, data = self._imap.noop()
+        if return_code != "OK":
+            raise imaplib.IMAP4.error("NOOP failed: {} {}".format(return_code, data))
+
+    def wait_for_changes(self, folder_name, timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL):
+        """Block until the server reports new mail in a folder or the timeout passes.
+
+        Uses IDLE when the server advertises it and falls back to NOOP polling otherwise.
+        Returns True if the server reported new messages.
+        """
+        if self._selected_folder != folder_name:
+            self.select_folder(folder_name)
+        if "IDLE" in self._imap.capabilities:
+            return self._idle(timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            return_code, data = self._imap.noop()
+            if return_code != "OK":
+                raise Exception("Error polling folder named '{}' via IMAP: {} {}".format(folder_name, return_code, data))
+            _, exists = self._imap.response("EXISTS")
+            if exists and exists[0]:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(poll_interval, remaining))
+
+    def _idle(self, timeout):
+        # New mail the server reported during an earlier command is stashed by imaplib, not sent again
+        _, exists = self._imap.response("EXISTS")
+        if exists and exists[0]:
+            return True
+
+        # imaplib has no IDLE support so speak the protocol directly (RFC 2177)
+        tag = self._imap._new_tag()
+        self._imap.send(tag + b" IDLE\r\n")
+        response = self._imap.readline()
+        if not response.startswith(b"+"):
+            raise imaplib.IMAP4.error("IDLE rejected by server: {}".format(response))
+
+        changed = False
+        deadline = time.monotonic() + timeout
+        try:
+            while not changed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not self._has_buffered_data():
+                    readable, _, _ = select.select([self._imap.sock], [], [], remaining)
+                    if not readable:
+                        break
+                line = self._imap.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed during IDLE")
+                changed = _reports_new_mail(line)
+        finally:
+            self._imap.send(b"DONE\r\n")
+            # Mail arriving as IDLE ends is reported before the tagged response
+            while True:
+                line = self._imap.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed while ending IDLE")
+                if line.startswith(tag):
+                    break
+                changed = changed or _reports_new_mail(line)
+        return changed
+
+    def _has_buffered_data(self):
+        """Return True if a response line can be read without waiting, including lines imaplib or the SSL layer buffered out of select()'s sight."""
+        sock = self._imap.sock
+        sock_timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(self._imap.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(sock_timeout)
+
+    def select_folder(self, folder_name):
+        """Select a folder and return its UIDVALIDITY (or None if the server didn't report one)."""
         return_code, data = self._imap.select(folder_name)
         if return_code != "OK":
             raise Exception("Error selecting folder named '{}' via IMAP: {} {}".format(folder_name, return_code, data))
+        self._selected_folder = folder_name
+        self.uidvalidity = None
+        _, uidvalidity = self._imap.response("UIDVALIDITY")
+        if uidvalidity and uidvalidity[0]:
+            self.uidvalidity = _to_int(uidvalidity[0])
+        # The message count SELECT reports isn't new mail, so don't let wait_for_changes see it
+        self._imap.response("EXISTS")
+        return self.uidvalidity
+
+    def list_message_ids_in_folder(self, folder_name, since=None, search_criteria=None, min_uid=None):
+        """Return the UIDs of messages in a folder matching the search criteria.
+
+        ``min_uid`` restricts the search to ``UID min_uid:*`` for incremental syncs.
+        """
+        if self._selected_folder != folder_name:
+            self.select_folder(folder_name)
 
         # Build search query
-        query = "SUBJECT \"NTT Communications\""
+        query = []
+        if min_uid:
+            query.append("UID {}:*".format(min_uid))
         if since:
-            query += " SENTSINCE {}".format(since)
+            query.append("SENTSINCE {}".format(since))
+        if search_criteria:
+            query.append(search_criteria)
 
-        # Get a list of message IDs in the folder
-        return_code, data = self._imap.search(None, query)
+        # Get a list of message UIDs in the folder
+        with METRICS.timer("imap_search_seconds"):
+            return_code, data = self._imap.uid("SEARCH", " ".join(query) or "ALL")
         if return_code != "OK":
             raise Exception("No messages found in folder named '{}' via IMAP: {} {}".format(folder_name, return_code, data))
 
-        mail_message_id_list = data[0].split(b" ")
+        mail_message_id_list = data[0].split()
+        if min_uid:
+            # "N:*" always matches the highest UID, even when it's below N
+            mail_message_id_list = [message_id for message_id in mail_message_id_list if _to_int(message_id) >= min_uid]
         return mail_message_id_list
 
     def get_message_by_id_from_folder(self, folder_name, email_id):
-        return_code, data = self._imap.fetch(email_id, '(RFC822)')
-        if return_code != "OK":
+        return_code, data = self._imap.uid("FETCH", email_id, "(RFC822)")
+        if return_code != "OK" or not data or data[0] is None:
             raise Exception("No message with ID {} found in folder named '{}' via IMAP: {} {}".format(email_id, folder_name, return_code, data))
         email_obj = email.message_from_bytes(data[0][1])
         return email_obj
+
+    def fetch_messages_from_folder(self, folder_name, email_ids, chunk_size=DEFAULT_FETCH_CHUNK_SIZE):
+        """Fetch many messages with one UID FETCH per chunk and yield them in order.
+
+        Message UIDs are sent as IMAP message sets (e.g. ``1:500`` or ``3,7,9:12``) and
+        bodies are requested with ``BODY.PEEK[]`` so the Seen flag is left untouched.
+        """
+        for raw_message in self.fetch_raw_messages_from_folder(folder_name, email_ids, chunk_size=chunk_size):
+            yield email.message_from_bytes(raw_message)
+
+    def fetch_raw_messages_from_folder(self, folder_name, email_ids, chunk_size=DEFAULT_FETCH_CHUNK_SIZE):
+        """Like fetch_messages_from_folder, but yield the raw RFC822 bytes."""
+        for _, raw_message in self.fetch_uid_raw_messages_from_folder(folder_name, email_ids, chunk_size=chunk_size):
+            yield raw_message
+
+    def fetch_uid_raw_messages_from_folder(self, folder_name, email_ids, chunk_size=DEFAULT_FETCH_CHUNK_SIZE):
+        """Yield (uid, raw RFC822 bytes) for many messages, in the order the server returns them."""
+        for uid, raw_message in self._fetch_literals(folder_name, email_ids, "BODY.PEEK[]", chunk_size):
+            METRICS.increment("imap_fetched_messages_total")
+            METRICS.increment("imap_fetched_bytes_total", len(raw_message))
+            yield uid, raw_message
+
+    def fetch_header_fields_from_folder(self, folder_name, email_ids, fields, chunk_size=DEFAULT_FETCH_CHUNK_SIZE):
+        """Yield (uid, header bytes) with only the named header fields of many messages, without their bodies."""
+        item = "BODY.PEEK[HEADER.FIELDS ({})]".format(" ".join(field.upper() for field in fields))
+        for uid, header in self._fetch_literals(folder_name, email_ids, item, chunk_size):
+            METRICS.increment("imap_fetched_header_bytes_total", len(header))
+            yield uid, header
+
+    def _fetch_literals(self, folder_name, email_ids, item, chunk_size):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1, got {}".format(chunk_size))
+        email_ids = list(email_ids)
+        for offset in range(0, len(email_ids), chunk_size):
+            message_set = build_message_set(email_ids[offset:offset + chunk_size])
+            with METRICS.timer("imap_fetch_seconds"):
+                return_code, data = self._imap.uid("FETCH", message_set, "({})".format(item))
+            if return_code != "OK":
+                raise Exception("Error fetching messages {} from folder named '{}' via IMAP: {} {}".format(message_set, folder_name, return_code, data))
+            for uid, literal in iter_fetch_uid_literals(data):
+                yield uid, literal
+
+
+def _reports_new_mail(line):
+    return line.rstrip().endswith((b"EXISTS", b"RECENT"))
+
+
+def _to_int(message_id):
+    if isinstance(message_id, bytes):
+        message_id = message_id.decode("ascii")
+    return int(message_id)
+
+
+def build_message_set(message_ids):
+    """Collapse message IDs into an IMAP message set string, e.g. ``1:3,7,9:10``."""
+    ranges = []
+    for message_id in sorted(set(_to_int(message_id) for message_id in message_ids)):
+        if ranges and ranges[-1][1] + 1 == message_id:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+    return ",".join(str(start) if start == end else "{}:{}".format(start, end) for start, end in ranges)
+
+
+FETCH_UID = re.compile(rb"\bUID (\d+)")
+
+
+def iter_fetch_uid_literals(data):
+    """Yield (uid, literal payload) pairs from an imaplib UID FETCH response."""
+    for item in data:
+        # imaplib returns (b'1 (UID 7 BODY[] {1234}', b'<literal>') tuples followed by b')' terminators
+        if isinstance(item, tuple) and len(item) == 2:
+            match = FETCH_UID.search(item[0])
+            yield (match.group(1) if match else None), item[1]
+
+
+def _quote(value):
+    return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def literal_from_pattern(pattern):
+    """Return the literal text a regex pattern matches, or None if it isn't a plain literal.
+
+    IMAP SEARCH only does substring matching, so only patterns like ``no-reply@level3\\.com``
+    can be pushed to the server.
+    """
+    literal = []
+    characters = iter(pattern)
+    for character in characters:
+        if character == "\\":
+            escaped = next(characters, "")
+            if not escaped or escaped.isalnum():
+                return None     # Character classes like \\d or \\w
+            literal.append(escaped)
+        elif character in ".^$*+?{}[]|()":
+            return None
+        else:
+            literal.append(character)
+    return "".join(literal) or None
+
+
+def split_address_anchor(pattern):
+    """Split a sender pattern into the pattern before its end-of-address anchor and whether it had one.
+
+    ``$``, ``>`` and ``>?$`` pin a pattern to the end of a bare address or of a ``Name <address>`` header.
+    """
+    for anchor in (">?$", ">$", "$", ">"):
+        if pattern.endswith(anchor) and not pattern[:-len(anchor)].endswith("\\"):
+            return pattern[:-len(anchor)], True
+    return pattern, False
+
+
+def build_search_criteria(notification_patterns):
+    """Build an IMAP SEARCH criteria string matching any of the notification patterns.
+
+    Each pattern contributes ``FROM``/``SUBJECT`` terms for its sender and subject patterns and the
+    patterns are OR'd together. Returns None when a pattern can't be expressed as an IMAP search,
+    in which case the server can't filter safely and every message has to be considered.
+    """
+    terms = []
+    for notification_config in notification_patterns:
+        pattern_terms = []
+        for key, search_key in (("email_domain_pattern", "FROM"), ("email_subject_pattern", "SUBJECT")):
+            if not notification_config.get(key, None):
+                continue
+            pattern = notification_config[key]
+            if search_key == "FROM":
+                # Substring search can't anchor, but without the anchor it still finds every match
+                pattern = split_address_anchor(pattern)[0]
+            literal = literal_from_pattern(pattern)
+            if literal:
+                pattern_terms.append("{} {}".format(search_key, _quote(literal)))
+        if not pattern_terms:
+            return None
+        terms.append("({})".format(" ".join(pattern_terms)) if len(pattern_terms) > 1 else pattern_terms[0])
+    if not terms:
+        return None
+
+    # IMAP's OR is binary, so nest it: OR a OR b c
+    criteria = terms[-1]
+    for term in reversed(terms[:-1]):
+        criteria = "OR {} {}".format(term, criteria)
+    return criteria
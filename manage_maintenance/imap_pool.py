@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import yaml
+
+from manage_maintenance.imap import CONNECTION_ERRORS, IMAP
+from manage_maintenance.metrics import METRICS
+
+
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_CONNECTIONS = 4
+
+# Idle connections older than this are NOOP-checked before being handed out again
+DEFAULT_HEALTH_CHECK_INTERVAL = 60
+
+MailboxSource = namedtuple("MailboxSource", ("username", "password", "address", "folder", "port", "use_ssl"))
+MailboxSource.__new__.__defaults__ = (None, True)
+
+
+def mailbox_account(source):
+    """The part of a MailboxSource a connection is logged in to; connections are shared between folders of one account."""
+    return source.username, source.address, source.port, source.use_ssl
+
+
+def load_mailbox_sources(file_path):
+    """Load MailboxSources from a YAML list of accounts, each with ``username``, ``password``, ``address`` and ``folders``.
+
+    ``port`` and ``use_ssl`` are optional, as in IMAP.
+    """
+    with open(file_path) as f:
+        accounts = yaml.safe_load(f) or []
+    return [MailboxSource(username=account["username"], password=account["password"], address=account["address"], folder=folder,
+                          port=account.get("port", None), use_ssl=account.get("use_ssl", True))
+            for account in accounts for folder in account["folders"]]
+
+
+class IMAPConnectionPool(object):
+    """A bounded pool of logged-in IMAP connections shared by the accounts of several MailboxSources.
+
+    At most ``max_connections`` connections are open at once, across all accounts. Idle connections
+    are reused for any folder of their account; when the pool is full and a different account needs
+    one, an idle connection of another account is logged out to make room. Connections that sat
+    idle for ``health_check_interval`` seconds are NOOP-checked before reuse and re-established if
+    the server dropped them, and a connection whose user fails with one of CONNECTION_ERRORS is
+    thrown away rather than returned to the pool.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1, got {}".format(max_connections))
+        self.max_connections = max_connections
+        self._health_check_interval = health_check_interval
+        self._idle = {}     # account: [(IMAP, time it was released), ...]
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def connection(self, source, check_health=False):
+        """Lend a connection with ``source.folder`` selected, blocking while every connection is in use.
+
+        ``check_health`` NOOP-checks a reused connection however recently it was used, e.g. when
+        retrying after a dropped session.
+        """
+        imap = self._acquire(source, check_health)
+        try:
+            if imap.selected_folder != source.folder:
+                imap.select_folder(source.folder)
+            yield imap
+        except BaseException:
+            # Whatever went wrong may have left the session mid-command
+            self._release(source, imap, broken=True)
+            raise
+        self._release(source, imap)
+
+    def _acquire(self, source, check_health):
+        account = mailbox_account(source)
+        evicted = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("IMAP connection pool is closed")
+                if self._idle.get(account):
+                    imap, released = self._idle[account].pop()
+                    break
+                if self._open < self.max_connections:
+                    self._open += 1
+                    imap, released = None, None
+                    break
+                evicted = self._pop_idle_of_other_account(account)
+                if evicted:
+                    imap, released = None, None
+                    break
+                self._condition.wait()
+        if evicted:
+            evicted.logout()
+
+        try:
+            if imap is None:
+                imap = self._connect(source)
+            elif check_health or time.monotonic() - released > self._health_check_interval:
+                imap = self._check_health(source, imap)
+        except BaseException:
+            self._forget_connection()
+            raise
+        return imap
+
+    def _pop_idle_of_other_account(self, account):
+        for other_account, idle in self._idle.items():
+            if other_account != account and idle:
+                return idle.pop(0)[0]
+        return None
+
+    @staticmethod
+    def _connect(source):
+        imap = IMAP(username=source.username, password=source.password, address=source.address, port=source.port, use_ssl=source.use_ssl)
+        imap.connect()
+        return imap
+
+    def _check_health(self, source, imap):
+        try:
+            imap.noop()
+            return imap
+        except CONNECTION_ERRORS as e:
+            LOG.warning("IMAP connection to %s@%s was dropped (%s), reconnecting", source.username, source.address, e)
+            METRICS.increment("imap_reconnects_total")
+            imap.logout()
+            return self._connect(source)
+
+    def _release(self, source, imap, broken=False):
+        if broken:
+            imap.logout()
+            self._forget_connection()
+            return
+        with self._condition:
+            if self._closed:
+                imap.logout()
+                self._open -= 1
+                return
+            self._idle.setdefault(mailbox_account(source), []).append((imap, time.monotonic()))
+            self._condition.notify()
+
+    def _forget_connection(self):
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def close(self):
+        """Log out of every idle connection; connections still lent out are logged out when returned."""
+        with self._condition:
+            self._closed = True
+            idle = [imap for connections in self._idle.values() for imap, _ in connections]
+            self._open -= len(idle)
+            self._idle = {}
+            self._condition.notify_all()
+        for imap in idle:
+            imap.logout()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import csv
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+
+from manage_maintenance.files import write_atomically
+
+
+LOG = logging.getLogger(__name__)
+
+
+CircuitEndpoint = namedtuple("CircuitEndpoint", ("hostname", "interface"))
+
+
+# Prebuilt index layout: header, then uint32 arrays, then the CID and name string blobs.
+# Arrays are written in native byte order, which the magic records.
+INDEX_MAGIC = b"MMCINV1" + (b"L" if sys.byteorder == "little" else b"B")
+INDEX_HEADER = struct.Struct("=8s6IQQ")
+
+CID_SEPARATORS = re.compile(r"[^0-9A-Z]")
+
+
+def normalize_cid(cid):
+    """Normalize a CID so carrier formatting differences don't matter, e.g. ``abc-1234 xyz`` -> ``ABC1234XYZ``."""
+    return CID_SEPARATORS.sub("", cid.upper())
+
+
+def _uint32_array(values=()):
+    return array("I", values)     # 4 bytes on every platform CPython supports
+
+
+def _source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class CircuitInventory(object):
+    """Array-backed CID -> (hostname, interface) index with O(1) lookups.
+
+    The index lives in one flat buffer (built in memory or memory-mapped from a prebuilt index
+    file), read through memoryviews, so loading a prebuilt index costs no parsing. CIDs are found
+    through an open-addressing hash table of uint32 slots.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        magic, n_cids, n_records, table_size, n_names, cid_blob_length, _, self.source_size, self.source_mtime_ns = INDEX_HEADER.unpack_from(buffer, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError("Not a circuit inventory index built on this platform: {!r}".format(magic))
+        view = memoryview(buffer)
+        offset = INDEX_HEADER.size
+
+        def section(length):
+            nonlocal offset
+            uint32_view = view[offset:offset + 4 * length].cast("I")
+            offset += 4 * length
+            return uint32_view
+
+        self._n_cids = n_cids
+        self._cid_offsets = section(n_cids + 1)
+        self._cid_record_starts = section(n_cids + 1)
+        self._table = section(table_size)
+        self._record_hostnames = section(n_records)
+        self._record_interfaces = section(n_records)
+        self._name_offsets = section(n_names + 1)
+        self._cid_blob = view[offset:offset + cid_blob_length]
+        self._names_blob = view[offset + cid_blob_length:]
+        self._table_mask = table_size - 1
+        self._names = {}
+
+    @classmethod
+    def build(cls, rows, source_stamp=(0, 0)):
+        """Build an inventory from (cid, hostname, interface) rows."""
+        return cls(cls._serialize(rows, source_stamp))
+
+    @classmethod
+    def build_from_csv(cls, csv_path):
+        """Build an inventory from a ``CircuitID, Hostname, InterfaceName`` CSV file."""
+        with open(csv_path, newline="") as f:
+            return cls.build(iter_csv_rows(f), source_stamp=_source_stamp(csv_path))
+
+    @classmethod
+    def load(cls, index_path):
+        """Memory-map a prebuilt index file."""
+        with open(index_path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def open(cls, csv_path, index_path):
+        """Load the prebuilt index for a CSV file, rebuilding it first if the CSV has changed."""
+        source_stamp = _source_stamp(csv_path)
+        if os.path.exists(index_path):
+            try:
+                inventory = cls.load(index_path)
+                if (inventory.source_size, inventory.source_mtime_ns) == source_stamp:
+                    return inventory
+            except (ValueError, struct.error):
+                LOG.warning("Ignoring unreadable circuit inventory index '%s'", index_path)
+        LOG.info("Building circuit inventory index for '%s'", csv_path)
+        cls.build_from_csv(csv_path).save(index_path)
+        return cls.load(index_path)
+
+    def save(self, index_path):
+        write_atomically(index_path, self._buffer)
+
+    @staticmethod
+    def _serialize(rows, source_stamp):
+        names = {}
+        endpoints_by_cid = {}
+        for cid, hostname, interface in rows:
+            endpoints = endpoints_by_cid.setdefault(normalize_cid(cid), [])
+            endpoints.append((names.setdefault(hostname, len(names)), names.setdefault(interface, len(names))))
+        endpoints_by_cid.pop("", None)
+
+        cids = sorted(endpoints_by_cid)
+        table_size = 8
+        while table_size < 2 * len(cids):
+            table_size *= 2
+        table = _uint32_array([0]) * table_size
+        cid_offsets = _uint32_array([0])
+        cid_record_starts = _uint32_array([0])
+        record_hostnames = _uint32_array()
+        record_interfaces = _uint32_array()
+        cid_blob = bytearray()
+        for index, cid in enumerate(cids):
+            key = cid.encode("utf-8")
+            cid_blob += key
+            cid_offsets.append(len(cid_blob))
+            for hostname_id, interface_id in endpoints_by_cid[cid]:
+                record_hostnames.append(hostname_id)
+                record_interfaces.append(interface_id)
+            cid_record_starts.append(len(record_hostnames))
+            slot = zlib.crc32(key) & (table_size - 1)
+            while table[slot]:
+                slot = (slot + 1) & (table_size - 1)
+            table[slot] = index + 1
+
+        name_offsets = _uint32_array([0])
+        names_blob = bytearray()
+        for name in names:     # Insertion order matches the assigned IDs
+            names_blob += name.encode("utf-8")
+            name_offsets.append(len(names_blob))
+
+        header = INDEX_HEADER.pack(INDEX_MAGIC, len(cids), len(record_hostnames), table_size, len(names), len(cid_blob), 0, source_stamp[0], source_stamp[1])
+        return b"".join([header, cid_offsets.tobytes(), cid_record_starts.tobytes(), table.tobytes(), record_hostnames.tobytes(),
+                         record_interfaces.tobytes(), name_offsets.tobytes(), bytes(cid_blob), bytes(names_blob)])
+
+    def __len__(self):
+        return self._n_cids
+
+    def __contains__(self, cid):
+        return self._find(normalize_cid(cid)) >= 0
+
+    def _find(self, cid):
+        key = cid.encode("utf-8")
+        slot = zlib.crc32(key) & self._table_mask
+        while True:
+            entry = self._table[slot]
+            if not entry:
+                return -1
+            index = entry - 1
+            if self._cid_blob[self._cid_offsets[index]:self._cid_offsets[index + 1]] == key:
+                return index
+            slot = (slot + 1) & self._table_mask
+
+    def _name(self, name_id):
+        name = self._names.get(name_id)
+        if name is None:
+            name = self._names[name_id] = bytes(self._names_blob[self._name_offsets[name_id]:self._name_offsets[name_id + 1]]).decode("utf-8")
+        return name
+
+    def lookup(self, cid):
+        """Return the CircuitEndpoints a CID is connected to, or an empty tuple if it's unknown."""
+        index = self._find(normalize_cid(cid))
+        if index < 0:
+            return ()
+        return tuple(CircuitEndpoint(self._name(self._record_hostnames[record]), self._name(self._record_interfaces[record]))
+                     for record in range(self._cid_record_starts[index], self._cid_record_starts[index + 1]))
+
+
+def iter_csv_rows(f):
+    """Yield (cid, hostname, interface) rows, skipping comments, blank lines and a header row."""
+    for row in csv.reader(f, skipinitialspace=True):
+        if not row or row[0].startswith("#") or len(row) < 3:
+            continue
+        cid, hostname, interface = (value.strip() for value in row[:3])
+        if cid.lower() == "circuitid":
+            continue
+        yield cid, hostname, interface
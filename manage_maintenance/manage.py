@@ -1,44 +1,140 @@
 #!/usr/bin/env python3
 # Copyright 2017 Netflix
-import glob
+import email
 import hashlib
 import logging
 import os
-import re
 import uuid
-import yaml
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
 
-from icalendar import Calendar, vDatetime
-from tinydb import TinyDB
-
-from manage_maintenance.config import config
-from manage_maintenance.google_calendar import GoogleCalendar
-from manage_maintenance.imap import IMAP
+from manage_maintenance.checkpoint import IMAPCheckpointStore
+from manage_maintenance.coalesce import plan_calendar_writes
+from manage_maintenance.config import MAX_BATCH_SIZE, config
+from manage_maintenance.ics import extract_events
+from manage_maintenance.imap import DEFAULT_FETCH_CHUNK_SIZE, DEFAULT_IDLE_TIMEOUT, DEFAULT_POLL_INTERVAL, IMAP, build_search_criteria
+from manage_maintenance.metrics import METRICS
+from manage_maintenance.parse_cache import content_key, message_id_key, pattern_source_fingerprints
+from manage_maintenance.patterns import NotificationPatternEngine
+from manage_maintenance.schedule import CALENDAR_TABLE, FEED_TABLE, ScheduleStore
+from manage_maintenance.sources import IMAPMessageSource
 
 
 LOG = logging.getLogger(__name__)
 
 
-MaintenanceNotification = namedtuple("MaintenanceNotification", ("subject", "start_time", "end_time", "cid", "partner", "original_message", "event_uuid"))
+MaintenanceNotification = namedtuple("MaintenanceNotification", ("subject", "start_time", "end_time", "cid", "partner", "original_message", "event_uuid", "affected_devices",
+                                                                 "reference", "cancelled", "sent_time"))
+# affected_devices holds the CircuitEndpoints the CID maps to in the circuit inventory, if one is loaded;
+# reference is the carrier's maintenance reference and sent_time the notice's Date, when known
+MaintenanceNotification.__new__.__defaults__ = ((), None, False, None)
+
+# One window of a maintenance; times are strings until parsed with the pattern's time formats.
+# uid and cancelled come from a calendar part's VEVENT
+MaintenanceWindow = namedtuple("MaintenanceWindow", ("start_time", "end_time", "uid", "cancelled"))
+
+
+# Messages in flight per parse worker when parsing in a process pool
+PARSE_QUEUE_DEPTH = 4
+
+# Header fields fetched to screen messages (and look them up in the parse cache) before downloading their bodies
+SCREENING_HEADER_FIELDS = ("From", "Subject", "Message-ID", "Date")
+
+DEFAULT_NOTIFICATION_PATTERNS_GLOB = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "notification_patterns", "*.yml")
+
+# Notification patterns of a parse worker process, keyed by pattern ID
+_worker_notification_patterns = None
+
+
+def _init_parse_worker(pattern_configs, metrics_enabled=False):
+    global _worker_notification_patterns
+    # Forked workers start with a copy of the parent's metrics, which must not be sent back
+    METRICS.reset()
+    if metrics_enabled:
+        METRICS.enable()
+    engine = NotificationPatternEngine()
+    _worker_notification_patterns = {pattern_id: engine.add(pattern_config, pattern_id=pattern_id) for pattern_id, pattern_config in pattern_configs}
+
+
+def _parse_message_in_worker(raw_message, pattern_ids):
+    message = email.message_from_bytes(raw_message)
+    maintenance_notifications = [ManageMaintenance.extract_maintenances(message, _worker_notification_patterns[pattern_id]) for pattern_id in pattern_ids]
+    # Metrics recorded in the worker go back with the result and are merged into the parent's
+    return maintenance_notifications, METRICS.drain() if METRICS.enabled else None
+
+
+def parse_sent_time(date_header):
+    """Return a message's Date header as a datetime, or None if it is missing or malformed."""
+    if not date_header:
+        return None
+    try:
+        return parsedate_to_datetime(date_header)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _is_transient_failure(result):
+    # Queued writes ran out of retries on throttling or server errors; a retryable error may also come back as "failed"
+    if result.status == "queued":
+        return True
+    error = getattr(result, "error", None)
+    if result.status != "failed" or error is None:
+        return False
+    from manage_maintenance.request_scheduler import is_retryable
+    return is_retryable(error)
+
+
+def writes_hold_checkpoint(results):
+    """Return whether write results should hold the IMAP checkpoint back, so the next run lists the messages again.
+
+    Only transient failures do: writes queued for the next run after running out of retries, or
+    failing with an error that may go away (throttling, 5xx). Permanent failures, such as a 400 for
+    an invalid time range, would fail again on every run, so they are logged and the checkpoint
+    advances past them.
+    """
+    failed = [result for result in results if getattr(result, "status", None) in ("failed", "queued")]
+    transient = sum(1 for result in failed if _is_transient_failure(result))
+    if len(failed) > transient:
+        LOG.error("%s calendar writes failed permanently, advancing the checkpoint past them", len(failed) - transient)
+        METRICS.increment("calendar_writes_abandoned_total", len(failed) - transient)
+    if transient:
+        LOG.warning("%s calendar writes failed for now, not advancing the checkpoint so the next run retries them", transient)
+        METRICS.increment("checkpoints_held_total")
+    return bool(transient)
 
 
 class ManageMaintenance(object):
 
-    def __init__(self, imap_username, imap_password, imap_address, imap_folder, google_calendar_id=None):
+    def __init__(self, imap_username, imap_password, imap_address, imap_folder, google_calendar_id=None, imap_fetch_chunk_size=DEFAULT_FETCH_CHUNK_SIZE, parse_workers=0,
+                 google_calendar=None, circuit_inventory=None, imap_port=None, imap_ssl=True, parse_cache=None, header_first_fetch=False,
+                 imap_checkpoints=None, message_source=None, notification_patterns_glob=DEFAULT_NOTIFICATION_PATTERNS_GLOB):
         self._imap_username = imap_username
         self._imap_password = imap_password
         self._imap_addresss = imap_address
         self._imap_folder = imap_folder
+        self._imap_port = imap_port
+        self._imap_ssl = imap_ssl
+        self._imap_fetch_chunk_size = imap_fetch_chunk_size
+        self._parse_workers = parse_workers or 0
+        self._circuit_inventory = circuit_inventory
+        self._parse_cache = parse_cache
+        self._header_first_fetch = header_first_fetch
         self.__imap_server = None
-        self._notification_patterns = []
+        self.__imap_checkpoints = imap_checkpoints
+        self._pending_checkpoints = []
+        self._message_source = message_source
+        self._notification_patterns_glob = notification_patterns_glob
+        self._notification_patterns = NotificationPatternEngine()
+        self._imap_search_criteria = None
         self.load_notification_patterns()
         self._google_calendar_id = google_calendar_id
-        self._google_calendar = GoogleCalendar()
+        self.__google_calendar = google_calendar
 
     def _connect_to_imap(self):
-        self.__imap_server = IMAP(username=self._imap_username, password=self._imap_password, address=self._imap_addresss)
+        self.__imap_server = IMAP(username=self._imap_username, password=self._imap_password, address=self._imap_addresss, port=self._imap_port, use_ssl=self._imap_ssl)
         self.__imap_server.connect()
 
     @property
@@ -47,136 +143,606 @@ class ManageMaintenance(object):
             self._connect_to_imap()
         return self.__imap_server
 
+    @property
+    def message_source(self):
+        """The MessageSource list_maintenances reads, the IMAP folder unless another was given."""
+        if not self._message_source:
+            self._message_source = IMAPMessageSource(self)
+        return self._message_source
+
+    @property
+    def _google_calendar(self):
+        # Created, and the Google API client imported, on first write so parse-only runs never touch OAuth or the network
+        if not self.__google_calendar:
+            from manage_maintenance.google_calendar import GoogleCalendar
+            self.__google_calendar = GoogleCalendar()
+        return self.__google_calendar
+
+    def disconnect_imap(self):
+        """Drop the IMAP connection; the next IMAP call logs in again."""
+        if self.__imap_server:
+            self.__imap_server.logout()
+        self.__imap_server = None
+
+    def wait_for_new_messages(self, timeout=DEFAULT_IDLE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL):
+        return self._imap.wait_for_changes(folder_name=self._imap_folder, timeout=timeout, poll_interval=poll_interval)
+
+    @property
+    def _imap_checkpoints(self):
+        if not self.__imap_checkpoints:
+            self.__imap_checkpoints = IMAPCheckpointStore(os.path.join(config.SCHEDULE_FILE_PATH, config.IMAP_CHECKPOINT_FILE_NAME))
+        return self.__imap_checkpoints
+
     def load_notification_patterns(self):
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        patterns_directory = os.path.join(current_dir, "..", "notification_patterns", "*.yml")
-        self._notification_patterns = []
-        for file_path in glob.glob(patterns_directory):
-            with open(file_path) as f:
-                file_blob = f.read()
-            patterns = yaml.load(file_blob)
-            for pattern in patterns:
-                self._notification_patterns.append(pattern)
+        self._notification_patterns = NotificationPatternEngine.from_directory(self._notification_patterns_glob)
+        self._imap_search_criteria = build_search_criteria(self._notification_patterns.pattern_configs)
         return
 
-    def list_maintenances(self, since=None):
-        since = since or datetime.now().strftime("%Y-%m-%d")
-        email_ids = self._imap.list_message_ids_in_folder(folder_name=self._imap_folder, since=since)
-        LOG.debug("Found %s emails in folder", len(email_ids))
-        for email_id in email_ids:
-            message = self._imap.get_message_by_id_from_folder(folder_name=self._imap_folder, email_id=email_id)
-            msg_subject = message["Subject"]
-            msg_from = message["From"].strip()
-
-            for notification_config in self._notification_patterns:
-                # Check email sender domain matches
-                if notification_config.get("email_domain_pattern", None) and not re.search(notification_config["email_domain_pattern"], msg_from):
-                    continue
+    def notification_pattern_statistics(self):
+        return self._notification_patterns.match_statistics()
 
-                # Check email subject matches pattern
-                if notification_config.get("email_subject_pattern", None) and not re.search(notification_config["email_subject_pattern"], msg_subject):
-                    continue
+    def list_maintenances(self, since=None, defer_checkpoint=False):
+        """Yield maintenances from the messages of the message source that arrived since the last completed run.
 
-                # Get important details
-                cid, start_time, end_time, original_message = self._extract_info_from_message_naive(
-                    message=message,
-                    cid_pattern=notification_config["maintenance_cid_pattern"],
-                    start_time_pattern=notification_config["maintenance_start_time_pattern"],
-                    end_time_pattern=notification_config["maintenance_end_time_pattern"]
-                )
-
-                # Convert start_time and end_time to datetime objects
-                if start_time and not isinstance(start_time, datetime):
-                    start_time = datetime.strptime(start_time, notification_config["start_time_format"])
-                if end_time and not isinstance(end_time, datetime):
-                    end_time = datetime.strptime(end_time, notification_config["end_time_format"])
-
-                # Yield each item
-                if cid and start_time and end_time:
-                    yield MaintenanceNotification(
-                        subject=msg_subject,
-                        start_time=start_time,
-                        end_time=end_time,
-                        cid=cid,
-                        partner=notification_config["partner_name"],
-                        original_message=original_message,
-                        event_uuid=self._generate_maintenance_uuid(cid=cid, start_time=start_time, end_time=end_time)
-                    )
-                else:
-                    LOG.warning("Missing one of CID, Start Time, or End Time: %s, %s, %s", cid, start_time, end_time)
+        The source is checkpointed once every message has been yielded (for the IMAP folder, its
+        highest processed UID), so ``since`` only bounds the first run (or a run after the folder's
+        UIDVALIDITY changed). With ``defer_checkpoint``, the checkpoint waits for commit_checkpoints,
+        to be called once the maintenances are written.
+        """
+        message_source = self.message_source
+        message_ids = message_source.list_message_ids(since=since)
+        if self._parse_cache is not None:
+            maintenance_notifications = self._list_maintenances_with_cache(message_source, message_ids)
+        else:
+            raw_messages = (raw_message for _, raw_message in self._fetch_from_source(message_source, message_ids))
+            if self._parse_workers > 1:
+                maintenance_notifications = self._parse_messages_in_pool(raw_messages)
+            else:
+                maintenance_notifications = self._parse_messages(raw_messages)
+        for maintenance_notification in maintenance_notifications:
+            yield self.add_impact(maintenance_notification)
+
+        if defer_checkpoint:
+            self._pending_checkpoints.append(lambda: message_source.checkpoint(message_ids))
+        else:
+            message_source.checkpoint(message_ids)
         return
 
-    def extract_times_from_ical(self, ical_obj):
-        start_time = ical_obj.subcomponents[0]["DTSTART"].dt
-        end_time = ical_obj.subcomponents[0]["DTEND"].dt
-        return start_time, end_time
+    def commit_checkpoints(self, results=()):
+        """Advance the checkpoints list_maintenances deferred, unless one of the write ``results`` failed for now.
+
+        ``results`` are the EventWriteResults (or any results with a status) of writing the listed
+        maintenances. If a write failed transiently (see writes_hold_checkpoint) the checkpoints
+        are dropped instead, so the next run lists the same messages again; their other writes are
+        idempotent. Returns whether they advanced.
+        """
+        pending_checkpoints, self._pending_checkpoints = self._pending_checkpoints, []
+        if writes_hold_checkpoint(results):
+            return False
+        for checkpoint in pending_checkpoints:
+            checkpoint()
+        return True
+
+    def _list_maintenances_with_cache(self, message_source, message_ids):
+        """Yield maintenances in mailbox order, downloading and parsing only messages the parse cache can't answer.
+
+        Each chunk's From, Subject, Message-ID and Date headers are fetched first, and messages no pattern
+        matches are never downloaded (as with ``header_first_fetch``). A message is answered
+        from the cache when every patterns file has a current entry for it, or when the files whose
+        entries are stale (edited or new) have no pattern matching its headers; those are rebuilt
+        without downloading their body, so ``original_message`` is empty. Messages without a
+        Message-ID are looked up by a hash of their content once downloaded, which still saves
+        parsing them. Everything parsed is added to the cache.
+        """
+        fingerprints = pattern_source_fingerprints(self._notification_patterns)
+        message_ids = list(message_ids)
+        for offset in range(0, len(message_ids), self._imap_fetch_chunk_size):
+            uids = message_ids[offset:offset + self._imap_fetch_chunk_size]
+            headers = message_source.fetch_screening_headers(uids)
+            message_keys = {uid: message_id_key(header["Message-ID"]) for uid, header in headers.items()}
+            cached = self._cached_maintenances(message_keys, headers, fingerprints)
+
+            # Messages no pattern matches are cached as having nothing to extract, without downloading them
+            unmatched = {uid for uid in headers if message_keys[uid] not in cached and not self._headers_match(headers[uid])}
+            self._parse_cache.put_many([(message_keys[uid], {}) for uid in unmatched if message_keys[uid]], fingerprints)
+            METRICS.increment("screened_out_messages_total", len(unmatched))
+
+            raw_messages = list(message_source.fetch_raw_messages([uid for uid in uids if uid in headers and message_keys[uid] not in cached and uid not in unmatched]))
+            content_keys = {uid: content_key(raw_message) for uid, raw_message in raw_messages if not message_keys[uid]}
+            if content_keys:
+                message_keys.update(content_keys)
+                cached.update(self._cached_maintenances(content_keys, headers, fingerprints))
+            raw_messages = [(uid, raw_message) for uid, raw_message in raw_messages if message_keys[uid] not in cached]
+            METRICS.increment("parse_cache_hits_total", len(headers) - len(unmatched) - len(raw_messages))
+            METRICS.increment("parse_cache_misses_total", len(raw_messages))
+
+            parsed = {}
+            entries = []
+            extract = self._extract_from_messages_in_pool if self._parse_workers > 1 else self._extract_from_messages
+            for uid, extractions in extract(raw_messages):
+                maintenances_by_source = {}
+                for notification_pattern, maintenance_notification in extractions:
+                    if maintenance_notification:
+                        maintenances_by_source.setdefault(notification_pattern.source, []).append(maintenance_notification)
+                entries.append((message_keys[uid], maintenances_by_source))
+                parsed[uid] = self._extracted_notifications(extractions)
+            self._parse_cache.put_many(entries, fingerprints)
+
+            for uid in uids:
+                if uid in parsed:
+                    maintenance_notifications = parsed[uid]
+                elif message_keys.get(uid) in cached:
+                    maintenance_notifications = [MaintenanceNotification(subject=headers[uid]["Subject"], original_message="", sent_time=parse_sent_time(headers[uid]["Date"]),
+                                                                         **cached_maintenance._asdict())
+                                                 for cached_maintenance in cached[message_keys[uid]]]
+                else:
+                    maintenance_notifications = []  # Gone from the folder since the search
+                for maintenance_notification in maintenance_notifications:
+                    yield maintenance_notification
+
+    def _cached_maintenances(self, message_keys, headers, fingerprints):
+        """Return {message_key: [CachedMaintenance, ...]} for the messages (by message ID in message_keys) the parse cache answers."""
+        rows = self._parse_cache.get_many([message_key for message_key in message_keys.values() if message_key], fingerprints)
+        cached = {}
+        refreshed = []
+        for uid, message_key in message_keys.items():
+            if message_key not in rows:
+                continue
+            cached_by_source = rows[message_key]
+            stale_sources = set(fingerprints) - set(cached_by_source)
+            if stale_sources:
+                if self._headers_match(headers[uid], sources=stale_sources):
+                    continue
+                # The stale files can't match the message, so their entries become current and empty
+                refreshed.append((message_key, cached_by_source))
+            cached[message_key] = [cached_maintenance for source in sorted(cached_by_source) for cached_maintenance in cached_by_source[source]]
+        if refreshed:
+            self._parse_cache.put_many(refreshed, fingerprints)
+        return cached
+
+    def list_new_message_ids(self, since=None, imap=None):
+        """Select the folder and return its checkpoint key and the UIDs of messages not processed yet.
+
+        Uses ``imap`` if given (which is left with the folder selected) or the main connection otherwise.
+        """
+        imap = imap or self._imap
+        since = since or datetime.now().strftime("%d-%b-%Y")
+        checkpoint_key = IMAPCheckpointStore.checkpoint_key(self._imap_username, self._imap_addresss, self._imap_folder)
+        uidvalidity = imap.select_folder(self._imap_folder)
+        last_uid = self._imap_checkpoints.get(checkpoint_key, uidvalidity)
+        if last_uid is None:
+            email_ids = imap.list_message_ids_in_folder(folder_name=self._imap_folder, since=since, search_criteria=self._imap_search_criteria)
+        else:
+            email_ids = imap.list_message_ids_in_folder(folder_name=self._imap_folder, search_criteria=self._imap_search_criteria, min_uid=last_uid + 1)
+        LOG.debug("Found %s emails in folder", len(email_ids))
+        return checkpoint_key, email_ids
+
+    def checkpoint_message_ids(self, checkpoint_key, email_ids, uidvalidity=None):
+        """Record every UID in ``email_ids`` as processed, under the main connection's UIDVALIDITY unless one is given."""
+        if email_ids:
+            self._imap_checkpoints.set(checkpoint_key, uidvalidity or self._imap.uidvalidity, max(int(email_id) for email_id in email_ids))
+
+    def fetch_raw_messages(self, email_ids, imap=None):
+        """Yield the raw RFC822 bytes of messages, over ``imap`` if given or the main connection otherwise.
+
+        With ``header_first_fetch``, each chunk's headers are fetched and screened first, and only
+        the messages a notification pattern matches are downloaded.
+        """
+        for _, raw_message in self._fetch_from_source(IMAPMessageSource(self, imap=imap), [int(email_id) for email_id in email_ids]):
+            yield raw_message
+
+    def fetch_uid_raw_messages(self, email_ids, imap=None):
+        """Yield (uid, raw RFC822 bytes) for messages, without screening them."""
+        imap = imap or self._imap
+        for uid, raw_message in imap.fetch_uid_raw_messages_from_folder(folder_name=self._imap_folder, email_ids=email_ids, chunk_size=self._imap_fetch_chunk_size):
+            yield int(uid), raw_message
+
+    def _fetch_from_source(self, message_source, message_ids):
+        # Yields (message_id, raw_message), screening each chunk's headers first with header_first_fetch
+        if not self._header_first_fetch:
+            for message in message_source.fetch_raw_messages(message_ids):
+                yield message
+            return
+        message_ids = list(message_ids)
+        for offset in range(0, len(message_ids), self._imap_fetch_chunk_size):
+            matching_ids = self._matching_message_ids(message_source, message_ids[offset:offset + self._imap_fetch_chunk_size])
+            for message in message_source.fetch_raw_messages(matching_ids):
+                yield message
+
+    def fetch_screening_headers(self, email_ids, imap=None):
+        """Return {uid: headers} with the From, Subject, Message-ID and Date of messages, without downloading their bodies."""
+        imap = imap or self._imap
+        header_parser = BytesHeaderParser()
+        return {int(uid): header_parser.parsebytes(header) for uid, header in imap.fetch_header_fields_from_folder(
+            folder_name=self._imap_folder, email_ids=email_ids, fields=SCREENING_HEADER_FIELDS, chunk_size=self._imap_fetch_chunk_size)}
+
+    def _matching_message_ids(self, message_source, message_ids):
+        # The UIDs, in order, of the messages whose headers match a notification pattern
+        headers = message_source.fetch_screening_headers(message_ids)
+        matching_ids = [message_id for message_id in message_ids if message_id in headers and self._headers_match(headers[message_id])]
+        METRICS.increment("screened_out_messages_total", len(headers) - len(matching_ids))
+        return matching_ids
+
+    def _headers_match(self, headers, sources=None):
+        # Screening doesn't count towards the pattern statistics; matching messages are matched again when parsed
+        return self._notification_patterns.matches_any((headers["From"] or "").strip(), headers["Subject"] or "", sources=sources)
+
+    def open_imap_folder(self):
+        """Open an extra IMAP connection with the folder selected, for fetching in parallel with the main one."""
+        imap = IMAP(username=self._imap_username, password=self._imap_password, address=self._imap_addresss, port=self._imap_port, use_ssl=self._imap_ssl)
+        imap.connect()
+        imap.select_folder(self._imap_folder)
+        return imap
+
+    def parse_raw_message(self, raw_message):
+        """Return the maintenances found in one raw RFC822 message."""
+        return list(self._parse_messages([raw_message]))
+
+    def add_impact(self, maintenance_notification):
+        """Fill in the devices a maintenance affects from the circuit inventory."""
+        if not self._circuit_inventory:
+            return maintenance_notification
+        return maintenance_notification._replace(affected_devices=self._circuit_inventory.lookup(maintenance_notification.cid))
 
-    def _extract_info_from_message_naive(self, message, cid_pattern, start_time_pattern, end_time_pattern):
+    def _match_message_headers(self, message):
+        # Only patterns indexed under the sender's domain (plus regex-only senders) are checked
+        return self._notification_patterns.match((message["From"] or "").strip(), message["Subject"] or "")
+
+    def _parse_messages(self, raw_messages):
+        for _, extractions in self._extract_from_messages((None, raw_message) for raw_message in raw_messages):
+            for maintenance_notification in self._extracted_notifications(extractions):
+                yield maintenance_notification
+
+    def _parse_messages_in_pool(self, raw_messages):
+        for _, extractions in self._extract_from_messages_in_pool((None, raw_message) for raw_message in raw_messages):
+            for maintenance_notification in self._extracted_notifications(extractions):
+                yield maintenance_notification
+
+    @staticmethod
+    def _extracted_notifications(extractions):
+        return [maintenance_notification for _, maintenance_notification in extractions if maintenance_notification]
+
+    def _extract_from_messages(self, tagged_raw_messages):
+        """Parse (tag, raw_message) pairs, yielding (tag, [(notification_pattern, maintenance_notification or None), ...])."""
+        for tag, raw_message in tagged_raw_messages:
+            message = email.message_from_bytes(raw_message)
+            extractions = []
+            for notification_pattern in self._match_message_headers(message):
+                for maintenance_notification in self.extract_maintenances(message, notification_pattern) or [None]:
+                    self._record_extraction(notification_pattern, maintenance_notification)
+                    extractions.append((notification_pattern, maintenance_notification))
+            yield tag, extractions
+
+    def _extract_from_messages_in_pool(self, tagged_raw_messages):
+        """Like _extract_from_messages, but in a process pool, still yielding results in mailbox order.
+
+        Header matching is cheap and stays in this process, so only messages that match a pattern
+        are shipped to the workers. At most ``PARSE_QUEUE_DEPTH`` messages per worker are in flight.
+        """
+        header_parser = BytesHeaderParser()
+        pending = deque()
+        with self.parse_pool() as executor:
+            for tag, raw_message in tagged_raw_messages:
+                pending.append((tag, self._submit_parse(executor, header_parser, raw_message)))
+                while len(pending) >= self._parse_workers * PARSE_QUEUE_DEPTH:
+                    tag, parse = pending.popleft()
+                    yield tag, self._collect_parse_result(parse)
+            while pending:
+                tag, parse = pending.popleft()
+                yield tag, self._collect_parse_result(parse)
+
+    def parse_pool(self, max_workers=None):
+        """Return a process pool whose workers have this manager's notification patterns loaded."""
+        pattern_configs = [(notification_pattern.pattern_id, notification_pattern.config) for notification_pattern in self._notification_patterns]
+        return ProcessPoolExecutor(max_workers=max_workers or self._parse_workers, initializer=_init_parse_worker, initargs=(pattern_configs, METRICS.enabled))
+
+    def _submit_parse(self, executor, header_parser, raw_message):
+        # Returns (notification_patterns, future), or None when no pattern matches the headers
+        notification_patterns = self._match_message_headers(header_parser.parsebytes(raw_message))
+        if not notification_patterns:
+            return None
+        pattern_ids = [notification_pattern.pattern_id for notification_pattern in notification_patterns]
+        return notification_patterns, executor.submit(_parse_message_in_worker, raw_message, pattern_ids)
+
+    def _collect_parse_result(self, parse):
+        # Wait for a _submit_parse result and return its [(notification_pattern, maintenance_notification or None), ...]
+        if not parse:
+            return []
+        notification_patterns, future = parse
+        maintenance_notifications, metrics = future.result()
+        if metrics:
+            METRICS.merge(metrics)
+        extractions = [(notification_pattern, maintenance_notification) for notification_pattern, pattern_notifications in zip(notification_patterns, maintenance_notifications)
+                       for maintenance_notification in pattern_notifications or [None]]
+        for notification_pattern, maintenance_notification in extractions:
+            self._record_extraction(notification_pattern, maintenance_notification)
+        return extractions
+
+    @staticmethod
+    def _record_extraction(notification_pattern, maintenance_notification):
+        if maintenance_notification:
+            notification_pattern.extractions += 1
+            METRICS.increment("notifications_extracted_total", partner=notification_pattern.partner_name)
+        else:
+            notification_pattern.incomplete_extractions += 1
+            METRICS.increment("notifications_incomplete_total", partner=notification_pattern.partner_name)
+
+    @staticmethod
+    def extract_maintenance(message, notification_pattern):
+        """Extract the (first) MaintenanceNotification from a message matching a pattern, or None if details are missing."""
+        maintenance_notifications = ManageMaintenance.extract_maintenances(message, notification_pattern)
+        return maintenance_notifications[0] if maintenance_notifications else None
+
+    @staticmethod
+    def extract_maintenances(message, notification_pattern):
+        """Extract a MaintenanceNotification per maintenance window from a message matching a pattern.
+
+        A calendar part can hold several windows (one per VEVENT); otherwise there is one. Returns
+        an empty list if details are missing.
+        """
+        # Get important details
+        cid, windows, original_message = ManageMaintenance._extract_info_from_message(message, notification_pattern)
+
+        # Convert start_time and end_time to datetime objects
+        with METRICS.timer("time_parse_seconds", partner=notification_pattern.partner_name):
+            windows = [window._replace(
+                start_time=window.start_time if isinstance(window.start_time, datetime) else datetime.strptime(window.start_time, notification_pattern.start_time_format),
+                end_time=window.end_time if isinstance(window.end_time, datetime) else datetime.strptime(window.end_time, notification_pattern.end_time_format))
+                for window in windows]
+
+        if not (cid and windows):
+            LOG.warning("Missing one of CID, Start Time, or End Time: %s, %s", cid, windows)
+            return []
+
+        subject = message["Subject"] or ""
+        reference = ManageMaintenance._search_group(notification_pattern.reference_regex, subject, original_message)
+        cancelled = bool(notification_pattern.cancelled_regex and ManageMaintenance._search_group(notification_pattern.cancelled_regex, subject, original_message, group=0))
+        sent_time = parse_sent_time(message["Date"])
+        return [MaintenanceNotification(
+            subject=message["Subject"],
+            start_time=window.start_time,
+            end_time=window.end_time,
+            cid=cid,
+            partner=notification_pattern.partner_name,
+            original_message=original_message,
+            event_uuid=ManageMaintenance._generate_maintenance_uuid(cid=cid, start_time=window.start_time, end_time=window.end_time),
+            # A VEVENT's UID tells the windows of a multi-window notice apart
+            reference=window.uid or reference,
+            cancelled=window.cancelled or cancelled,
+            sent_time=sent_time
+        ) for window in windows]
+
+    @staticmethod
+    def _search_group(regex, *texts, group=1):
+        # The group of the first match in the texts, searched in order
+        if not regex:
+            return None
+        for text in texts:
+            match = regex.search(text or "")
+            if match:
+                return match.group(group)
+        return None
+
+    @staticmethod
+    def extract_windows_from_ical(ical_text):
+        """Return a MaintenanceWindow for every VEVENT of an ICS calendar."""
+        return [MaintenanceWindow(start_time=event.start_time, end_time=event.end_time, uid=event.uid, cancelled=event.status == "CANCELLED")
+                for event in extract_events(ical_text)]
+
+    @staticmethod
+    def _decode_message_part(message_part):
+        payload = message_part.get_payload(decode=True)
+        if not payload:
+            return None     # The message part couldn't be decoded
+        charset = message_part.get_content_charset() or "utf-8"
+        try:
+            return payload.decode(charset, errors="replace")
+        except LookupError:     # Unknown charset
+            return payload.decode("utf-8", errors="replace")
+
+    @staticmethod
+    def _extract_info_from_message(message, notification_pattern):
+        """Search a message's parts for the CID and the windows (start and end times) of a maintenance.
+
+        Parts are visited in the pattern's content type preference order, each decoded once with its
+        declared charset, and the search stops as soon as the CID and the windows have been found. A
+        calendar part gives a window per VEVENT, so windows the time patterns find in other parts only
+        stop the search once no calendar part is left; without one, the time patterns give one window.
+        Returns (cid, [MaintenanceWindow, ...], original_message).
+        """
         cid = None
+        windows = []
         start_time = None
         end_time = None
-        message_body = None
-        for message_part in message.walk():
-            # Get a message body if this message part has one
-            if message_part.get_content_type() == "text/plain":
-                message_body = message_part.get_payload(decode=True)
-            elif message_part.get_content_type() == "text/html":
-                message_body = message_part.get_payload(decode=True)
-            elif message_part.get_content_type() == "text/calendar":
-                message_body = message_part.get_payload(decode=True)
-                ics = Calendar.from_ical(message_body)
-                start_time, end_time = self.extract_times_from_ical(ics)
-            else:
-                continue    # We don't know how to parse this message part type
-
+        original_message = None
+        content_types = notification_pattern.content_types
+        with METRICS.timer("mime_walk_seconds"):
+            message_parts = sorted((message_part for message_part in message.walk() if message_part.get_content_type() in content_types),
+                                   key=lambda message_part: content_types.index(message_part.get_content_type()))
+        calendar_parts_left = sum(1 for message_part in message_parts if message_part.get_content_type() == "text/calendar")
+        for message_part in message_parts:
+            if message_part.get_content_type() == "text/calendar":
+                calendar_parts_left -= 1
+            with METRICS.timer("mime_walk_seconds"):
+                message_body = ManageMaintenance._decode_message_part(message_part)
             if not message_body:
-                continue    # The message part couldn't be decoded. Skip it.
+                continue
 
-            # Parse the message body
-            message_body = str(message_body)
-            match = re.search(cid_pattern, message_body, re.IGNORECASE)
-            if match:
-                cid = match.group(1)
-            match = re.search(start_time_pattern, message_body, re.IGNORECASE)
-            if match:
-                start_time = match.group(1)
-            match = re.search(end_time_pattern, message_body, re.IGNORECASE)
-            if match:
-                end_time = match.group(1)
+            found = False
+            if message_part.get_content_type() == "text/calendar" and not windows:
+                with METRICS.timer("time_parse_seconds", partner=notification_pattern.partner_name):
+                    windows = ManageMaintenance.extract_windows_from_ical(message_body)
+                found = bool(windows)
+
+            # Only search for the details that are still missing
+            with METRICS.timer("pattern_match_seconds", pattern=notification_pattern.pattern_id):
+                if not cid:
+                    match = notification_pattern.cid_regex.search(message_body)
+                    if match:
+                        cid = match.group(1)
+                        found = True
+                if not start_time and not windows:
+                    match = notification_pattern.start_time_regex.search(message_body)
+                    if match:
+                        start_time = match.group(1)
+                        found = True
+                if not end_time and not windows:
+                    match = notification_pattern.end_time_regex.search(message_body)
+                    if match:
+                        end_time = match.group(1)
+                        found = True
 
-            # If we have all of the things we need stop looking
-            #if cid and start_time and end_time:
-            #    break
-        return cid, start_time, end_time, message_body
+            if found and original_message is None:
+                original_message = message_body
 
-    def _generate_maintenance_uuid(self, cid, start_time, end_time):
+            # If we have all of the things we need stop looking; a calendar part may still hold more windows
+            if cid and (windows or (start_time and end_time and not calendar_parts_left)):
+                break
+        if not windows and start_time and end_time:
+            windows = [MaintenanceWindow(start_time=start_time, end_time=end_time, uid=None, cancelled=False)]
+        return cid, windows, original_message
+
+    @staticmethod
+    def _generate_maintenance_uuid(cid, start_time, end_time):
         return hashlib.sha1(bytes("{}{}{}".format(
             cid,
             start_time.isoformat(),
             end_time.isoformat()
         ), "utf-8")).hexdigest()
 
+    @staticmethod
+    def _maintenance_event_fields(maintenance_notification):
+        return dict(
+            newEventId=maintenance_notification.event_uuid,
+            start_time=maintenance_notification.start_time,
+            end_time=maintenance_notification.end_time,
+            event_summary="Scheduled Maintenance: {} {}".format(maintenance_notification.partner, maintenance_notification.cid),
+            event_description="{} will be performing maintenance starting {} and ending {} that will affect the following CIDs:\n{}\n{}\n\n{}".format(
+                maintenance_notification.partner,
+                maintenance_notification.start_time.isoformat(),
+                maintenance_notification.end_time.isoformat(),
+                maintenance_notification.cid,
+                ManageMaintenance._format_affected_devices(maintenance_notification.affected_devices),
+                maintenance_notification.original_message
+            ),
+            event_location="",
+            event_cids=[maintenance_notification.cid]
+        )
+
+    @staticmethod
+    def _format_affected_devices(affected_devices):
+        if not affected_devices:
+            return ""
+        return "\nAffected devices:\n{}\n".format("\n".join("{} {}".format(hostname, interface) for hostname, interface in affected_devices))
+
+    def find_maintenance_conflicts(self, maintenance_notification):
+        """Return calendar events overlapping a maintenance's window, other than its own event."""
+        return [interval for interval in self._google_calendar.find_conflicting_events(maintenance_notification.start_time, maintenance_notification.end_time)
+                if interval.event_id != maintenance_notification.event_uuid]
+
+    def check_maintenance_conflicts(self, maintenance_notifications):
+        """Log the calendar events each maintenance about to be written overlaps, and return {event_uuid: [EventInterval, ...]} of those that do.
+
+        Cancelled maintenances can't conflict. The calendar is checked as it is before the writes,
+        so maintenances written together aren't checked against each other.
+        """
+        conflicts = {}
+        for maintenance_notification in maintenance_notifications:
+            if maintenance_notification.cancelled:
+                continue
+            overlapping = self.find_maintenance_conflicts(maintenance_notification)
+            if not overlapping:
+                continue
+            conflicts[maintenance_notification.event_uuid] = overlapping
+            METRICS.increment("maintenance_conflicts_total", partner=maintenance_notification.partner)
+            LOG.warning("Maintenance %s %s (%s - %s) overlaps %s calendar events: %s", maintenance_notification.partner, maintenance_notification.cid,
+                        maintenance_notification.start_time, maintenance_notification.end_time, len(overlapping),
+                        "; ".join("'{}' ({} - {})".format(interval.summary, interval.start, interval.end) for interval in overlapping))
+        return conflicts
+
     def add_maintenance_to_calendar(self, maintenance_notification):
-        # event_uuid = str(uuid.uuid4()).replace("-", "")
-        if not self._google_calendar.is_existing_event_id(eventId=maintenance_notification.event_uuid):
-            self._google_calendar.create_maintenance_event(
-                newEventId=maintenance_notification.event_uuid,
-                start_time=maintenance_notification.start_time,
-                end_time=maintenance_notification.end_time,
-                event_summary="Scheduled Maintenance: {} {}".format(maintenance_notification.partner, maintenance_notification.cid),
-                event_description="{} will be performing maintenance starting {} and ending {} that will affect the following CIDs:\n{}\n\n\n{}".format(
-                    maintenance_notification.partner,
-                    maintenance_notification.start_time.isoformat(),
-                    maintenance_notification.end_time.isoformat(),
-                    maintenance_notification.cid,
-                    maintenance_notification.original_message
-                ),
-                event_location=""
-            )
+        # create_maintenance_event treats an existing event ID as success, so no pre-check is needed
+        return self._google_calendar.create_maintenance_event(**self._maintenance_event_fields(maintenance_notification))
+
+    def replay_failed_calendar_writes(self):
+        """Send again the calendar writes earlier runs queued after running out of retries, and return their results.
+
+        Call it once per run (or daemon sync) before writing: the batch writers don't, as a pipeline
+        calls them once per batch.
+        """
+        return self._google_calendar.replay_failed_writes()
+
+    def add_maintenances_to_calendar(self, maintenance_notifications, batch_size=MAX_BATCH_SIZE):
+        """Add many maintenances to the calendar using batch requests and return the per-event results.
+
+        Maintenances overlapping events already in the calendar are logged, see check_maintenance_conflicts.
+        """
+        maintenance_notifications = list(maintenance_notifications)
+        self.check_maintenance_conflicts(maintenance_notifications)
+        with self._google_calendar.batch(batch_size=batch_size) as batch:
+            for maintenance_notification in maintenance_notifications:
+                batch.insert(self._google_calendar.build_maintenance_event_body(**self._maintenance_event_fields(maintenance_notification)))
+        return batch.results
+
+    def sync_maintenances_to_calendar(self, maintenance_notifications, batch_size=MAX_BATCH_SIZE):
+        """Write each maintenance's final state to the calendar once and record it in the schedule.
+
+        Notifications are coalesced per maintenance and compared with the schedule, so a run's
+        initial notice, reminders, reschedules and cancellation of one maintenance cost a single
+        create, update or delete, sent in batch requests, and those already in the calendar as
+        notified cost none. Writes still failing after retries are queued for the next run and
+        recorded in the schedule like sent ones; other failures are permanent (see
+        writes_hold_checkpoint) and left out of it, so a later notice of the maintenance writes it
+        again. Pass the results to commit_checkpoints. Created and updated maintenances overlapping
+        other calendar events are logged. Returns the per-event results of the writes sent.
+        """
+        with self.open_schedule() as schedule:
+            writes = list(plan_calendar_writes(maintenance_notifications, schedule, self._google_calendar.is_existing_event_id))
+            sent_writes = [write for write in writes if write.action in ("create", "update", "delete")]
+            self.check_maintenance_conflicts(write.maintenance_notification for write in sent_writes if write.action != "delete")
+            with self._google_calendar.batch(batch_size=batch_size) as batch:
+                for write in sent_writes:
+                    if write.action == "delete":
+                        batch.delete(write.event_id)
+                        continue
+                    event = self._google_calendar.build_maintenance_event_body(**self._maintenance_event_fields(write.maintenance_notification))
+                    if write.action == "create":
+                        batch.insert(event)
+                    else:
+                        batch.update(write.event_id, event)
+            failed_event_ids = {result.event_id for result in batch.results if result.status == "failed"}
+            # Failed writes are left out of the schedule, so the next notice of their maintenance isn't
+            # planned as unchanged and writes it again
+            schedule.upsert_many(write.maintenance_notification for write in writes
+                                 if write.action != "stale" and write.event_id not in failed_event_ids)
+        return batch.results
+
+    def add_maintenances_to_feed(self, maintenance_notifications, feed_publisher):
+        """Record maintenances in the feed schedule and publish it as iCalendar feeds instead of the calendar.
+
+        Notifications are coalesced against the feed's own schedule table as in
+        sync_maintenances_to_calendar, then the whole of it is published in one local write per
+        changed feed. The calendar's rows are left alone, so maintenances published here are still
+        created in the calendar by a later calendar run. Returns the FeedWriteResults of
+        ICSFeedPublisher.publish.
+        """
+        with self.open_schedule(FEED_TABLE) as schedule:
+            writes = plan_calendar_writes(maintenance_notifications, schedule, lambda event_id: False)
+            schedule.upsert_many(write.maintenance_notification for write in writes if write.action != "stale")
+            return feed_publisher.publish_schedule(schedule)
+
+    @staticmethod
+    def open_schedule(table=CALENDAR_TABLE):
+        return ScheduleStore(os.path.join(config.SCHEDULE_FILE_PATH, config.SCHEDULE_DB_FILE_NAME), table)
 
     @staticmethod
     def add_maintenance_to_schedule(maintenance_notification):
-        os.makedirs(config.SCHEDULE_FILE_PATH, exist_ok=True)
-        with TinyDB(os.path.join(config.SCHEDULE_FILE_PATH, config.SCHEDULE_FILE_NAME)) as db:
-            db.insert(maintenance_notification._asdict())
+        with ManageMaintenance.open_schedule() as schedule:
+            schedule.upsert(maintenance_notification)
         return
+
+    @staticmethod
+    def add_maintenances_to_schedule(maintenance_notifications):
+        """Upsert many maintenances into the schedule in a single transaction."""
+        with ManageMaintenance.open_schedule() as schedule:
+            return schedule.upsert_many(maintenance_notifications)
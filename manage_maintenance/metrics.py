@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from manage_maintenance.files import write_atomically
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Upper bounds (seconds) of the timer histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+METRIC_PREFIX = "manage_maintenance_"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _NullTimer(object):
+    """Timer handed out while metrics are disabled; entering and leaving it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(self._name, time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        self.bucket_counts = [count + other_count for count, other_count in zip(self.bucket_counts, other.bucket_counts)]
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    labels = list(label_key) + list(extra)
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                                    for name, value in labels))
+
+
+class Metrics(object):
+    """Process-wide counters and timers, exported as Prometheus text or a JSON summary.
+
+    Metrics start disabled. While disabled ``timer()`` returns a shared no-op context manager and
+    ``increment()``/``observe()`` return straight away, so instrumented code costs one attribute
+    check per call. Timers are histograms of seconds; counters are plain totals. Both take labels
+    as keyword arguments.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.enabled = False
+        self._buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def drain(self):
+        """Return the raw state recorded so far and start over, e.g. to ship it from a worker process."""
+        with self._lock:
+            state = (self._counters, self._histograms)
+            self._counters = {}
+            self._histograms = {}
+        return state
+
+    def merge(self, state):
+        """Add raw state from drain() (usually another process's) to this instance."""
+        counters, histograms = state
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _Histogram(other.buckets)
+                histogram.merge(other)
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self._buckets)
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        """Return a context manager that observes the seconds spent in its block."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def counter_value(self, name, **labels):
+        return self._counters.get((name, _label_key(labels)), 0)
+
+    def timer_count(self, name, **labels):
+        histogram = self._histograms.get((name, _label_key(labels)))
+        return histogram.count if histogram else 0
+
+    def summary(self):
+        """Return every metric as plain data, for a JSON summary at the end of a run."""
+        with self._lock:
+            counters = [{"name": name, "labels": dict(label_key), "value": value} for (name, label_key), value in sorted(self._counters.items())]
+            timers = [{"name": name, "labels": dict(label_key), "count": histogram.count, "total_seconds": histogram.sum,
+                       "mean_seconds": histogram.sum / histogram.count if histogram.count else None, "max_seconds": histogram.max}
+                      for (name, label_key), histogram in sorted(self._histograms.items())]
+        return {"counters": counters, "timers": timers}
+
+    def write_json(self, file_path):
+        write_atomically(os.path.expanduser(file_path), json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def prometheus_text(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        seen = set()
+        for (name, label_key), value in counters:
+            metric = METRIC_PREFIX + name
+            if metric not in seen:
+                seen.add(metric)
+                lines.append("# TYPE {} counter".format(metric))
+            lines.append("{}{} {}".format(metric, _format_labels(label_key), value))
+        for (name, label_key), histogram in histograms:
+            metric = METRIC_PREFIX + name
+            if metric not in seen:
+                seen.add(metric)
+                lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(metric, _format_labels(label_key, [("le", repr(bound))]), cumulative))
+            lines.append("{}_bucket{} {}".format(metric, _format_labels(label_key, [("le", "+Inf")]), histogram.count))
+            lines.append("{}_sum{} {!r}".format(metric, _format_labels(label_key), histogram.sum))
+            lines.append("{}_count{} {}".format(metric, _format_labels(label_key), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, file_path):
+        """Write the Prometheus text format to a file, e.g. for node_exporter's textfile collector."""
+        write_atomically(os.path.expanduser(file_path), self.prometheus_text())
+
+    def serve(self, port, address=""):
+        """Serve the Prometheus text format at /metrics from a background thread and return the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                payload = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        server = HTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        LOG.info("Serving metrics on port %s", server.server_address[1])
+        return server
+
+
+# Shared by every module; enabled by the entry points when metrics are asked for
+METRICS = Metrics()
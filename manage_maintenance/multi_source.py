@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.parser import BytesHeaderParser
+from functools import partial
+
+from manage_maintenance.checkpoint import IMAPCheckpointStore
+from manage_maintenance.config import config
+from manage_maintenance.imap import CONNECTION_ERRORS, DEFAULT_FETCH_CHUNK_SIZE
+from manage_maintenance.imap_pool import DEFAULT_MAX_CONNECTIONS, IMAPConnectionPool
+from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.metrics import METRICS
+
+
+LOG = logging.getLogger(__name__)
+
+
+# UIDs fetched per shard; each shard holds a pooled connection while it is fetched
+DEFAULT_SHARD_SIZE = 1000
+
+# Times a shard is retried on a fresh connection after the session was dropped
+SHARD_RETRIES = 1
+
+
+class MultiSourceMaintenance(object):
+    """Lists maintenances from several (account, folder) MailboxSources in parallel.
+
+    Every source gets its own ManageMaintenance (and IMAP checkpoint), but their IMAP traffic goes
+    through one IMAPConnectionPool: folders are searched in parallel, and each folder's new UIDs are
+    split into shards of ``shard_size`` that are fetched in parallel, at most ``max_connections`` at
+    a time. A shard whose session drops is retried once on a fresh connection. Parsing happens in
+    the fetching threads, or in a shared process pool with ``parse_workers`` above one.
+
+    The notifications of every source are merged into one stream, in the order shards complete,
+    without repeating a notice (event UUID, cancellation and Date), so a notice delivered to several
+    folders or mailboxes appears once while its reminders and cancellation still come through. A
+    source's checkpoint advances once all of its shards have been yielded. A source that fails is
+    logged and its checkpoint left alone while the others carry on, and the first failure is
+    raised after the rest of the stream.
+    """
+
+    def __init__(self, sources, max_connections=DEFAULT_MAX_CONNECTIONS, shard_size=DEFAULT_SHARD_SIZE, parse_workers=0,
+                 imap_fetch_chunk_size=DEFAULT_FETCH_CHUNK_SIZE, circuit_inventory=None, header_first_fetch=False, google_calendar=None, imap_pool=None):
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1, got {}".format(shard_size))
+        self._sources = list(sources)
+        self._shard_size = shard_size
+        self._parse_workers = parse_workers or 0
+        self._imap_pool = imap_pool or IMAPConnectionPool(max_connections=max_connections)
+        checkpoints = IMAPCheckpointStore(os.path.join(config.SCHEDULE_FILE_PATH, config.IMAP_CHECKPOINT_FILE_NAME))
+        self._managers = [ManageMaintenance(imap_username=source.username, imap_password=source.password, imap_address=source.address,
+                                            imap_folder=source.folder, imap_port=source.port, imap_ssl=source.use_ssl,
+                                            imap_fetch_chunk_size=imap_fetch_chunk_size, parse_workers=parse_workers, circuit_inventory=circuit_inventory,
+                                            header_first_fetch=header_first_fetch, google_calendar=google_calendar, imap_checkpoints=checkpoints)
+                          for source in self._sources]
+
+    @property
+    def managers(self):
+        return list(self._managers)
+
+    def close(self):
+        self._imap_pool.close()
+
+    def replay_failed_calendar_writes(self):
+        return self._managers[0].replay_failed_calendar_writes()
+
+    def add_maintenances_to_calendar(self, maintenance_notifications, **kwargs):
+        # Every source writes to the same calendar, so any manager can do it
+        return self._managers[0].add_maintenances_to_calendar(maintenance_notifications, **kwargs)
+
+    def sync_maintenances_to_calendar(self, maintenance_notifications, **kwargs):
+        return self._managers[0].sync_maintenances_to_calendar(maintenance_notifications, **kwargs)
+
+    def add_maintenances_to_feed(self, maintenance_notifications, feed_publisher):
+        return self._managers[0].add_maintenances_to_feed(maintenance_notifications, feed_publisher)
+
+    def commit_checkpoints(self, results=()):
+        # Deferred checkpoints of every source are kept by the first manager, see list_maintenances
+        return self._managers[0].commit_checkpoints(results)
+
+    def list_maintenances(self, since=None, defer_checkpoint=False):
+        """Yield the maintenances of every source that arrived since its last completed run, each notice once.
+
+        With ``defer_checkpoint``, the sources' checkpoints wait for commit_checkpoints.
+        """
+        seen_notices = set()
+        failed_sources = set()
+        first_error = None
+        parse_pool = self._managers[0].parse_pool(max_workers=self._parse_workers) if self._parse_workers > 1 and self._managers else None
+        try:
+            with ThreadPoolExecutor(max_workers=self._imap_pool.max_connections) as threads:
+                # future: (source index, shard, or None for the listing)
+                tasks = {threads.submit(self._list_source, index, since): (index, None) for index in range(len(self._sources))}
+                listings = {}   # source index: [checkpoint key, UIDs, UIDVALIDITY, shards left]
+                try:
+                    while tasks:
+                        done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            index, shard = tasks.pop(future)
+                            if index in failed_sources:
+                                continue
+                            try:
+                                result = future.result()
+                            except Exception as e:
+                                LOG.exception("Failed to read maintenances from %s", self._describe(index))
+                                METRICS.increment("mailbox_source_failures_total")
+                                failed_sources.add(index)
+                                first_error = first_error or e
+                                continue
+
+                            if shard is None:
+                                checkpoint_key, email_ids, uidvalidity = result
+                                shards = [email_ids[offset:offset + self._shard_size] for offset in range(0, len(email_ids), self._shard_size)]
+                                listings[index] = [checkpoint_key, email_ids, uidvalidity, len(shards)]
+                                for shard in shards:
+                                    tasks[threads.submit(self._read_shard, index, shard, parse_pool)] = (index, shard)
+                            else:
+                                for maintenance_notification in result:
+                                    notice = (maintenance_notification.event_uuid, maintenance_notification.cancelled, maintenance_notification.sent_time)
+                                    if notice in seen_notices:
+                                        METRICS.increment("duplicate_notifications_total")
+                                        continue
+                                    seen_notices.add(notice)
+                                    yield maintenance_notification
+                                listings[index][3] -= 1
+
+                            checkpoint_key, email_ids, uidvalidity, shards_left = listings[index]
+                            if not shards_left:
+                                checkpoint = partial(self._managers[index].checkpoint_message_ids, checkpoint_key, email_ids, uidvalidity=uidvalidity)
+                                if defer_checkpoint:
+                                    self._managers[0]._pending_checkpoints.append(checkpoint)
+                                else:
+                                    checkpoint()
+                finally:
+                    for future in tasks:
+                        future.cancel()
+        finally:
+            if parse_pool:
+                parse_pool.shutdown(wait=True)
+        if first_error:
+            raise first_error
+
+    def _describe(self, index):
+        source = self._sources[index]
+        return "{}@{}/{}".format(source.username, source.address, source.folder)
+
+    def _list_source(self, index, since):
+        with self._imap_pool.connection(self._sources[index]) as imap:
+            checkpoint_key, email_ids = self._managers[index].list_new_message_ids(since=since, imap=imap)
+            return checkpoint_key, email_ids, imap.uidvalidity
+
+    def _read_shard(self, index, shard, parse_pool):
+        manager = self._managers[index]
+        for attempt in range(SHARD_RETRIES + 1):
+            try:
+                with self._imap_pool.connection(self._sources[index], check_health=attempt > 0) as imap:
+                    raw_messages = list(manager.fetch_raw_messages(shard, imap=imap))
+                break
+            except CONNECTION_ERRORS as e:
+                if attempt == SHARD_RETRIES:
+                    raise
+                LOG.warning("IMAP session for %s dropped while fetching (%s), retrying on a fresh connection", self._describe(index), e)
+                METRICS.increment("imap_reconnects_total")
+
+        if parse_pool:
+            header_parser = BytesHeaderParser()
+            parses = [manager._submit_parse(parse_pool, header_parser, raw_message) for raw_message in raw_messages]
+            maintenance_notifications = [maintenance_notification for parse in parses
+                                         for maintenance_notification in manager._extracted_notifications(manager._collect_parse_result(parse))]
+        else:
+            maintenance_notifications = list(manager._parse_messages(raw_messages))
+        return [manager.add_impact(maintenance_notification) for maintenance_notification in maintenance_notifications]
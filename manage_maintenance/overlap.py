@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import dateutil.parser
+
+
+MAINTENANCE_SUMMARY_PREFIX = "Scheduled Maintenance:"
+
+
+EventInterval = namedtuple("EventInterval", ("start", "end", "event_id", "summary", "cids"))
+
+
+def to_utc(value):
+    """Return an aware UTC datetime; naive datetimes are taken to be UTC already."""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _parse_event_time(event_time):
+    if event_time.get("dateTime"):
+        return to_utc(dateutil.parser.parse(event_time["dateTime"]))
+    # All-day events only have a date; their end date is exclusive
+    return datetime.strptime(event_time["date"], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+def event_cids(event):
+    """Return the CIDs a calendar event covers, from its private properties or its summary."""
+    cids = event.get("extendedProperties", {}).get("private", {}).get("cids")
+    if cids:
+        return tuple(cids.split(","))
+    summary = event.get("summary", "")
+    if summary.startswith(MAINTENANCE_SUMMARY_PREFIX) and summary.split():
+        return (summary.split()[-1],)
+    return ()
+
+
+def parse_event_interval(event):
+    """Parse a Calendar API event into an EventInterval, or None if it has no usable start and end."""
+    try:
+        start = _parse_event_time(event["start"])
+        end = _parse_event_time(event["end"])
+    except (KeyError, ValueError, OverflowError):
+        return None
+    return EventInterval(start, end, event["id"], event.get("summary", ""), event_cids(event))
+
+
+class OverlapIndex(object):
+    """Static interval index over calendar events for overlap detection and window queries.
+
+    Intervals are half-open ``[start, end)``, like Calendar API events, so back-to-back
+    maintenances don't overlap. Each event is parsed once when the index is built.
+    """
+
+    def __init__(self, events=()):
+        intervals = (parse_event_interval(event) for event in events)
+        self._intervals = sorted((interval for interval in intervals if interval), key=lambda interval: (interval.start, interval.end))
+        self._starts = [interval.start for interval in self._intervals]
+
+        # Running maximum of end times; non-decreasing, so it can be bisected
+        self._max_ends = []
+        for interval in self._intervals:
+            self._max_ends.append(max(self._max_ends[-1], interval.end) if self._max_ends else interval.end)
+
+        self._cid_index = {}
+        for interval in self._intervals:
+            for cid in interval.cids:
+                self._cid_index.setdefault(cid, []).append(interval)
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def find_overlap_groups(self):
+        """Return every group of mutually chained overlapping events once, with a sweep over start times."""
+        groups = []
+        group = []
+        group_end = None
+        for interval in self._intervals:
+            if group and interval.start < group_end:
+                group.append(interval)
+                group_end = max(group_end, interval.end)
+                continue
+            if len(group) > 1:
+                groups.append(group)
+            group = [interval]
+            group_end = interval.end
+        if len(group) > 1:
+            groups.append(group)
+        return groups
+
+    def overlapping(self, start_time, end_time, cids=None):
+        """Return the events overlapping a window, optionally only those covering one of ``cids``."""
+        start_time = to_utc(start_time)
+        end_time = to_utc(end_time)
+        if cids is not None:
+            candidates = {interval.event_id: interval for cid in cids for interval in self._cid_index.get(cid, ())}
+            return sorted((interval for interval in candidates.values() if interval.start < end_time and start_time < interval.end),
+                          key=lambda interval: (interval.start, interval.end))
+        # Intervals before `low` all end by start_time; intervals from `high` on start at or after end_time
+        low = bisect_right(self._max_ends, start_time)
+        high = bisect_left(self._starts, end_time)
+        return [interval for interval in self._intervals[low:high] if start_time < interval.end]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+from manage_maintenance.config import config
+
+
+LOG = logging.getLogger(__name__)
+
+
+# What the cache keeps of a MaintenanceNotification
+CachedMaintenance = namedtuple("CachedMaintenance", ("cid", "start_time", "end_time", "partner", "event_uuid", "reference", "cancelled"))
+
+
+# Bump when extraction changes in a way that makes cached results wrong
+CACHE_FORMAT_VERSION = 2
+
+DEFAULT_MAX_ENTRIES = 200000
+
+CACHE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# SQLite's default limit on host parameters is 999
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parse_results (
+    message_key TEXT NOT NULL,
+    pattern_source TEXT NOT NULL,
+    pattern_fingerprint TEXT NOT NULL,
+    maintenances TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (message_key, pattern_source)
+);
+CREATE INDEX IF NOT EXISTS parse_results_last_used ON parse_results (last_used);
+"""
+
+
+def pattern_source_fingerprints(notification_patterns):
+    """Return {pattern source: fingerprint}, where a source is a patterns file like ``ntt.yml``.
+
+    A fingerprint covers every pattern loaded from a source, so editing one file only
+    invalidates the cached results for that file.
+    """
+    configs_by_source = {}
+    for notification_pattern in notification_patterns:
+        configs_by_source.setdefault(notification_pattern.source, []).append(notification_pattern.config)
+    return {source: hashlib.sha1(json.dumps([CACHE_FORMAT_VERSION, pattern_configs], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+            for source, pattern_configs in configs_by_source.items()}
+
+
+def _to_cache_time(value):
+    # [naive time, UTC offset in seconds or None], so aware times from iCalendar parts come back aware
+    if isinstance(value, datetime):
+        offset = value.utcoffset()
+        return [value.replace(tzinfo=None).strftime(CACHE_TIME_FORMAT), offset.total_seconds() if offset is not None else None]
+    return [value.isoformat(), "date"]
+
+
+def _from_cache_time(stored):
+    value, offset = stored
+    if offset == "date":
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    value = datetime.strptime(value, CACHE_TIME_FORMAT)
+    if offset is not None:
+        value = value.replace(tzinfo=timezone(timedelta(seconds=offset)))
+    return value
+
+
+def message_id_key(message_id):
+    message_id = (message_id or "").strip()
+    return "message-id:{}".format(message_id) if message_id else None
+
+
+def content_key(raw_message):
+    return "sha1:{}".format(hashlib.sha1(raw_message).hexdigest())
+
+
+class ParseCache(object):
+    """SQLite cache of the maintenances extracted from each message, per patterns file.
+
+    Rows are keyed by a message key (its Message-ID, or a hash of its content when it has none)
+    and a pattern source, and only hold the compact fields of each maintenance (CID, start, end,
+    partner, event UUID, reference and whether it cancels), never the message body. A row only counts while its pattern
+    fingerprint matches the loaded patterns, so adding or editing a patterns file only leaves that
+    file's rows stale. The least recently used messages are evicted beyond ``max_entries`` rows.
+    """
+
+    def __init__(self, file_path, max_entries=DEFAULT_MAX_ENTRIES):
+        self._file_path = os.path.expanduser(file_path)
+        self._max_entries = max_entries
+        os.makedirs(os.path.dirname(self._file_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(self._file_path)
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, max_entries=DEFAULT_MAX_ENTRIES):
+        return cls(os.path.join(config.SCHEDULE_FILE_PATH, config.PARSE_CACHE_FILE_NAME), max_entries=max_entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM parse_results").fetchone()[0]
+
+    def get_many(self, message_keys, fingerprints):
+        """Return {message_key: {pattern source: [CachedMaintenance, ...]}} with the current rows of each message.
+
+        Rows for sources whose fingerprint changed are left out, as are messages with no current
+        rows at all; the caller decides whether what is left answers for the message.
+        """
+        message_keys = list(set(message_keys))
+        cached = {}
+        for offset in range(0, len(message_keys), QUERY_CHUNK_SIZE):
+            chunk = message_keys[offset:offset + QUERY_CHUNK_SIZE]
+            cursor = self._db.execute("SELECT message_key, pattern_source, pattern_fingerprint, maintenances FROM parse_results WHERE message_key IN ({})".format(
+                ", ".join("?" for _ in chunk)), chunk)
+            for message_key, pattern_source, pattern_fingerprint, maintenances in cursor:
+                if fingerprints.get(pattern_source) == pattern_fingerprint:
+                    cached.setdefault(message_key, {})[pattern_source] = [self._from_stored(maintenance) for maintenance in json.loads(maintenances)]
+        if cached:
+            self._touch(cached)
+        return cached
+
+    def get(self, message_key, fingerprints):
+        return self.get_many([message_key], fingerprints).get(message_key)
+
+    def _touch(self, message_keys):
+        now = time.time()
+        with self._db:
+            self._db.executemany("UPDATE parse_results SET last_used = ? WHERE message_key = ?", ((now, message_key) for message_key in message_keys))
+
+    def put_many(self, entries, fingerprints):
+        """Store (message_key, {pattern source: [maintenances]}) entries; sources left out are stored as having found nothing.
+
+        Maintenances can be MaintenanceNotifications or CachedMaintenances.
+        """
+        now = time.time()
+        rows = ((message_key, source, fingerprint, json.dumps([self._to_stored(maintenance) for maintenance in maintenances_by_source.get(source, ())]), now)
+                for message_key, maintenances_by_source in entries
+                for source, fingerprint in fingerprints.items())
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO parse_results (message_key, pattern_source, pattern_fingerprint, maintenances, last_used) "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used messages until at most max_entries rows are left; return the rows dropped."""
+        excess = len(self) - self._max_entries
+        if excess <= 0:
+            return 0
+        evicted_keys = []
+        evicted_rows = 0
+        cursor = self._db.execute("SELECT message_key, COUNT(*) FROM parse_results GROUP BY message_key ORDER BY MAX(last_used), message_key")
+        for message_key, rows in cursor:
+            if evicted_rows >= excess:
+                break
+            evicted_keys.append((message_key,))
+            evicted_rows += rows
+        cursor.close()
+        with self._db:
+            self._db.executemany("DELETE FROM parse_results WHERE message_key = ?", evicted_keys)
+        LOG.debug("Evicted %s parse cache rows", evicted_rows)
+        return evicted_rows
+
+    @staticmethod
+    def _to_stored(maintenance):
+        return [maintenance.cid, _to_cache_time(maintenance.start_time), _to_cache_time(maintenance.end_time), maintenance.partner, maintenance.event_uuid,
+                maintenance.reference, maintenance.cancelled]
+
+    @staticmethod
+    def _from_stored(stored):
+        cid, start_time, end_time, partner, event_uuid, reference, cancelled = stored
+        return CachedMaintenance(cid=cid, start_time=_from_cache_time(start_time), end_time=_from_cache_time(end_time), partner=partner, event_uuid=event_uuid,
+                                 reference=reference, cancelled=cancelled)
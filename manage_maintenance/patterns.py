@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import glob
+import os
+import re
+from email.utils import parseaddr
+
+import yaml
+
+from manage_maintenance.imap import literal_from_pattern, split_address_anchor
+from manage_maintenance.metrics import METRICS
+
+
+# MIME types maintenance details can be extracted from, in default order of preference
+DEFAULT_CONTENT_TYPES = ("text/calendar", "text/plain", "text/html")
+
+
+class NotificationPattern(object):
+    """A notification pattern from notification_patterns/*.yml with its regexes compiled once."""
+
+    def __init__(self, pattern_config, pattern_id, order=0):
+        self.config = pattern_config
+        self.pattern_id = pattern_id
+        self.order = order
+        self.partner_name = pattern_config["partner_name"]
+        self.email_domain_regex = self._compile(pattern_config.get("email_domain_pattern", None))
+        self.email_subject_regex = self._compile(pattern_config.get("email_subject_pattern", None))
+        self.cid_regex = self._compile(pattern_config["maintenance_cid_pattern"], re.IGNORECASE)
+        self.start_time_regex = self._compile(pattern_config["maintenance_start_time_pattern"], re.IGNORECASE)
+        self.end_time_regex = self._compile(pattern_config["maintenance_end_time_pattern"], re.IGNORECASE)
+        # Optional: the carrier's own reference for the maintenance, tying reschedules and cancellations to it
+        self.reference_regex = self._compile(pattern_config.get("maintenance_reference_pattern", None), re.IGNORECASE)
+        # Optional: marks a notice as cancelling the maintenance, searched in the subject and then the body
+        self.cancelled_regex = self._compile(pattern_config.get("maintenance_cancelled_pattern", None), re.IGNORECASE)
+        self.start_time_format = pattern_config.get("start_time_format", None)
+        self.end_time_format = pattern_config.get("end_time_format", None)
+        self.sender_domain = sender_domain_from_pattern(pattern_config.get("email_domain_pattern", None))
+
+        # Part types the pattern declares are searched first, then the remaining defaults
+        declared_content_types = tuple(pattern_config.get("content_types", None) or ())
+        self.content_types = declared_content_types + tuple(content_type for content_type in DEFAULT_CONTENT_TYPES if content_type not in declared_content_types)
+
+        # Match statistics
+        self.candidates = 0
+        self.header_matches = 0
+        self.extractions = 0
+        self.incomplete_extractions = 0
+
+    @property
+    def source(self):
+        """The patterns file (or inline source) the pattern was loaded from, e.g. ``ntt.yml``."""
+        return self.pattern_id.rpartition("#")[0]
+
+    @staticmethod
+    def _compile(pattern, flags=0):
+        return re.compile(pattern, flags) if pattern else None
+
+    def matches_headers(self, msg_from, msg_subject):
+        if self.email_domain_regex and not self.email_domain_regex.search(msg_from):
+            return False
+        if self.email_subject_regex and not self.email_subject_regex.search(msg_subject):
+            return False
+        return True
+
+    def statistics(self):
+        return {
+            "pattern_id": self.pattern_id,
+            "partner_name": self.partner_name,
+            "candidates": self.candidates,
+            "header_matches": self.header_matches,
+            "extractions": self.extractions,
+            "incomplete_extractions": self.incomplete_extractions,
+        }
+
+
+def sender_domain_from_pattern(email_domain_pattern):
+    """Return the lowercase sender domain a pattern is anchored to, or None if it can't be indexed.
+
+    Only literals pinned to the whole domain index: they must start at ``@`` or a dot and end at the
+    end of the address (see split_address_anchor). ``no-reply@level3\\.com>?$`` and ``\\.level3\\.com$``
+    both index under ``level3.com``; ``no-reply@level3\\.co`` also matches ``level3.com`` senders, so it doesn't.
+    """
+    if not email_domain_pattern:
+        return None
+    pattern, anchored = split_address_anchor(email_domain_pattern)
+    literal = literal_from_pattern(pattern) if anchored else None
+    if not literal or ("@" not in literal and not literal.startswith(".")):
+        return None
+    domain = literal.rpartition("@")[2].lstrip(".").lower()
+    if "." not in domain or any(character.isspace() or character in "<>\"" for character in domain):
+        return None
+    return domain
+
+
+def sender_domain(msg_from):
+    return parseaddr(msg_from)[1].rpartition("@")[2].lower()
+
+
+class NotificationPatternEngine(object):
+    """Compiled notification patterns indexed by sender domain.
+
+    A message's sender domain (and each of its parent domains) is looked up in the index, so it is
+    only checked against patterns for that sender plus the patterns whose sender can only be
+    expressed as a regex. The compiled regexes still decide the match.
+    """
+
+    def __init__(self, pattern_configs=(), source="inline"):
+        self._patterns = []
+        self._domain_index = {}
+        self._fallback_patterns = []
+        for index, pattern_config in enumerate(pattern_configs):
+            self.add(pattern_config, pattern_id="{}#{}".format(source, index))
+
+    @classmethod
+    def from_directory(cls, patterns_glob):
+        engine = cls()
+        for file_path in sorted(glob.glob(patterns_glob)):
+            with open(file_path) as f:
+                pattern_configs = yaml.safe_load(f) or []
+            for index, pattern_config in enumerate(pattern_configs):
+                engine.add(pattern_config, pattern_id="{}#{}".format(os.path.basename(file_path), index))
+        return engine
+
+    def add(self, pattern_config, pattern_id):
+        notification_pattern = NotificationPattern(pattern_config, pattern_id=pattern_id, order=len(self._patterns))
+        self._patterns.append(notification_pattern)
+        if notification_pattern.sender_domain:
+            self._domain_index.setdefault(notification_pattern.sender_domain, []).append(notification_pattern)
+        else:
+            self._fallback_patterns.append(notification_pattern)
+        return notification_pattern
+
+    def __iter__(self):
+        return iter(self._patterns)
+
+    def __len__(self):
+        return len(self._patterns)
+
+    @property
+    def pattern_configs(self):
+        return [notification_pattern.config for notification_pattern in self._patterns]
+
+    def candidates(self, msg_from):
+        """Return the patterns that could match a sender, in load order."""
+        domain = sender_domain(msg_from)
+        candidates = []
+        labels = domain.split(".")
+        for offset in range(len(labels)):
+            candidates.extend(self._domain_index.get(".".join(labels[offset:]), ()))
+        if not candidates:
+            return list(self._fallback_patterns)
+        candidates.extend(self._fallback_patterns)
+        candidates.sort(key=lambda notification_pattern: notification_pattern.order)
+        return candidates
+
+    def match(self, msg_from, msg_subject):
+        """Return the patterns whose sender and subject regexes match a message, in load order."""
+        matches = []
+        with METRICS.timer("header_match_seconds"):
+            for notification_pattern in self.candidates(msg_from):
+                notification_pattern.candidates += 1
+                if notification_pattern.matches_headers(msg_from, msg_subject):
+                    notification_pattern.header_matches += 1
+                    METRICS.increment("pattern_header_matches_total", partner=notification_pattern.partner_name)
+                    matches.append(notification_pattern)
+                else:
+                    METRICS.increment("pattern_header_misses_total", partner=notification_pattern.partner_name)
+        if not matches:
+            METRICS.increment("messages_unmatched_total")
+        return matches
+
+    def matches_any(self, msg_from, msg_subject, sources=None):
+        """Return whether any pattern (only those loaded from ``sources``, if given) matches a message's headers.
+
+        Unlike match(), this doesn't count towards the statistics, so it can screen messages that
+        are matched again when parsed.
+        """
+        return any(notification_pattern.matches_headers(msg_from, msg_subject) for notification_pattern in self.candidates(msg_from)
+                   if sources is None or notification_pattern.source in sources)
+
+    def match_statistics(self):
+        """Return per-pattern counters, hottest first; patterns with no header matches are dead weight."""
+        return sorted((notification_pattern.statistics() for notification_pattern in self._patterns),
+                      key=lambda statistics: (-statistics["header_matches"], statistics["pattern_id"]))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesHeaderParser
+
+from manage_maintenance.config import MAX_BATCH_SIZE
+from manage_maintenance.imap import DEFAULT_FETCH_CHUNK_SIZE
+from manage_maintenance.manage import writes_hold_checkpoint
+
+
+LOG = logging.getLogger(__name__)
+
+
+DEFAULT_QUEUE_SIZE = 1000
+
+# Marks the end of a queue's input; each consumer gets one
+_DONE = object()
+
+
+class MaintenancePipeline(object):
+    """Runs fetch, parse and calendar stages concurrently, connected by bounded queues.
+
+    Each stage has its own workers, so IMAP fetches overlap parsing and calendar writes and a run
+    takes as long as its slowest stage rather than the sum of all of them. Full queues make faster
+    stages wait (backpressure), which bounds memory to roughly ``queue_size`` messages plus one
+    fetch chunk per fetch worker.
+
+    - fetch: ``fetch_workers`` IMAP connections (the manager's own plus extra ones) each fetch
+      chunks of ``fetch_chunk_size`` UIDs in a thread.
+    - parse: ``parse_workers`` tasks; with more than one, message bodies are parsed in the
+      manager's process pool, otherwise in a thread.
+    - sink: ``sink_workers`` tasks, each handing whatever is queued (up to ``sink_batch_size``
+      notifications) to ``sink`` in a thread. The default sink is the manager's batched calendar
+      insert; a sink used with more than one sink worker must be thread-safe.
+
+    ``stop()`` stops fetching new chunks and lets the messages already fetched drain through the
+    parse and sink stages. The IMAP checkpoint is only advanced when every message was processed
+    and no write the sink reports (as results with a ``status``) failed transiently (see
+    writes_hold_checkpoint); after a stop or such a failure the next run re-reads the rest,
+    which is safe because calendar event IDs are derived from the maintenance itself.
+    """
+
+    def __init__(self, manager, sink=None, fetch_workers=1, parse_workers=1, sink_workers=1, queue_size=DEFAULT_QUEUE_SIZE,
+                 fetch_chunk_size=DEFAULT_FETCH_CHUNK_SIZE, sink_batch_size=MAX_BATCH_SIZE):
+        for name, value in (("fetch_workers", fetch_workers), ("parse_workers", parse_workers), ("sink_workers", sink_workers),
+                            ("queue_size", queue_size), ("fetch_chunk_size", fetch_chunk_size), ("sink_batch_size", sink_batch_size)):
+            if value < 1:
+                raise ValueError("{} must be at least 1, got {}".format(name, value))
+        self._manager = manager
+        self._sink = sink or manager.add_maintenances_to_calendar
+        self._fetch_workers = fetch_workers
+        self._parse_workers = parse_workers
+        self._sink_workers = sink_workers
+        self._queue_size = queue_size
+        self._fetch_chunk_size = fetch_chunk_size
+        self._sink_batch_size = sink_batch_size
+        self._stopping = False
+        self.results = []
+
+    @property
+    def stopping(self):
+        return self._stopping
+
+    def stop(self):
+        """Stop fetching and drain what has been fetched already."""
+        LOG.info("Stopping maintenance pipeline, draining fetched messages")
+        self._stopping = True
+
+    def run(self, since=None):
+        """Run the pipeline on a new event loop and return the sink results."""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_async(since=since))
+        finally:
+            loop.close()
+
+    async def run_async(self, since=None):
+        """Process every message that arrived since the last checkpoint and return the sink results."""
+        loop = asyncio.get_event_loop()
+        self.results = []
+        with ThreadPoolExecutor(max_workers=self._fetch_workers + self._sink_workers + 1) as threads:
+            checkpoint_key, email_ids = await loop.run_in_executor(threads, self._manager.list_new_message_ids, since)
+            chunks = [email_ids[offset:offset + self._fetch_chunk_size] for offset in range(0, len(email_ids), self._fetch_chunk_size)]
+            chunks.reverse()    # Popped from the end, so fetched in mailbox order
+            raw_messages = asyncio.Queue(maxsize=self._queue_size)
+            notifications = asyncio.Queue(maxsize=self._queue_size)
+
+            parse_pool = self._manager.parse_pool(max_workers=self._parse_workers) if self._parse_workers > 1 else None
+            try:
+                fetchers = [self._fetch(loop, threads, chunks, raw_messages, primary=(number == 0)) for number in range(min(self._fetch_workers, len(chunks)) or 1)]
+                parsers = [self._parse(loop, threads, parse_pool, raw_messages, notifications) for _ in range(self._parse_workers)]
+                sinks = [self._write(loop, threads, notifications) for _ in range(self._sink_workers)]
+                stages = [self._stage(fetchers, raw_messages, self._parse_workers),
+                          self._stage(parsers, notifications, self._sink_workers),
+                          self._stage(sinks)]
+                await self._gather(stages)
+            finally:
+                if parse_pool:
+                    parse_pool.shutdown(wait=True)
+
+            if self._stopping and chunks:
+                LOG.info("Pipeline stopped with %s chunks unfetched, not advancing the IMAP checkpoint", len(chunks))
+            elif not writes_hold_checkpoint(self.results):
+                await loop.run_in_executor(threads, self._manager.checkpoint_message_ids, checkpoint_key, email_ids)
+        return self.results
+
+    async def _stage(self, workers, output=None, consumers=0):
+        # Run a stage's workers to completion, then tell each consumer of its output queue
+        await self._gather(workers)
+        for _ in range(consumers):
+            await output.put(_DONE)
+
+    @staticmethod
+    async def _gather(coroutines):
+        # Like asyncio.gather, but a failure cancels the other coroutines instead of leaving them running
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _fetch(self, loop, threads, chunks, raw_messages, primary):
+        imap = None if primary else await loop.run_in_executor(threads, self._manager.open_imap_folder)
+        try:
+            while chunks and not self._stopping:
+                chunk = chunks.pop()
+                for raw_message in await loop.run_in_executor(threads, lambda: list(self._manager.fetch_raw_messages(chunk, imap=imap))):
+                    await raw_messages.put(raw_message)
+        finally:
+            if imap:
+                await loop.run_in_executor(threads, imap.logout)
+
+    async def _parse(self, loop, threads, parse_pool, raw_messages, notifications):
+        header_parser = BytesHeaderParser()
+        while True:
+            raw_message = await raw_messages.get()
+            if raw_message is _DONE:
+                return
+            if parse_pool:
+                parse = self._manager._submit_parse(parse_pool, header_parser, raw_message)
+                if not parse:
+                    continue
+                await asyncio.wrap_future(parse[1])
+                maintenance_notifications = self._manager._extracted_notifications(self._manager._collect_parse_result(parse))
+            else:
+                maintenance_notifications = await loop.run_in_executor(threads, self._manager.parse_raw_message, raw_message)
+            for maintenance_notification in maintenance_notifications:
+                await notifications.put(self._manager.add_impact(maintenance_notification))
+
+    async def _write(self, loop, threads, notifications):
+        while True:
+            batch = []
+            maintenance_notification = await notifications.get()
+            # Take whatever else is queued; batches grow on their own when the sink is the bottleneck
+            while maintenance_notification is not _DONE:
+                batch.append(maintenance_notification)
+                if len(batch) >= self._sink_batch_size or notifications.empty():
+                    break
+                maintenance_notification = notifications.get_nowait()
+            if batch:
+                results = await loop.run_in_executor(threads, self._sink, batch)
+                self.results.extend(results or ())
+            if maintenance_notification is _DONE:
+                return
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+"""Replay mail archives through the notification patterns and print what they match and miss.
+
+Nothing is written to the calendar or the schedule, and no mail server is involved, so a new
+notification_patterns/*.yml file can be tried against years of archived notices:
+
+    python -m manage_maintenance.replay archive.mbox Maildir/ --patterns "notification_patterns/new.yml"
+"""
+import argparse
+import logging
+import sys
+import time
+from collections import Counter
+
+from manage_maintenance.archive import ArchiveMessageSource
+from manage_maintenance.manage import DEFAULT_NOTIFICATION_PATTERNS_GLOB, ManageMaintenance
+from manage_maintenance.metrics import METRICS
+
+
+def replay(paths, notification_patterns_glob=DEFAULT_NOTIFICATION_PATTERNS_GLOB, parse_workers=0):
+    """Parse every message of the archives and return the replay statistics.
+
+    Messages are screened on their headers first, so only the ones a pattern matches are parsed.
+    """
+    # The screening and header-matching counters tell the messages no pattern matched apart
+    metrics_enabled = METRICS.enabled
+    METRICS.enable()
+    missed_before = METRICS.counter_value("screened_out_messages_total") + METRICS.counter_value("messages_unmatched_total")
+    started = time.monotonic()
+    try:
+        with ArchiveMessageSource(paths) as message_source:
+            manager = ManageMaintenance(imap_username=None, imap_password=None, imap_address=None, imap_folder=None, parse_workers=parse_workers,
+                                        header_first_fetch=True, message_source=message_source, notification_patterns_glob=notification_patterns_glob)
+            maintenances_by_partner = Counter(maintenance_notification.partner for maintenance_notification in manager.list_maintenances())
+            messages = len(message_source.list_message_ids())
+        seconds = time.monotonic() - started
+        missed = METRICS.counter_value("screened_out_messages_total") + METRICS.counter_value("messages_unmatched_total") - missed_before
+    finally:
+        if not metrics_enabled:
+            METRICS.disable()
+    return {
+        "messages": messages,
+        "matched_messages": messages - missed,
+        "missed_messages": missed,
+        "maintenances": sum(maintenances_by_partner.values()),
+        "maintenances_by_partner": dict(maintenances_by_partner),
+        "seconds": seconds,
+        "messages_per_minute": messages * 60 / seconds if seconds else None,
+        "patterns": manager.notification_pattern_statistics(),
+    }
+
+
+def format_statistics(statistics):
+    lines = [
+        "{messages} messages in {seconds:.1f}s ({rate} messages/minute)".format(
+            rate="{:,.0f}".format(statistics["messages_per_minute"]) if statistics["messages_per_minute"] else "-", **statistics),
+        "{matched_messages} matched a pattern, {missed_messages} matched none".format(**statistics),
+        "{} maintenances: {}".format(statistics["maintenances"], ", ".join(
+            "{} {}".format(partner, count) for partner, count in sorted(statistics["maintenances_by_partner"].items())) or "-"),
+        "",
+        "{:<24} {:<16} {:>14} {:>12} {:>11}".format("pattern", "partner", "header matches", "extractions", "incomplete"),
+    ]
+    for pattern_statistics in statistics["patterns"]:
+        lines.append("{pattern_id:<24} {partner_name:<16} {header_matches:>14} {extractions:>12} {incomplete_extractions:>11}".format(**pattern_statistics))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("paths", nargs="+", help="mbox files, Maildir directories, .eml files or directories of .eml files")
+    parser.add_argument("--patterns", default=DEFAULT_NOTIFICATION_PATTERNS_GLOB, help="glob of notification pattern files (default: notification_patterns/*.yml)")
+    parser.add_argument("--parse-workers", type=int, default=0, help="parse in a pool of this many processes")
+    args = parser.parse_args(argv)
+    print(format_statistics(replay(args.paths, notification_patterns_glob=args.patterns, parse_workers=args.parse_workers)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import json
+import logging
+import random
+import socket
+import threading
+import time
+
+from apiclient import errors
+
+from manage_maintenance.metrics import METRICS
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Calendar API quota units per second and burst; a batch request costs one unit per call in it
+DEFAULT_REQUESTS_PER_SECOND = 50
+DEFAULT_BURST = 100
+
+# Concurrent API requests: where AIMD starts, and its bounds
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 16
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 32.0
+
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# 403 reasons that mean "slow down" rather than "forbidden"
+RATE_LIMIT_REASONS = frozenset(("rateLimitExceeded", "userRateLimitExceeded"))
+
+RETRYABLE_EXCEPTIONS = (ConnectionError, socket.timeout)
+
+
+def http_error_reason(error):
+    """Return the first error reason of an HttpError's JSON body (e.g. "rateLimitExceeded"), or None."""
+    try:
+        content = json.loads(error.content.decode("utf-8") if isinstance(error.content, bytes) else error.content)
+        return content["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def is_throttled(error):
+    """Whether an API error means the quota or the server asked us to slow down."""
+    if not isinstance(error, errors.HttpError):
+        return False
+    return error.resp.status == 429 or (error.resp.status == 403 and http_error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    """Whether a failed request may succeed if sent again later."""
+    if isinstance(error, errors.HttpError):
+        return error.resp.status in RETRYABLE_STATUSES or is_throttled(error)
+    return isinstance(error, RETRYABLE_EXCEPTIONS)
+
+
+class TokenBucket(object):
+    """Hands out ``rate`` tokens a second, up to ``capacity`` at once; callers block until theirs are available."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or capacity < 1:
+            raise ValueError("rate must be positive and capacity at least 1, got {} and {}".format(rate, capacity))
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take ``tokens`` (at most ``capacity``, so a large batch doesn't wait forever) and return the seconds waited."""
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            self._sleep(delay)
+            waited += delay
+
+
+class AIMDLimiter(object):
+    """Bounds concurrent requests by a limit that grows by one per limit's worth of successes and halves on throttling."""
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, minimum=1, maximum=DEFAULT_MAX_CONCURRENCY, decrease=0.5):
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("Need 1 <= minimum <= initial <= maximum, got {}, {}, {}".format(minimum, initial, maximum))
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self._decrease = decrease
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def succeeded(self):
+        with self._condition:
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if int(self.limit) > previous:
+                self._condition.notify()
+
+    def throttled(self):
+        with self._condition:
+            self.limit = max(self.minimum, self.limit * self._decrease)
+
+
+class RequestScheduler(object):
+    """Runs Calendar API requests within the quota, adapting concurrency and retrying transient failures.
+
+    Each request first takes its cost in quota units from a token bucket (``requests_per_second``
+    of None disables it), then a slot from an AIMD limiter. Throttling responses (429, or 403
+    rateLimitExceeded) halve the concurrency limit; successes grow it back. Retryable failures
+    (throttling, 5xx, dropped connections) are retried up to ``max_retries`` times after a
+    jittered exponential delay, or the server's Retry-After if longer.
+    """
+
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_BURST, limiter=None, max_retries=DEFAULT_MAX_RETRIES,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, sleep=time.sleep, rng=None):
+        self._sleep = sleep
+        self.token_bucket = TokenBucket(requests_per_second, burst, sleep=sleep) if requests_per_second else None
+        self.limiter = limiter or AIMDLimiter()
+        self.max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._rng = rng or random.Random()
+
+    def backoff(self, attempt, error=None):
+        """Sleep before retry number ``attempt`` (from 0) and return the delay."""
+        delay = self._rng.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+        retry_after = error.resp.get("retry-after") if isinstance(error, errors.HttpError) else None
+        if retry_after:
+            try:
+                delay = max(delay, min(self._max_delay, float(retry_after)))
+            except ValueError:
+                pass
+        self._sleep(delay)
+        return delay
+
+    def call(self, function, method, cost=1):
+        """Call ``function()`` once within the quota and concurrency limit, recording the outcome."""
+        if self.token_bucket:
+            waited = self.token_bucket.acquire(cost)
+            if waited:
+                METRICS.observe("calendar_api_quota_wait_seconds", waited, method=method)
+        self.limiter.acquire()
+        try:
+            with METRICS.timer("calendar_api_call_seconds", method=method):
+                result = function()
+        except Exception as e:
+            if is_throttled(e):
+                self.limiter.throttled()
+                METRICS.increment("calendar_api_throttled_total", method=method)
+            if isinstance(e, errors.HttpError):
+                METRICS.increment("calendar_api_errors_total", method=method, status=e.resp.status)
+            raise
+        finally:
+            self.limiter.release()
+        self.limiter.succeeded()
+        return result
+
+    def execute(self, request, method, cost=1):
+        """Execute a request, retrying retryable failures; the last failure is raised."""
+        attempt = 0
+        while True:
+            try:
+                return self.call(request.execute, method, cost=cost)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                METRICS.increment("calendar_api_retries_total", method=method)
+                delay = self.backoff(attempt, e)
+                LOG.warning("Calendar API %s failed (%s), retrying in %.1f seconds", method, e, delay)
+                attempt += 1
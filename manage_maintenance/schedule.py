@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+from datetime import datetime, timezone
+
+from tinydb import TinyDB
+
+from manage_maintenance.config import config
+
+
+LOG = logging.getLogger(__name__)
+
+
+SCHEDULE_COLUMNS = ("event_uuid", "subject", "start_time", "end_time", "cid", "partner", "original_message", "affected_devices", "reference", "cancelled", "sent_time")
+
+# Maintenances written to the calendar, and those published as iCalendar feeds. Each sink keeps its
+# own rows, so a maintenance published to the feeds is still created in the calendar later
+CALENDAR_TABLE = "maintenances"
+FEED_TABLE = "feed_maintenances"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    event_uuid TEXT PRIMARY KEY,
+    subject TEXT,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    partner TEXT,
+    original_message TEXT,
+    affected_devices TEXT,
+    reference TEXT,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    sent_time TEXT
+);
+CREATE INDEX IF NOT EXISTS {table}_cid ON {table} (cid);
+CREATE INDEX IF NOT EXISTS {table}_partner ON {table} (partner);
+CREATE INDEX IF NOT EXISTS {table}_window ON {table} (start_time, end_time);
+"""
+
+DB_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def to_db_time(value):
+    """Store times as sortable naive UTC ISO strings."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.strftime(DB_TIME_FORMAT)
+    return value
+
+
+def from_db_time(value):
+    try:
+        return datetime.strptime(value, DB_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return value
+
+
+class ScheduleStore(object):
+    """SQLite store of maintenance notifications, one row per event UUID, in the table of a sink."""
+
+    def __init__(self, file_path, table=CALENDAR_TABLE):
+        self._file_path = os.path.expanduser(file_path)
+        self._table = table
+        os.makedirs(os.path.dirname(self._file_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(self._file_path)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA.format(table=table))
+        self._upgrade_schema()
+
+    def _upgrade_schema(self):
+        # Add columns introduced after a schedule file was created
+        existing_columns = set(row["name"] for row in self._db.execute("PRAGMA table_info({})".format(self._table)))
+        with self._db:
+            if "affected_devices" not in existing_columns:
+                self._db.execute("ALTER TABLE {} ADD COLUMN affected_devices TEXT".format(self._table))
+            if "reference" not in existing_columns:
+                self._db.execute("ALTER TABLE {} ADD COLUMN reference TEXT".format(self._table))
+                self._db.execute("ALTER TABLE {} ADD COLUMN cancelled INTEGER NOT NULL DEFAULT 0".format(self._table))
+                self._db.execute("ALTER TABLE {} ADD COLUMN sent_time TEXT".format(self._table))
+            self._db.execute("CREATE INDEX IF NOT EXISTS {table}_reference ON {table} (partner, reference, cid)".format(table=self._table))
+
+    @classmethod
+    def from_config(cls, table=CALENDAR_TABLE):
+        return cls(os.path.join(config.SCHEDULE_FILE_PATH, config.SCHEDULE_DB_FILE_NAME), table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def upsert(self, maintenance):
+        self.upsert_many([maintenance])
+
+    def upsert_many(self, maintenances):
+        """Insert or replace many maintenances (notifications or dicts) in a single transaction."""
+        rows = (self._to_row(maintenance) for maintenance in maintenances)
+        with self._db:
+            cursor = self._db.executemany("INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+                self._table, ", ".join(SCHEDULE_COLUMNS), ", ".join("?" for _ in SCHEDULE_COLUMNS)), rows)
+        return cursor.rowcount
+
+    @staticmethod
+    def _to_row(maintenance):
+        if not isinstance(maintenance, dict):
+            maintenance = maintenance._asdict()
+        row = []
+        for column in SCHEDULE_COLUMNS:
+            value = maintenance.get(column)
+            if column in ("start_time", "end_time", "sent_time"):
+                value = to_db_time(value)
+            elif column == "cancelled":
+                value = int(bool(value))
+            elif column == "affected_devices":
+                value = json.dumps([list(device) for device in value or ()])
+            row.append(value)
+        return tuple(row)
+
+    @staticmethod
+    def _from_row(row):
+        maintenance = dict(row)
+        maintenance["start_time"] = from_db_time(maintenance["start_time"])
+        maintenance["end_time"] = from_db_time(maintenance["end_time"])
+        maintenance["sent_time"] = from_db_time(maintenance["sent_time"])
+        maintenance["cancelled"] = bool(maintenance["cancelled"])
+        maintenance["affected_devices"] = tuple(tuple(device) for device in json.loads(maintenance["affected_devices"] or "[]"))
+        return maintenance
+
+    def _query(self, where="", parameters=()):
+        cursor = self._db.execute("SELECT * FROM {} {} ORDER BY start_time, end_time, event_uuid".format(self._table, where), parameters)
+        return [self._from_row(row) for row in cursor]
+
+    def get(self, event_uuid):
+        rows = self._query("WHERE event_uuid = ?", (event_uuid,))
+        return rows[0] if rows else None
+
+    def all(self):
+        return self._query()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM {}".format(self._table)).fetchone()[0]
+
+    def find_by_reference(self, partner, reference, cid):
+        """Return the row of a carrier's maintenance reference for a CID, cancelled or not."""
+        rows = self._query("WHERE partner = ? AND reference = ? AND cid = ?", (partner, reference, cid))
+        return rows[-1] if rows else None
+
+    # Cancelled maintenances keep their row (so older notices can't revive them) but aren't scheduled
+
+    def active_between(self, start_time, end_time):
+        """Return the maintenances whose window overlaps [start_time, end_time)."""
+        return self._query("WHERE start_time < ? AND end_time > ? AND NOT cancelled", (to_db_time(end_time), to_db_time(start_time)))
+
+    def windows_for_cid(self, cid):
+        return self._query("WHERE cid = ? AND NOT cancelled", (cid,))
+
+    def for_partner(self, partner):
+        return self._query("WHERE partner = ? AND NOT cancelled", (partner,))
+
+
+def migrate_from_tinydb(tinydb_file_path, schedule_store):
+    """Copy every row of a TinyDB schedule file into a ScheduleStore and return the number of rows."""
+    tinydb_file_path = os.path.expanduser(tinydb_file_path)
+    if not os.path.exists(tinydb_file_path):
+        raise FileNotFoundError("No TinyDB schedule file at '{}'".format(tinydb_file_path))
+    with TinyDB(tinydb_file_path) as db:
+        rows = db.all()
+    maintenances = []
+    for row in rows:
+        maintenance = {column: row.get(column) for column in SCHEDULE_COLUMNS}
+        if not maintenance["event_uuid"]:
+            # Same scheme as ManageMaintenance._generate_maintenance_uuid; TinyDB rows hold ISO strings
+            maintenance["event_uuid"] = hashlib.sha1(bytes("{}{}{}".format(row["cid"], row["start_time"], row["end_time"]), "utf-8")).hexdigest()
+        maintenances.append(maintenance)
+    schedule_store.upsert_many(maintenances)
+    LOG.info("Migrated %s rows from '%s'", len(maintenances), tinydb_file_path)
+    return len(maintenances)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    tinydb_file_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(config.SCHEDULE_FILE_PATH, config.SCHEDULE_FILE_NAME)
+    with ScheduleStore.from_config() as schedule_store:
+        migrate_from_tinydb(tinydb_file_path, schedule_store)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+from email.parser import BytesHeaderParser
+
+
+class MessageSource(object):
+    """Where ManageMaintenance.list_maintenances reads raw messages from.
+
+    Message IDs are opaque to ManageMaintenance, but must be hashable and listed in mailbox order.
+    Sources hand out raw RFC822 bytes lazily, so a run never holds more than a chunk of messages.
+    """
+
+    def list_message_ids(self, since=None):
+        """Return the IDs of the messages not processed yet; ``since`` ("1-Oct-2017") may bound the first run."""
+        raise NotImplementedError
+
+    def fetch_raw_messages(self, message_ids):
+        """Yield (message_id, raw RFC822 bytes) for messages, in order, skipping any that are gone."""
+        raise NotImplementedError
+
+    def fetch_screening_headers(self, message_ids):
+        """Return {message_id: headers} with at least the From, Subject, Message-ID and Date of messages."""
+        header_parser = BytesHeaderParser()
+        return {message_id: header_parser.parsebytes(raw_message) for message_id, raw_message in self.fetch_raw_messages(message_ids)}
+
+    def checkpoint(self, message_ids):
+        """Record messages as processed, once every maintenance in them has been yielded."""
+        return
+
+    def close(self):
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class IMAPMessageSource(MessageSource):
+    """The messages of a ManageMaintenance's IMAP folder, by UID, checkpointed by highest UID.
+
+    Uses ``imap`` if given or the manager's main connection otherwise.
+    """
+
+    def __init__(self, manager, imap=None):
+        self._manager = manager
+        self._imap = imap
+        self._checkpoint_key = None
+
+    def list_message_ids(self, since=None):
+        self._checkpoint_key, email_ids = self._manager.list_new_message_ids(since=since, imap=self._imap)
+        return [int(email_id) for email_id in email_ids]
+
+    def fetch_raw_messages(self, message_ids):
+        return self._manager.fetch_uid_raw_messages(message_ids, imap=self._imap)
+
+    def fetch_screening_headers(self, message_ids):
+        return self._manager.fetch_screening_headers(message_ids, imap=self._imap)
+
+    def checkpoint(self, message_ids):
+        self._manager.checkpoint_message_ids(self._checkpoint_key, message_ids, uidvalidity=self._imap.uidvalidity if self._imap else None)
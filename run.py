@@ -2,8 +2,18 @@
 # Copyright 2017 Netflix
 import logging
 import os
+import signal
+from collections import Counter
 
+from manage_maintenance.config import config
+from manage_maintenance.feed import ICSFeedPublisher
+from manage_maintenance.imap_pool import DEFAULT_MAX_CONNECTIONS, load_mailbox_sources
+from manage_maintenance.inventory import CircuitInventory
 from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.metrics import METRICS
+from manage_maintenance.multi_source import MultiSourceMaintenance
+from manage_maintenance.parse_cache import DEFAULT_MAX_ENTRIES, ParseCache
+from manage_maintenance.pipeline import MaintenancePipeline
 
 
 MAILBOX_FOLDER = "_OpenConnect/NetOps"
@@ -26,14 +36,102 @@ def load_config_options_from_env():
     return imap_address, imap_folder, notification_patterns_folder
 
 
+def load_circuit_inventory():
+    circuit_inventory_csv = os.getenv("CIRCUIT_INVENTORY_CSV", None)
+    if not circuit_inventory_csv:
+        return None
+    index_path = os.path.join(os.path.expanduser(config.SCHEDULE_FILE_PATH), config.CIRCUIT_INVENTORY_INDEX_FILE_NAME)
+    return CircuitInventory.open(circuit_inventory_csv, index_path)
+
+
+def load_parse_cache():
+    if not os.getenv("PARSE_CACHE", None):
+        return None
+    return ParseCache.from_config(max_entries=int(os.getenv("PARSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)))
+
+
+def writes_to_calendar():
+    # Without the pipeline, ICS_FEED_DIR publishes feeds instead of writing to the calendar
+    return bool(os.getenv("PIPELINE", None)) or not os.getenv("ICS_FEED_DIR", None)
+
+
+def load_google_calendar():
+    # Imported here so runs that don't write to the calendar never load the Google API client
+    from manage_maintenance.google_calendar import GoogleCalendar
+    from manage_maintenance.request_scheduler import DEFAULT_MAX_RETRIES, DEFAULT_REQUESTS_PER_SECOND, RequestScheduler
+    scheduler = RequestScheduler(requests_per_second=float(os.getenv("CALENDAR_REQUESTS_PER_SECOND", DEFAULT_REQUESTS_PER_SECOND)),
+                                 max_retries=int(os.getenv("CALENDAR_MAX_RETRIES", DEFAULT_MAX_RETRIES)))
+    return GoogleCalendar(scheduler=scheduler)
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
-    username, password = load_creds()
-    imap_address = 'imap.gmail.com'
-    manager = ManageMaintenance(imap_username=username, imap_password=password, imap_address=imap_address, imap_folder=MAILBOX_FOLDER)
-    for maintenance_notification in manager.list_maintenances(since="1-Oct-2017"):
+    parse_workers = int(os.getenv("PARSE_WORKERS", 0))
+    metrics_json_file = os.getenv("METRICS_JSON_FILE", None)
+    metrics_prometheus_file = os.getenv("METRICS_PROMETHEUS_FILE", None)
+    if metrics_json_file or metrics_prometheus_file:
+        METRICS.enable()
+    mailbox_sources_file = os.getenv("MAILBOX_SOURCES_FILE", None)
+    if mailbox_sources_file:
+        results = run_multi_source(mailbox_sources_file, parse_workers)
+    else:
+        username, password = load_creds()
+        imap_address = 'imap.gmail.com'
+        manager = ManageMaintenance(imap_username=username, imap_password=password, imap_address=imap_address, imap_folder=MAILBOX_FOLDER, parse_workers=parse_workers,
+                                    circuit_inventory=load_circuit_inventory(), parse_cache=load_parse_cache(), header_first_fetch=bool(os.getenv("HEADER_FIRST_FETCH", None)),
+                                    google_calendar=load_google_calendar() if writes_to_calendar() else None)
+        if os.getenv("PIPELINE", None):
+            results = run_pipeline(manager, parse_workers=max(parse_workers, 1))
+        else:
+            results = write_maintenances(manager)
+    LOG.info("{} writes: {}".format("Feed" if os.getenv("ICS_FEED_DIR", None) else "Calendar", dict(Counter(result.status for result in results))))
+    if metrics_json_file:
+        METRICS.write_json(metrics_json_file)
+    if metrics_prometheus_file:
+        METRICS.write_prometheus_file(metrics_prometheus_file)
+
+
+def write_maintenances(manager):
+    # The checkpoint waits until every write is flushed, and stays put if one failed so the next run retries it
+    maintenance_notifications = log_maintenances(manager.list_maintenances(since="1-Oct-2017", defer_checkpoint=True))
+    if os.getenv("ICS_FEED_DIR", None):
+        results = manager.add_maintenances_to_feed(maintenance_notifications, ICSFeedPublisher(os.getenv("ICS_FEED_DIR")))
+    elif os.getenv("COALESCE", None):
+        manager.replay_failed_calendar_writes()
+        results = manager.sync_maintenances_to_calendar(maintenance_notifications)
+    else:
+        manager.replay_failed_calendar_writes()
+        results = manager.add_maintenances_to_calendar(maintenance_notifications)
+    manager.commit_checkpoints(results)
+    return results
+
+
+def run_multi_source(mailbox_sources_file, parse_workers):
+    multi_source = MultiSourceMaintenance(load_mailbox_sources(mailbox_sources_file), max_connections=int(os.getenv("IMAP_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)),
+                                          parse_workers=parse_workers, circuit_inventory=load_circuit_inventory(),
+                                          header_first_fetch=bool(os.getenv("HEADER_FIRST_FETCH", None)),
+                                          google_calendar=load_google_calendar() if writes_to_calendar() else None)
+    try:
+        return write_maintenances(multi_source)
+    finally:
+        multi_source.close()
+
+
+def run_pipeline(manager, parse_workers):
+    pipeline = MaintenancePipeline(manager, sink=lambda maintenance_notifications: manager.add_maintenances_to_calendar(log_maintenances(maintenance_notifications)),
+                                   fetch_workers=int(os.getenv("PIPELINE_FETCH_WORKERS", 1)), parse_workers=parse_workers)
+    # Finish what has been fetched on the first signal, stop right away on the second
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: pipeline.stop() if not pipeline.stopping else signal.default_int_handler(signum, frame))
+    # Once per run, not in the sink, which writes a batch at a time from several workers
+    manager.replay_failed_calendar_writes()
+    return pipeline.run(since="1-Oct-2017")
+
+
+def log_maintenances(maintenance_notifications):
+    for maintenance_notification in maintenance_notifications:
         LOG.info("Adding maintenance event: {} {} {}".format(maintenance_notification.partner, maintenance_notification.cid, maintenance_notification.start_time))
-        manager.add_maintenance_to_calendar(maintenance_notification=maintenance_notification)
+        yield maintenance_notification
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# Copyright 2017 Netflix
+import logging
+import os
+
+from manage_maintenance.daemon import MaintenanceDaemon
+from manage_maintenance.imap import DEFAULT_IDLE_TIMEOUT, DEFAULT_POLL_INTERVAL
+from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.metrics import METRICS
+from run import MAILBOX_FOLDER, load_creds, load_google_calendar
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    username, password = load_creds()
+    imap_address = os.getenv("IMAP_ADDRESS", "imap.gmail.com")
+    imap_folder = os.getenv("IMAP_FOLDER", MAILBOX_FOLDER)
+    metrics_port = os.getenv("METRICS_PORT", None)
+    metrics_file = os.getenv("METRICS_PROMETHEUS_FILE", None)
+    if metrics_port or metrics_file:
+        METRICS.enable()
+    if metrics_port:
+        METRICS.serve(int(metrics_port))
+    manager = ManageMaintenance(imap_username=username, imap_password=password, imap_address=imap_address, imap_folder=imap_folder,
+                                google_calendar=load_google_calendar())
+    daemon = MaintenanceDaemon(
+        manager=manager,
+        since="1-Oct-2017",
+        idle_timeout=int(os.getenv("IMAP_IDLE_TIMEOUT", DEFAULT_IDLE_TIMEOUT)),
+        poll_interval=int(os.getenv("IMAP_POLL_INTERVAL", DEFAULT_POLL_INTERVAL)),
+        metrics_file=metrics_file,
+        coalesce=bool(os.getenv("COALESCE", None))
+    )
+    daemon.install_signal_handlers()
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
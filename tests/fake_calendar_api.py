@@ -0,0 +1,213 @@
+"""A local stand-in for the Google Calendar v3 REST API."""
+import email
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import httplib2
+import googleapiclient
+from apiclient import discovery
+
+
+EVENT_PATH = re.compile(r"^/calendar/v3/calendars/(?P<calendar_id>[^/]+)/events(?:/(?P<event_id>[^/]+))?$")
+BATCH_PATH = "/batch/calendar/v3"
+
+
+class FakeCalendarAPI(object):
+    """In-memory Calendar API state and request handling, independent of the transport."""
+
+    def __init__(self, latency=0.0, page_size=250):
+        self.latency = latency
+        self.page_size = page_size
+        self.calendars = {}
+        self.requests = []
+        self.batch_requests = 0
+        self.sequence = 0
+        self.min_sync_token = 0
+        self.failures = []
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    def events(self, calendar_id="primary"):
+        """Return the events dictionary of a calendar."""
+        return self.calendars.setdefault(calendar_id, {})
+
+    def _changed(self, calendar_id, event_id):
+        self.sequence += 1
+        self._changes.setdefault(calendar_id, {})[event_id] = self.sequence
+
+    def expire_sync_tokens(self):
+        """Make every sync token handed out so far invalid (410 Gone)."""
+        self.min_sync_token = self.sequence + 1
+
+    def fail_next(self, count, status=429, reason="rateLimitExceeded"):
+        """Answer the next ``count`` calls, batched or not, with an error instead of handling them."""
+        with self._lock:
+            self.failures.extend([(status, reason)] * count)
+
+    def handle(self, method, path, body):
+        """Handle one API call and return (status, payload)."""
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        match = EVENT_PATH.match(url.path)
+        if not match:
+            return 404, error_payload(404, "Not Found")
+        calendar_id = unquote(match.group("calendar_id"))
+        event_id = unquote(match.group("event_id")) if match.group("event_id") else None
+        with self._lock:
+            self.requests.append((method, url.path))
+            if self.failures:
+                status, reason = self.failures.pop(0)
+                return status, error_payload(status, STATUS_TEXT.get(status, "Error"), reason)
+            events = self.events(calendar_id)
+            if method == "POST" and not event_id:
+                event = json.loads(body.decode("utf-8"))
+                event.setdefault("id", uuid.uuid4().hex)
+                if event["id"] in events:
+                    return 409, error_payload(409, "The requested identifier already exists.", "duplicate")
+                event["htmlLink"] = "https://calendar.example/{}".format(event["id"])
+                events[event["id"]] = event
+                self._changed(calendar_id, event["id"])
+                return 200, event
+            if method == "GET" and not event_id:
+                return self.list_events(calendar_id, query)
+            if event_id not in events:
+                return 404, error_payload(404, "Not Found", "notFound")
+            if method == "GET":
+                return 200, events[event_id]
+            if method == "PUT":
+                event = json.loads(body.decode("utf-8"))
+                event["id"] = event_id
+                event["htmlLink"] = events[event_id]["htmlLink"]
+                events[event_id] = event
+                self._changed(calendar_id, event_id)
+                return 200, event
+            if method == "DELETE":
+                del events[event_id]
+                self._changed(calendar_id, event_id)
+                return 204, None
+        return 405, error_payload(405, "Method Not Allowed")
+
+    def list_events(self, calendar_id, query):
+        """Return one page of an events listing, or of the changes since a sync token."""
+        events = self.events(calendar_id)
+        if "syncToken" in query:
+            sync_token = int(query["syncToken"][0])
+            if sync_token < self.min_sync_token:
+                return 410, error_payload(410, "Sync token is no longer valid, a full sync is required.", "fullSyncRequired")
+            changes = self._changes.get(calendar_id, {})
+            items = [events[event_id] if event_id in events else {"id": event_id, "status": "cancelled"}
+                     for event_id, sequence in sorted(changes.items(), key=lambda change: change[1]) if sequence > sync_token]
+        else:
+            items = list(events.values())
+        offset = int(query.get("pageToken", ["0"])[0])
+        page_size = min(int(query.get("maxResults", [self.page_size])[0]), self.page_size)
+        result = {"kind": "calendar#events", "items": items[offset:offset + page_size]}
+        if offset + page_size < len(items):
+            result["nextPageToken"] = str(offset + page_size)
+        else:
+            result["nextSyncToken"] = str(self.sequence)
+        return 200, result
+
+
+def error_payload(code, message, reason="error"):
+    """Build a Google API error body."""
+    return {"error": {"code": code, "message": message, "errors": [{"reason": reason, "message": message}]}}
+
+
+STATUS_TEXT = {200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict",
+               410: "Gone", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        api = self.server.api
+        if api.latency:
+            time.sleep(api.latency)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+        if urlsplit(self.path).path == BATCH_PATH:
+            content_type, payload = self._handle_batch(body)
+            self._respond(200, payload, content_type)
+            return
+        status, payload = api.handle(self.command, self.path, body)
+        self._respond(status, json.dumps(payload).encode("utf-8") if payload is not None else b"", "application/json")
+
+    def _handle_batch(self, body):
+        api = self.server.api
+        with api._lock:
+            api.batch_requests += 1
+        batch = email.message_from_bytes("Content-Type: {}\r\n\r\n".format(self.headers["Content-Type"]).encode("utf-8") + body)
+        boundary = "batch_{}".format(uuid.uuid4().hex)
+        parts = []
+        for part in batch.get_payload():
+            request = part.get_payload(decode=False)
+            if isinstance(request, list):
+                request = request[0].as_string()
+            head, _, part_body = request.replace("\r\n", "\n").partition("\n\n")
+            method, path, _ = head.split("\n", 1)[0].split(" ", 2)
+            status, payload = api.handle(method, path, part_body.encode("utf-8"))
+            response_body = json.dumps(payload) if payload is not None else ""
+            parts.append("--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\nHTTP/1.1 {} {}\r\nContent-Type: application/json\r\n\r\n{}\r\n".format(
+                boundary, part["Content-ID"][1:-1], status, STATUS_TEXT.get(status, "Unknown"), response_body))
+        payload = "".join(parts) + "--{}--\r\n".format(boundary)
+        return "multipart/mixed; boundary={}".format(boundary), payload.encode("utf-8")
+
+    def _respond(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeCalendarServer(object):
+    """Serves a FakeCalendarAPI on a local port."""
+
+    def __init__(self, api=None):
+        self.api = api or FakeCalendarAPI()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.api = self.api
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Root URL of the fake API."""
+        return "http://127.0.0.1:{}/".format(self._server.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def build_service(self):
+        """Build a Calendar API client pointed at this server."""
+        return build_service(self.url)
+
+
+def build_service(url):
+    """Build a Calendar API client pointed at a fake API root URL."""
+    documents = os.path.join(os.path.dirname(googleapiclient.__file__), "discovery_cache", "documents")
+    with open(os.path.join(documents, "calendar.v3.json")) as f:
+        document = json.load(f)
+    document["rootUrl"] = url
+    document["baseUrl"] = url + document["servicePath"]
+    return discovery.build_from_document(document, http=httplib2.Http())
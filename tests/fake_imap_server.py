@@ -0,0 +1,223 @@
+"""A local stand-in for an IMAP4rev1 server, enough for imaplib and manage_maintenance.imap."""
+import re
+import socket
+import threading
+import time
+from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+
+COMMAND = re.compile(rb"^(?P<tag>\S+) (?P<command>\S+)(?: (?P<arguments>.*))?$")
+UID_RANGE = re.compile(r"\bUID (\d+):\*")
+HEADER_FIELDS = re.compile(r"BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]", re.IGNORECASE)
+
+
+def header_fields(raw_message, fields):
+    """Return the named header fields of a raw message the way a server answers HEADER.FIELDS."""
+    wanted = set(field.lower() for field in fields)
+    header_block = re.split(rb"\r?\n\r?\n", raw_message, maxsplit=1)[0]
+    lines = []
+    keep = False
+    for line in re.split(rb"\r?\n", header_block):
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                lines.append(line)
+            continue
+        keep = line.partition(b":")[0].strip().decode("ascii", "replace").lower() in wanted
+        if keep:
+            lines.append(line)
+    return b"".join(line + b"\r\n" for line in lines) + b"\r\n"
+
+
+def fetch_item(raw_message, items):
+    """Return the FETCH data item name and payload a UID FETCH for ``items`` asks for."""
+    match = HEADER_FIELDS.search(items)
+    if match:
+        fields = match.group(1).split()
+        return "BODY[HEADER.FIELDS ({})]".format(" ".join(fields)), header_fields(raw_message, fields)
+    return "BODY[]", raw_message
+
+
+class FakeMailbox(object):
+    """Messages of one folder, keyed by UID."""
+
+    def __init__(self, messages=(), uidvalidity=1):
+        self.messages = {}
+        self.uidvalidity = uidvalidity
+        self.commands = []
+        self.fetched_bytes = 0
+        self._lock = threading.Lock()
+        for raw_message in messages:
+            self.append(raw_message)
+
+    def append(self, raw_message):
+        """Add a message and return its UID."""
+        with self._lock:
+            uid = max(self.messages, default=0) + 1
+            self.messages[uid] = raw_message
+        return uid
+
+    def search(self, criteria):
+        """Return matching UIDs; only ``UID n:*`` narrows the result, like a server matching every other criterion."""
+        uids = sorted(self.messages)
+        match = UID_RANGE.search(criteria)
+        if match:
+            # n:* always includes the highest UID, even when it is below n
+            uids = [uid for uid in uids if uid >= int(match.group(1))] or uids[-1:]
+        return uids
+
+    def message_set(self, message_set):
+        """Expand an IMAP message set into the UIDs that exist."""
+        uids = []
+        for part in message_set.split(","):
+            start, _, end = part.partition(":")
+            end = max(self.messages, default=0) if end == "*" else int(end or start)
+            uids.extend(uid for uid in range(int(start), end + 1) if uid in self.messages)
+        return uids
+
+
+class _Handler(StreamRequestHandler):
+
+    def _send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode("utf-8"))
+
+    def handle(self):
+        # With folders, commands go to the selected folder's mailbox; otherwise every folder is the one mailbox
+        mailbox = self.server.mailbox
+        with self.server.connections_lock:
+            self.server.connections.add(self.connection)
+        try:
+            self._serve(mailbox)
+        finally:
+            with self.server.connections_lock:
+                self.server.connections.discard(self.connection)
+
+    def _serve(self, mailbox):
+        # Message count last reported to the client, so new mail can be announced with untagged EXISTS
+        self._exists = None
+        self._send("* OK [CAPABILITY IMAP4rev1 UIDPLUS IDLE] Fake IMAP server ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            match = COMMAND.match(line.rstrip(b"\r\n"))
+            if not match:
+                self._send("* BAD Unparseable command\r\n")
+                continue
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            tag = match.group("tag").decode("ascii")
+            command = match.group("command").decode("ascii").upper()
+            arguments = (match.group("arguments") or b"").decode("utf-8")
+            if command in ("SELECT", "EXAMINE") and self.server.folders is not None:
+                mailbox = self.server.folders.get(arguments.strip('"'))
+                if mailbox is None:
+                    self._send("{} NO Mailbox doesn't exist\r\n".format(tag))
+                    continue
+            mailbox.commands.append((command, arguments))
+            if command == "LOGOUT":
+                self._send("* BYE Logging out\r\n{} OK LOGOUT completed\r\n".format(tag))
+                return
+            if command == "IDLE":
+                # New mail goes out in the same packet as the continuation, as a busy server's would
+                self._send("+ idling\r\n" + self._new_mail(mailbox))
+                self.wfile.flush()
+                self.rfile.readline()
+                # Mail that arrived while idling is only reported once the client sends DONE
+                self._send(self._new_mail(mailbox) + "{} OK IDLE terminated\r\n".format(tag))
+                continue
+            response = self._respond(mailbox, tag, command, arguments)
+            self._send(self._new_mail(mailbox))
+            self._send(response)
+            self.wfile.flush()
+
+    def _new_mail(self, mailbox):
+        if self._exists is None or self._exists == len(mailbox.messages):
+            return ""
+        self._exists = len(mailbox.messages)
+        return "* {} EXISTS\r\n".format(self._exists)
+
+    def _respond(self, mailbox, tag, command, arguments):
+        if command == "CAPABILITY":
+            return "* CAPABILITY IMAP4rev1 UIDPLUS IDLE\r\n{} OK CAPABILITY completed\r\n".format(tag)
+        if command in ("LOGIN", "NOOP"):
+            return "{} OK {} completed\r\n".format(tag, command)
+        if command in ("SELECT", "EXAMINE"):
+            self._exists = len(mailbox.messages)
+            return "* {} EXISTS\r\n* OK [UIDVALIDITY {}] UIDs valid\r\n{} OK [READ-WRITE] SELECT completed\r\n".format(len(mailbox.messages), mailbox.uidvalidity, tag)
+        if command == "UID":
+            subcommand, _, arguments = arguments.partition(" ")
+            if subcommand.upper() == "SEARCH":
+                return "* SEARCH {}\r\n{} OK SEARCH completed\r\n".format(" ".join(str(uid) for uid in mailbox.search(arguments)), tag)
+            if subcommand.upper() == "FETCH":
+                message_set, _, items = arguments.partition(" ")
+                response = bytearray()
+                for number, uid in enumerate(mailbox.message_set(message_set), start=1):
+                    name, payload = fetch_item(mailbox.messages[uid], items)
+                    mailbox.fetched_bytes += len(payload)
+                    response += "* {} FETCH (UID {} {} {{{}}}\r\n".format(number, uid, name, len(payload)).encode("ascii")
+                    response += payload + b")\r\n"
+                return bytes(response) + "{} OK FETCH completed\r\n".format(tag).encode("ascii")
+        return "{} BAD Unsupported command {}\r\n".format(tag, command)
+
+
+class _ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeIMAPServer(object):
+    """Serves a FakeMailbox over plain IMAP on a local port, with optional per-command latency.
+
+    ``folders`` maps folder names to FakeMailboxes; without it every folder name selects ``mailbox``.
+    """
+
+    def __init__(self, mailbox=None, latency=0.0, folders=None):
+        self.mailbox = mailbox or FakeMailbox()
+        self.folders = folders
+        self._server = _ThreadingTCPServer(("127.0.0.1", 0), _Handler)
+        self._server.mailbox = self.mailbox
+        self._server.folders = folders
+        self._server.latency = latency
+        self._server.connections = set()
+        self._server.connections_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        """(host, port) of the fake server."""
+        return self._server.server_address
+
+    @property
+    def connection_count(self):
+        return len(self._server.connections)
+
+    def drop_connections(self):
+        """Close every client connection, like a server timing out idle sessions."""
+        with self._server.connections_lock:
+            connections = list(self._server.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def wait_for_port(address, timeout=5.0):
+    """Block until a TCP port accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout=timeout).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
@@ -0,0 +1,80 @@
+"""Test reading maintenances from local mail archives."""
+import os
+import tempfile
+import unittest
+
+from manage_maintenance.archive import ArchiveMessageSource, scan_mbox
+from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.replay import format_statistics, replay
+from tests.test_manage_maintenance.test_manage import make_ntt_notice
+
+
+def write_mbox(file_path, raw_messages):
+    """Write messages to an mbox file, escaping body lines that start with "From "."""
+    with open(file_path, "wb") as f:
+        for raw_message in raw_messages:
+            f.write(b"From MAILER-DAEMON Fri Dec  1 00:00:00 2017\n")
+            f.write(raw_message.replace(b"\nFrom ", b"\n>From ").rstrip(b"\n") + b"\n\n")
+
+
+class ArchiveMessageSourceTest(unittest.TestCase):
+    """ArchiveMessageSource class test case."""
+
+    def setUp(self):
+        """Write the same notices as an mbox, a Maildir and a directory of .eml files."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.raw_messages = [make_ntt_notice("{:06d}".format(number), number, subject="Unrelated" if number % 3 == 0 else "Maintenance Notice")
+                             for number in range(1, 13)]
+        self.mbox = os.path.join(temp_dir.name, "archive.mbox")
+        write_mbox(self.mbox, self.raw_messages)
+        self.maildir = os.path.join(temp_dir.name, "Maildir")
+        self.eml_directory = os.path.join(temp_dir.name, "eml")
+        for directory in (os.path.join(self.maildir, "cur"), os.path.join(self.maildir, "new"), os.path.join(self.maildir, "tmp"), self.eml_directory):
+            os.makedirs(directory)
+        for number, raw_message in enumerate(self.raw_messages):
+            with open(os.path.join(self.maildir, "cur" if number < 6 else "new", "{:04d}.host:2,S".format(number)), "wb") as f:
+                f.write(raw_message)
+            with open(os.path.join(self.eml_directory, "{:04d}.eml".format(number)), "wb") as f:
+                f.write(raw_message)
+
+    def test_scan_mbox(self):
+        """Test message boundaries, with or without a trailing line break and with CRLF line endings."""
+        data = b"From a\nSubject: x\n\nbody\n\nFrom b\r\nSubject: y\r\n\r\nbody\r\n\r\nFrom c\n"
+        self.assertEqual([data[start:end] for start, end in scan_mbox(data)], [b"Subject: x\n\nbody\n", b"Subject: y\r\n\r\nbody\r\n", b""])
+        self.assertEqual(list(scan_mbox(b"")), [])
+
+    def test_archive_formats(self):
+        """Test every format yields the same messages, in order."""
+        for path in (self.mbox, self.maildir, self.eml_directory):
+            with ArchiveMessageSource([path]) as message_source:
+                message_ids = message_source.list_message_ids()
+                raw_messages = [raw_message for _, raw_message in message_source.fetch_raw_messages(message_ids)]
+                headers = message_source.fetch_screening_headers(message_ids[:2])
+            self.assertEqual([raw_message.rstrip(b"\n") for raw_message in raw_messages], [raw_message.rstrip(b"\n") for raw_message in self.raw_messages], path)
+            self.assertEqual(headers[1]["Subject"], "Maintenance Notice")
+
+    def test_list_maintenances(self):
+        """Test list_maintenances reads an archive like a mailbox."""
+        for header_first_fetch in (False, True):
+            with ArchiveMessageSource([self.mbox]) as message_source:
+                manager = ManageMaintenance(imap_username=None, imap_password=None, imap_address=None, imap_folder=None,
+                                            header_first_fetch=header_first_fetch, message_source=message_source)
+                self.assertEqual([notification.cid for notification in manager.list_maintenances()],
+                                 ["{:06d}".format(number) for number in range(1, 13) if number % 3])
+
+    def test_replay(self):
+        """Test the replay statistics count matched and missed messages."""
+        statistics = replay([self.mbox, self.eml_directory])
+        self.assertEqual((statistics["messages"], statistics["matched_messages"], statistics["missed_messages"], statistics["maintenances"]), (24, 16, 8, 16))
+        self.assertEqual(statistics["maintenances_by_partner"], {"NTT": 16})
+        self.assertIn("16 matched a pattern, 8 matched none", format_statistics(statistics))
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Test coalescing notification lifecycles into one calendar write per maintenance."""
+import email
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import manage_maintenance.manage
+from manage_maintenance.coalesce import coalesce_notifications
+from manage_maintenance.config import TestConfig
+from manage_maintenance.feed import ICSFeedPublisher
+from manage_maintenance.google_calendar import GoogleCalendar
+from manage_maintenance.manage import ManageMaintenance, MaintenanceNotification
+from manage_maintenance.patterns import NotificationPattern
+from tests.fake_calendar_api import FakeCalendarServer
+
+
+def make_notification(day, sent_hour, cid="000001", reference="MW-1", cancelled=False):
+    """Build a notification of a maintenance on a December day, sent on the 1st at an hour."""
+    start_time = datetime(2017, 12, day, 1)
+    return MaintenanceNotification(subject="Maintenance", start_time=start_time, end_time=start_time + timedelta(hours=4), cid=cid, partner="NTT",
+                                   original_message="", event_uuid=ManageMaintenance._generate_maintenance_uuid(cid, start_time, start_time + timedelta(hours=4)),
+                                   reference=reference, cancelled=cancelled, sent_time=datetime(2017, 11, 1, sent_hour, tzinfo=timezone.utc))
+
+
+class CoalesceTest(unittest.TestCase):
+    """Coalescing test case."""
+
+    def setUp(self):
+        """Point a manager at a fake Calendar API and a temporary schedule."""
+        self.server = FakeCalendarServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = TestConfig()
+        manage_maintenance.manage.config.SCHEDULE_FILE_PATH = temp_dir.name
+        self.addCleanup(setattr, manage_maintenance.manage, "config", previous_config)
+        calendar = GoogleCalendar(service=self.server.build_service(), mirror_file_path=os.path.join(temp_dir.name, "calendar_mirror.json"))
+        self.manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX", google_calendar=calendar)
+
+    def sync(self, maintenance_notifications):
+        """Sync notifications and return the event writes sent to the API."""
+        self.server.api.requests.clear()
+        self.manager.sync_maintenances_to_calendar(maintenance_notifications)
+        return [method for method, path in self.server.api.requests if method != "GET"]
+
+    def test_coalesce_notifications(self):
+        """Test the latest notice of each maintenance wins, whatever order they arrive in."""
+        rescheduled = make_notification(5, 12)
+        other = make_notification(3, 9, cid="000002")
+        finals = coalesce_notifications([rescheduled, make_notification(3, 9), other, make_notification(4, 10)])
+        self.assertEqual(finals, [rescheduled, other])
+
+    def test_lifecycle_in_one_run(self):
+        """Test an initial notice, reminder and reschedule cost one create, and a cancelled maintenance none."""
+        writes = self.sync([make_notification(3, 9), make_notification(3, 10), make_notification(5, 11),
+                            make_notification(7, 9, reference="MW-2"), make_notification(7, 10, reference="MW-2", cancelled=True)])
+        self.assertEqual(writes, ["POST"])
+        self.assertEqual([event["start"]["dateTime"] for event in self.server.api.events().values()], ["2017-12-05T01:00:00"])
+
+    def test_lifecycle_across_runs(self):
+        """Test later runs update and delete the event created first, once each, and ignore stale or repeated notices."""
+        self.assertEqual(self.sync([make_notification(3, 9)]), ["POST"])
+        event_id = make_notification(3, 9).event_uuid
+        self.assertEqual(self.sync([make_notification(3, 10)]), [])
+        self.assertEqual(self.sync([make_notification(5, 11), make_notification(6, 12)]), ["PUT"])
+        self.assertEqual(list(self.server.api.events()), [event_id])
+        self.assertEqual(self.server.api.events()[event_id]["start"]["dateTime"], "2017-12-06T01:00:00")
+        self.assertEqual(self.sync([make_notification(5, 11)]), [])
+        self.assertEqual(self.sync([make_notification(6, 13, cancelled=True)]), ["DELETE"])
+        self.assertEqual(self.server.api.events(), {})
+        self.assertEqual(self.sync([make_notification(6, 14, cancelled=True)]), [])
+        with self.manager.open_schedule() as schedule:
+            self.assertEqual(schedule.windows_for_cid("000001"), [])
+            self.assertTrue(schedule.get(event_id)["cancelled"])
+
+    def test_feed_then_calendar(self):
+        """Test a maintenance first published to the feeds is still created in the calendar."""
+        feed_publisher = ICSFeedPublisher(os.path.join(manage_maintenance.manage.config.SCHEDULE_FILE_PATH, "feeds"))
+        self.manager.add_maintenances_to_feed([make_notification(3, 9)], feed_publisher)
+        self.assertEqual(self.sync([make_notification(3, 9)]), ["POST"])
+        self.manager.add_maintenances_to_feed([make_notification(5, 10)], feed_publisher)
+        with self.manager.open_schedule() as schedule:
+            self.assertEqual([row["start_time"] for row in schedule.all()], [datetime(2017, 12, 3, 1)])
+
+    def test_conflicts_logged(self):
+        """Test a maintenance overlapping another calendar event is logged when written, and never conflicts with its own event."""
+        first = make_notification(3, 9)
+        self.sync([first])
+        other = make_notification(3, 10, cid="000002", reference="MW-2")
+        with self.assertLogs("manage_maintenance.manage", "WARNING") as logs:
+            self.assertEqual(self.sync([other]), ["POST"])
+        self.assertIn("Maintenance NTT 000002", logs.output[0])
+        conflicts = self.manager.check_maintenance_conflicts([other, make_notification(7, 9, cid="000003")])
+        self.assertEqual({event_uuid: [interval.event_id for interval in intervals] for event_uuid, intervals in conflicts.items()},
+                         {other.event_uuid: [first.event_uuid]})
+
+    def test_without_reference(self):
+        """Test without a reference a cancellation restating the window deletes its event."""
+        self.assertEqual(self.sync([make_notification(3, 9, reference=None), make_notification(4, 9, reference=None)]), ["POST", "POST"])
+        self.assertEqual(self.sync([make_notification(3, 10, reference=None, cancelled=True)]), ["DELETE"])
+        self.assertEqual(len(self.server.api.events()), 1)
+
+    def test_extract_reference_and_cancellation(self):
+        """Test the reference, cancellation and Date are extracted from a notice."""
+        notification_pattern = NotificationPattern({
+            "partner_name": "NTT",
+            "maintenance_cid_pattern": r"Circuit: (\d+)",
+            "maintenance_start_time_pattern": r"Start: (\S+ \S+)",
+            "maintenance_end_time_pattern": r"End: (\S+ \S+)",
+            "start_time_format": "%Y-%m-%d %H:%M",
+            "end_time_format": "%Y-%m-%d %H:%M",
+            "maintenance_reference_pattern": r"Ref: (MW-\d+)",
+            "maintenance_cancelled_pattern": r"\bcancel",
+        }, "test.yml#0")
+        message = email.message_from_string("Subject: Ref: MW-7 Cancelled\nDate: Wed, 01 Nov 2017 10:00:00 +0000\n\n"
+                                            "Circuit: 000001 Start: 2017-12-03 01:00 End: 2017-12-03 05:00")
+        maintenance_notification = ManageMaintenance.extract_maintenance(message, notification_pattern)
+        self.assertEqual(maintenance_notification.reference, "MW-7")
+        self.assertTrue(maintenance_notification.cancelled)
+        self.assertEqual(maintenance_notification.sent_time, datetime(2017, 11, 1, 10, tzinfo=timezone.utc))
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
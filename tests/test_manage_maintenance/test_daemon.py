@@ -0,0 +1,108 @@
+"""Test daemon."""
+import imaplib
+import unittest
+from collections import namedtuple
+
+from manage_maintenance.daemon import MaintenanceDaemon
+
+
+WriteResult = namedtuple("WriteResult", ("event_id", "status"))
+
+
+class FakeManager(object):
+    """ManageMaintenance stand-in that replays scripted sync results."""
+
+    def __init__(self, syncs, failing_cids=()):
+        self.syncs = list(syncs)
+        self.failing_cids = set(failing_cids)
+        self.added = []
+        self.checkpoints = []
+        self.pending_checkpoints = 0
+        self.replays = 0
+        self.disconnects = 0
+        self.daemon = None
+
+    def list_maintenances(self, since=None, defer_checkpoint=False):
+        """Yield the next scripted batch, or raise a scripted error."""
+        result = self.syncs.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        for notification in result:
+            yield notification
+        self.pending_checkpoints += 1
+
+    def replay_failed_calendar_writes(self):
+        """Count replays of queued calendar writes."""
+        self.replays += 1
+        return []
+
+    def add_maintenances_to_calendar(self, maintenance_notifications):
+        """Record calendar writes, failing those of the failing CIDs."""
+        self.added.extend(maintenance_notifications)
+        return [WriteResult(notification.cid, "failed" if notification.cid in self.failing_cids else "created") for notification in maintenance_notifications]
+
+    def commit_checkpoints(self, results=()):
+        """Record whether the listed messages were checkpointed."""
+        committed = bool(self.pending_checkpoints) and all(result.status != "failed" for result in results)
+        self.checkpoints.append(committed)
+        self.pending_checkpoints = 0
+        return committed
+
+    def wait_for_new_messages(self, timeout, poll_interval):
+        """Report new mail until the script runs out."""
+        if not self.syncs:
+            self.daemon.stop()
+            return False
+        return True
+
+    def disconnect_imap(self):
+        """Count reconnects."""
+        self.disconnects += 1
+
+
+class FakeNotification(object):
+    """Bare notification."""
+
+    partner = "NTT"
+    start_time = None
+
+    def __init__(self, cid):
+        self.cid = cid
+
+
+class MaintenanceDaemonTest(unittest.TestCase):
+    """MaintenanceDaemon class test case."""
+
+    def test_run_reconnects_and_resumes(self):
+        """Test new notifications are pushed and dropped connections are re-established."""
+        manager = FakeManager([[FakeNotification("1")], imaplib.IMAP4.abort("socket error: EOF"), [FakeNotification("2")]])
+        daemon = manager.daemon = MaintenanceDaemon(manager, min_backoff=0, max_backoff=0)
+        daemon.run()
+        self.assertEqual([notification.cid for notification in manager.added], ["1", "2"])
+        self.assertEqual(manager.disconnects, 1)
+        self.assertEqual(manager.replays, 3)
+        self.assertEqual(manager.checkpoints, [True, True])
+
+    def test_run_survives_other_errors(self):
+        """Test failures other than dropped connections are retried without reconnecting."""
+        manager = FakeManager([[FakeNotification("1")], Exception("NO [UNAVAILABLE] Try again later"), [FakeNotification("2")]])
+        daemon = manager.daemon = MaintenanceDaemon(manager, min_backoff=0, max_backoff=0)
+        daemon.run()
+        self.assertEqual([notification.cid for notification in manager.added], ["1", "2"])
+        self.assertEqual(manager.disconnects, 0)
+
+    def test_failed_write_holds_checkpoint(self):
+        """Test a failed calendar write leaves the checkpoint alone, so the next sync lists the message again."""
+        manager = FakeManager([[FakeNotification("1"), FakeNotification("2")], [FakeNotification("3")]], failing_cids=["2"])
+        daemon = manager.daemon = MaintenanceDaemon(manager, min_backoff=0, max_backoff=0)
+        daemon.run()
+        self.assertEqual(manager.checkpoints, [False, True])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Test publishing the schedule as iCalendar feeds."""
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from email.utils import formatdate
+
+import manage_maintenance.manage
+from manage_maintenance.config import TestConfig
+from manage_maintenance.feed import ICSFeedPublisher, fold_line
+from manage_maintenance.ics import extract_events
+from manage_maintenance.manage import ManageMaintenance
+from tests.test_manage_maintenance.test_coalesce import make_notification
+
+
+UTC = timezone.utc
+
+
+def make_row(number, partner="NTT", cancelled=False):
+    """Build a schedule row."""
+    return {"event_uuid": "event{:04d}".format(number), "subject": "Maintenance", "start_time": datetime(2017, 12, 1, number), "end_time": datetime(2017, 12, 1, number + 2),
+            "cid": "{:06d}".format(number), "partner": partner, "original_message": "", "affected_devices": (("router1", "xe-0/0/{}".format(number)),),
+            "reference": None, "cancelled": cancelled, "sent_time": datetime(2017, 11, 1, 9)}
+
+
+class ICSFeedPublisherTest(unittest.TestCase):
+    """ICSFeedPublisher class test case."""
+
+    def setUp(self):
+        """Publish to a temporary directory."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.publisher = ICSFeedPublisher(os.path.join(self.temp_dir, "feeds"))
+
+    def read_feed(self, file_name):
+        """Return the contents of a published feed."""
+        with open(os.path.join(self.publisher.directory, file_name), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def test_feeds(self):
+        """Test the combined and per-partner feeds hold the right events, readable by the ICS scanner."""
+        rows = [make_row(1), make_row(2, partner="Level 3"), make_row(3, cancelled=True)]
+        results = self.publisher.publish(rows)
+        self.assertEqual([(result.file_name, result.status, result.events) for result in results], [
+            ("maintenances.ics", "written", 3), ("maintenances-ntt.ics", "written", 2), ("maintenances-level-3.ics", "written", 1)])
+        events = extract_events(self.read_feed("maintenances.ics"))
+        self.assertEqual([(event.uid, event.start_time, event.end_time, event.status) for event in events], [
+            ("event0001", datetime(2017, 12, 1, 1, tzinfo=UTC), datetime(2017, 12, 1, 3, tzinfo=UTC), "CONFIRMED"),
+            ("event0002", datetime(2017, 12, 1, 2, tzinfo=UTC), datetime(2017, 12, 1, 4, tzinfo=UTC), "CONFIRMED"),
+            ("event0003", datetime(2017, 12, 1, 3, tzinfo=UTC), datetime(2017, 12, 1, 5, tzinfo=UTC), "CANCELLED"),
+        ])
+        self.assertEqual([event.uid for event in extract_events(self.read_feed("maintenances-level-3.ics"))], ["event0002"])
+        self.assertTrue(all(len(line.encode("utf-8")) <= 75 for line in self.read_feed("maintenances.ics").split("\r\n")))
+
+    def test_fold_line(self):
+        """Test folded lines stay within 75 octets without splitting characters, and unfold to the original."""
+        line = "DESCRIPTION:" + "Wartungsarbeiten in Zürich " * 10
+        folded = fold_line(line)
+        self.assertTrue(all(len(part.encode("utf-8")) <= 75 for part in folded.split("\r\n")))
+        self.assertEqual(folded.replace("\r\n ", ""), line)
+
+    def test_incremental_publish(self):
+        """Test only feeds whose contents changed are rewritten, with new ETags, and emptied partner feeds are removed."""
+        rows = [make_row(1), make_row(2, partner="Level 3")]
+        first = {result.file_name: result for result in self.publisher.publish(rows)}
+        os.utime(os.path.join(self.publisher.directory, "maintenances-level-3.ics"), (1000000000, 1000000000))
+        headers = self.publisher.headers("maintenances-ntt.ics")
+        self.assertEqual(headers["ETag"], '"{}"'.format(first["maintenances-ntt.ics"].etag))
+        self.assertEqual(formatdate(os.stat(os.path.join(self.publisher.directory, "maintenances-ntt.ics")).st_mtime, usegmt=True), headers["Last-Modified"])
+
+        publisher = ICSFeedPublisher(self.publisher.directory)
+        self.assertEqual([result.status for result in publisher.publish(rows)], ["unchanged"] * 3)
+
+        rows[0] = dict(rows[0], end_time=datetime(2017, 12, 1, 6))
+        second = {result.file_name: result for result in publisher.publish(rows)}
+        self.assertEqual({file_name: result.status for file_name, result in second.items()},
+                         {"maintenances.ics": "written", "maintenances-ntt.ics": "written", "maintenances-level-3.ics": "unchanged"})
+        self.assertNotEqual(second["maintenances-ntt.ics"].etag, first["maintenances-ntt.ics"].etag)
+        self.assertEqual(os.stat(os.path.join(publisher.directory, "maintenances-level-3.ics")).st_mtime, 1000000000)
+
+        results = publisher.publish(rows[:1])
+        self.assertEqual([(result.file_name, result.status) for result in results][-1], ("maintenances-level-3.ics", "removed"))
+        self.assertFalse(os.path.exists(os.path.join(publisher.directory, "maintenances-level-3.ics")))
+        self.assertIsNone(ICSFeedPublisher(publisher.directory).headers("maintenances-level-3.ics"))
+        self.assertEqual(sorted(os.listdir(publisher.directory)), ["feeds.json", "maintenances-ntt.ics", "maintenances.ics"])
+
+    def test_add_maintenances_to_feed(self):
+        """Test notifications go through the schedule, a reschedule keeping the event's UID."""
+        previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = TestConfig()
+        manage_maintenance.manage.config.SCHEDULE_FILE_PATH = self.temp_dir
+        self.addCleanup(setattr, manage_maintenance.manage, "config", previous_config)
+        manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX")
+
+        initial = make_notification(3, 9)
+        manager.add_maintenances_to_feed([initial], self.publisher)
+        manager.add_maintenances_to_feed([make_notification(5, 10), make_notification(3, 8)], self.publisher)
+        events = extract_events(self.read_feed("maintenances-ntt.ics"))
+        self.assertEqual([(event.uid, event.start_time) for event in events], [(initial.event_uuid, datetime(2017, 12, 5, 1, tzinfo=UTC))])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
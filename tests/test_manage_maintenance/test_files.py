@@ -0,0 +1,46 @@
+"""Test atomic file writes."""
+import os
+import tempfile
+import unittest
+
+from manage_maintenance.files import write_atomically
+
+
+class WriteAtomicallyTest(unittest.TestCase):
+    """write_atomically test case."""
+
+    def setUp(self):
+        """Create a temporary directory."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.file_path = os.path.join(temp_dir.name, "state", "queue.json")
+
+    def test_replace(self):
+        """Test text and bytes replace the file, with the mtime given and the usual mode, leaving no temporary file behind."""
+        write_atomically(self.file_path, "first")
+        write_atomically(self.file_path, b"second", modified_time=1500000000)
+        with open(self.file_path, "rb") as f:
+            self.assertEqual(f.read(), b"second")
+        self.assertEqual(os.stat(self.file_path).st_mtime, 1500000000)
+        self.assertEqual(os.listdir(os.path.dirname(self.file_path)), ["queue.json"])
+        plain_file_path = os.path.join(os.path.dirname(self.file_path), "plain.json")
+        open(plain_file_path, "w").close()
+        self.assertEqual(os.stat(self.file_path).st_mode, os.stat(plain_file_path).st_mode)
+
+    def test_failed_write(self):
+        """Test a failed write keeps the previous file and removes its temporary file."""
+        write_atomically(self.file_path, "first")
+        with self.assertRaises(TypeError):
+            write_atomically(self.file_path, [1, 2])
+        with open(self.file_path) as f:
+            self.assertEqual(f.read(), "first")
+        self.assertEqual(os.listdir(os.path.dirname(self.file_path)), ["queue.json"])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Test google_calendar."""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+import googleapiclient
+
+from manage_maintenance.google_calendar import GoogleCalendar
+from tests.fake_calendar_api import FakeCalendarAPI, FakeCalendarServer
+
+
+def make_event_body(number):
+    """Build a maintenance event body."""
+    start_time = datetime(2017, 12, 1) + timedelta(hours=number)
+    return GoogleCalendar.build_maintenance_event_body("event{:04d}".format(number), start_time, start_time + timedelta(hours=1),
+                                                       "Scheduled Maintenance: NTT {}".format(number), "", "")
+
+
+class GoogleCalendarTest(unittest.TestCase):
+    """GoogleCalendar class test case."""
+
+    def setUp(self):
+        """Point a GoogleCalendar at a fake Calendar API server."""
+        self.server = FakeCalendarServer(FakeCalendarAPI(page_size=20)).__enter__()
+        self.addCleanup(self.server.__exit__)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.mirror_file_path = os.path.join(temp_dir.name, "calendar_mirror.json")
+        self.calendar = self.make_calendar()
+
+    def make_calendar(self):
+        """Build a GoogleCalendar against the fake server."""
+        return GoogleCalendar(service=self.server.build_service(), mirror_file_path=self.mirror_file_path)
+
+    def test_lazy_construction(self):
+        """Test constructing a calendar touches neither OAuth nor the network."""
+        with mock.patch.object(GoogleCalendar, "get_credentials") as get_credentials:
+            GoogleCalendar(mirror_file_path=self.mirror_file_path)
+        get_credentials.assert_not_called()
+
+    def test_service_from_cached_discovery_document(self):
+        """Test the service is built from the on-disk discovery document."""
+        discovery_document_file = os.path.join(self.temp_dir, "calendar.v3.discovery.json")
+        shutil.copy(os.path.join(os.path.dirname(googleapiclient.__file__), "discovery_cache", "documents", "calendar.v3.json"), discovery_document_file)
+        calendar = GoogleCalendar(mirror_file_path=self.mirror_file_path, discovery_document_file=discovery_document_file)
+        with mock.patch("httplib2.Http.request") as request:
+            service = calendar.get_service(mock.Mock())
+        request.assert_not_called()
+        self.assertTrue(hasattr(service, "events"))
+
+    def test_batch_insert(self):
+        """Test inserts are grouped into batches and duplicates are reported as existing."""
+        self.server.api.events()["event0003"] = dict(make_event_body(3), htmlLink="")
+        with self.calendar.batch(batch_size=50) as batch:
+            for number in range(120):
+                batch.insert(make_event_body(number))
+        self.assertEqual(self.server.api.batch_requests, 3)
+        self.assertEqual(len(batch.results), 120)
+        self.assertEqual([result.event_id for result in batch.results], ["event{:04d}".format(number) for number in range(120)])
+        self.assertEqual(batch.results[3].status, "exists")
+        self.assertEqual(sum(result.status == "created" for result in batch.results), 119)
+        self.assertEqual(len(self.server.api.events()), 120)
+
+    def test_mirror_sync(self):
+        """Test the mirror is seeded page by page, then synced incrementally and resynced on 410."""
+        for number in range(45):
+            self.calendar.create_calendar_event(make_event_body(number))
+        self.calendar.delete_calendar_event("event0000")
+
+        calendar = self.make_calendar()
+        self.assertTrue(calendar.is_existing_event_id("event0044"))
+        self.assertFalse(calendar.is_existing_event_id("event0000"))
+        self.assertEqual(len(self.server.api.requests), 46 + 3)    # Writes above, plus three pages of listing
+
+        self.server.api.requests.clear()
+        calendar.get_calendar_event("event0001")
+        self.assertEqual(self.server.api.requests, [])
+
+        calendar = self.make_calendar()
+        self.calendar.delete_calendar_event("event0001")
+        self.calendar.update_calendar_event("event0002", dict(make_event_body(2), summary="Rescheduled"))
+        self.assertEqual(calendar.sync_mirror(), 2)
+        self.assertFalse(calendar.is_existing_event_id("event0001"))
+        self.assertEqual(calendar.get_calendar_event("event0002")["summary"], "Rescheduled")
+
+        self.server.api.expire_sync_tokens()
+        self.assertEqual(calendar.sync_mirror(), 43)
+        self.assertEqual(len(calendar.get_mirror().events()), 43)
+
+    def test_create_maintenance_event_existing(self):
+        """Test creating an existing event returns it without failing."""
+        body = make_event_body(1)
+        self.calendar.create_calendar_event(body)
+        event = self.calendar.create_maintenance_event(body["id"], datetime(2017, 12, 1), datetime(2017, 12, 2), "", "", "")
+        self.assertEqual(event["summary"], body["summary"])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Test the ICS scanner."""
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from icalendar import Calendar
+
+from manage_maintenance.ics import extract_events, parse_content_line, scan_events
+from manage_maintenance.manage import ManageMaintenance
+
+
+UTC = timezone.utc
+
+MULTI_WINDOW_ICS = "\r\n".join([
+    "BEGIN:VCALENDAR",
+    "VERSION:2.0",
+    "BEGIN:VTIMEZONE",
+    "TZID:Asia/Tokyo",
+    "BEGIN:STANDARD",
+    "DTSTART:19700101T000000",
+    "TZOFFSETFROM:+0900",
+    "TZOFFSETTO:+0900",
+    "END:STANDARD",
+    "END:VTIMEZONE",
+    "BEGIN:VEVENT",
+    "UID:MW-1-a",
+    "SEQUENCE:0",
+    "DTSTART;TZID=Asia/Tokyo:20171201T100000",
+    "DTEND;TZID=Asia/Tokyo:20171201T140000",
+    "DESCRIPTION:First window of a long description that is folded over",
+    "  more than one line",
+    "BEGIN:VALARM",
+    "TRIGGER:-PT15M",
+    "END:VALARM",
+    "END:VEVENT",
+    "BEGIN:VEVENT",
+    "UID:MW-1-b",
+    "DTSTART:20171202T010000Z",
+    "DURATION:PT4H",
+    "STATUS:CONFIRMED",
+    "END:VEVENT",
+    "BEGIN:VEVENT",
+    "UID:MW-1-a",
+    "SEQUENCE:1",
+    "STATUS:CANCELLED",
+    "DTSTART;TZID=Asia/Tokyo:20171201T100000",
+    "DTEND;TZID=Asia/Tokyo:20171201T140000",
+    "END:VEVENT",
+    "END:VCALENDAR",
+    "",
+])
+
+
+class ICSTest(unittest.TestCase):
+    """ICS scanner test case."""
+
+    def test_scan_events(self):
+        """Test every VEVENT is read, after the VTIMEZONE, in UTC, and only the latest SEQUENCE of a UID is kept."""
+        events = extract_events(MULTI_WINDOW_ICS)
+        self.assertEqual([(event.uid, event.start_time, event.end_time, event.sequence, event.status) for event in events], [
+            ("MW-1-a", datetime(2017, 12, 1, 1, tzinfo=UTC), datetime(2017, 12, 1, 5, tzinfo=UTC), 1, "CANCELLED"),
+            ("MW-1-b", datetime(2017, 12, 2, 1, tzinfo=UTC), datetime(2017, 12, 2, 5, tzinfo=UTC), 0, "CONFIRMED"),
+        ])
+        self.assertEqual(len(scan_events(MULTI_WINDOW_ICS)), 3)
+
+    def test_floating_and_all_day(self):
+        """Test floating times and dates stay naive."""
+        events = scan_events("BEGIN:VCALENDAR\nBEGIN:VEVENT\nDTSTART:20171201T010000\nDTEND:20171201T050000\nEND:VEVENT\n"
+                             "BEGIN:VEVENT\nDTSTART;VALUE=DATE:20171203\nDTEND;VALUE=DATE:20171204\nEND:VEVENT\nEND:VCALENDAR\n")
+        self.assertEqual([(event.start_time, event.end_time) for event in events], [
+            (datetime(2017, 12, 1, 1), datetime(2017, 12, 1, 5)), (datetime(2017, 12, 3), datetime(2017, 12, 4))])
+
+    def test_parse_content_line(self):
+        """Test quoted parameter values may hold colons."""
+        self.assertEqual(parse_content_line('DTSTART;TZID="Custom: Zone";VALUE=DATE-TIME:20171201T010000'),
+                         ("DTSTART", {"TZID": "Custom: Zone", "VALUE": "DATE-TIME"}, "20171201T010000"))
+
+    def test_fallback(self):
+        """Test zones only the calendar defines go through icalendar, and unreadable calendars give no events."""
+        ics = MULTI_WINDOW_ICS.replace("Asia/Tokyo", "Tokyo Standard Time")
+        self.assertEqual([event.start_time for event in extract_events(ics)], [datetime(2017, 12, 1, 1, tzinfo=UTC), datetime(2017, 12, 2, 1, tzinfo=UTC)])
+        self.assertEqual(extract_events("BEGIN:VCALENDAR\nBEGIN:VEVENT\nDTSTART:tomorrow\n"), [])
+
+    def test_one_notification_per_window(self):
+        """Test a notice with a multi-window calendar gives a notification per window, cancellations included."""
+        message = MIMEMultipart()
+        message["From"] = "NTT NOC <coins@noc.us.ntt.net>"
+        message["Subject"] = "Maintenance Notice"
+        message.attach(MIMEText("Circuit: 123456 Tokyo\nSee the attached calendar."))
+        message.attach(MIMEText(MULTI_WINDOW_ICS, "calendar"))
+        manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX")
+        notifications = manager.parse_raw_message(message.as_bytes())
+        self.assertEqual([(notification.cid, notification.start_time, notification.end_time - notification.start_time, notification.reference, notification.cancelled)
+                          for notification in notifications], [
+            ("123456", datetime(2017, 12, 1, 1, tzinfo=UTC), timedelta(hours=4), "MW-1-a", True),
+            ("123456", datetime(2017, 12, 2, 1, tzinfo=UTC), timedelta(hours=4), "MW-1-b", False),
+        ])
+        self.assertEqual(len({notification.event_uuid for notification in notifications}), 2)
+
+    def test_calendar_windows_after_preferred_part(self):
+        """Test a calendar part is still read for its windows when a preferred HTML part already gave the CID and a window."""
+        message = MIMEMultipart()
+        message["From"] = "Level 3 <no-reply@level3.com>"
+        message["Subject"] = "Initial maintenance notification"
+        message.attach(MIMEText("<p>Maintenance window: 01-Dec-2017 01:00:00 GMT TO 01-Dec-2017 05:00:00 GMT</p>"
+                                "<table><tr><td>ABCD1234</td></tr></table>", "html"))
+        message.attach(MIMEText("\r\n".join(["BEGIN:VCALENDAR", "VERSION:2.0",
+                                             "BEGIN:VEVENT", "UID:L3-1-a", "DTSTART:20171201T010000Z", "DTEND:20171201T050000Z", "END:VEVENT",
+                                             "BEGIN:VEVENT", "UID:L3-1-b", "DTSTART:20171208T010000Z", "DTEND:20171208T050000Z", "END:VEVENT",
+                                             "END:VCALENDAR", ""]), "calendar"))
+        manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX")
+        notifications = manager.parse_raw_message(message.as_bytes())
+        self.assertEqual([(notification.partner, notification.cid, notification.start_time, notification.reference) for notification in notifications], [
+            ("Level 3", "ABCD1234", datetime(2017, 12, 1, 1, tzinfo=UTC), "L3-1-a"),
+            ("Level 3", "ABCD1234", datetime(2017, 12, 8, 1, tzinfo=UTC), "L3-1-b"),
+        ])
+
+    def test_event_uuid_matches_icalendar(self):
+        """Test times keep their zone, so event UUIDs match those of notices parsed with icalendar before the scanner."""
+        events = extract_events(MULTI_WINDOW_ICS)
+        self.assertEqual(events[0].start_time.isoformat(), "2017-12-01T10:00:00+09:00")
+        legacy_event = Calendar.from_ical(MULTI_WINDOW_ICS).walk("VEVENT")[0]
+        self.assertEqual(ManageMaintenance._generate_maintenance_uuid("123456", events[0].start_time, events[0].end_time),
+                         ManageMaintenance._generate_maintenance_uuid("123456", legacy_event["DTSTART"].dt, legacy_event["DTEND"].dt))
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
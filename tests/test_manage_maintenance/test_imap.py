@@ -0,0 +1,166 @@
+"""Test imap."""
+import os
+import tempfile
+import threading
+import unittest
+
+from manage_maintenance.checkpoint import IMAPCheckpointStore
+from manage_maintenance.imap import IMAP, build_message_set, build_search_criteria, literal_from_pattern
+from tests.fake_imap_server import FakeIMAPServer, FakeMailbox, fetch_item
+
+
+def make_raw_message(number):
+    """Build a tiny RFC822 message."""
+    return "From: noc@example.com\r\nSubject: Message {}\r\n\r\nBody {}\r\n".format(number, number).encode("utf-8")
+
+
+class FakeIMAP4(object):
+    """Minimal stand-in for an imaplib.IMAP4 connection."""
+
+    def __init__(self, message_count, uidvalidity=1):
+        self.messages = {number: make_raw_message(number) for number in range(1, message_count + 1)}
+        self.uidvalidity = uidvalidity
+        self.commands = []
+
+    def select(self, folder_name):
+        """Select a folder."""
+        self.commands.append(("SELECT", folder_name))
+        return "OK", [str(len(self.messages)).encode("ascii")]
+
+    def logout(self):
+        """Log out."""
+        self.commands.append(("LOGOUT",))
+        return "BYE", [b"Logging out"]
+
+    def response(self, code):
+        """Return an untagged response code."""
+        if code == "UIDVALIDITY":
+            return code, [str(self.uidvalidity).encode("ascii")]
+        return code, [None]
+
+    def uid(self, command, *args):
+        """Answer UID SEARCH and UID FETCH the way imaplib does."""
+        self.commands.append((command,) + args)
+        if command == "SEARCH":
+            uids = sorted(self.messages)
+            if args[0].startswith("UID "):
+                start = int(args[0].split()[1].split(":")[0])
+                uids = [uid for uid in uids if uid >= start] or uids[-1:]
+            return "OK", [" ".join(str(uid) for uid in uids).encode("ascii")]
+        data = []
+        for part in args[0].split(","):
+            start, _, end = part.partition(":")
+            for number in range(int(start), int(end or start) + 1):
+                name, payload = fetch_item(self.messages[number], args[1])
+                data.append(("{} (UID {} {} {{{}}}".format(number, number, name, len(payload)).encode("ascii"), payload))
+                data.append(b")")
+        return "OK", data
+
+
+class IMAPTest(unittest.TestCase):
+    """IMAP class test case."""
+
+    def setUp(self):
+        """Setup IMAP wrapper around a fake connection."""
+        self.imap = IMAP(username="user", password="pass", address="localhost")
+        self.imap._imap = self.fake = FakeIMAP4(message_count=12)
+
+    def test_build_message_set(self):
+        """Test consecutive IDs collapse into ranges."""
+        self.assertEqual(build_message_set([b"1", b"2", b"3", b"7", b"9", b"10"]), "1:3,7,9:10")
+        self.assertEqual(build_message_set([5]), "5")
+
+    def test_fetch_messages_in_chunks(self):
+        """Test messages are fetched with one FETCH per chunk and yielded in order."""
+        email_ids = [str(number).encode("ascii") for number in range(1, 13)]
+        messages = list(self.imap.fetch_messages_from_folder("INBOX", email_ids, chunk_size=5))
+        self.assertEqual([message["Subject"] for message in messages], ["Message {}".format(number) for number in range(1, 13)])
+        self.assertEqual(self.fake.commands, [("FETCH", "1:5", "(BODY.PEEK[])"), ("FETCH", "6:10", "(BODY.PEEK[])"), ("FETCH", "11:12", "(BODY.PEEK[])")])
+
+    def test_fetch_header_fields(self):
+        """Test only the requested header fields are fetched, with their UIDs."""
+        headers = list(self.imap.fetch_header_fields_from_folder("INBOX", [b"2", b"3"], ("Subject",)))
+        self.assertEqual(headers, [(b"2", b"Subject: Message 2\r\n\r\n"), (b"3", b"Subject: Message 3\r\n\r\n")])
+        self.assertEqual(self.fake.commands, [("FETCH", "2:3", "(BODY.PEEK[HEADER.FIELDS (SUBJECT)])")])
+
+    def test_list_message_ids_above_checkpoint(self):
+        """Test incremental searches only return UIDs above the checkpoint."""
+        self.assertEqual(self.imap.select_folder("INBOX"), 1)
+        self.assertEqual(self.imap.list_message_ids_in_folder("INBOX", min_uid=11), [b"11", b"12"])
+        self.assertEqual(self.imap.list_message_ids_in_folder("INBOX", min_uid=13), [])
+        self.assertEqual([command[0] for command in self.fake.commands], ["SELECT", "SEARCH", "SEARCH"])
+
+    def test_build_search_criteria(self):
+        """Test notification patterns become OR'd FROM/SUBJECT search terms."""
+        patterns = [
+            {"email_domain_pattern": "no-reply@level3\\.com>?$", "email_subject_pattern": "Initial"},
+            {"email_domain_pattern": "coins@noc\\.us\\.ntt\\.net", "email_subject_pattern": "Maintenance Notice"},
+        ]
+        self.assertEqual(build_search_criteria(patterns),
+                         'OR (FROM "no-reply@level3.com" SUBJECT "Initial") (FROM "coins@noc.us.ntt.net" SUBJECT "Maintenance Notice")')
+        self.assertIsNone(literal_from_pattern("\\d{6} Notice"))
+        self.assertIsNone(build_search_criteria(patterns + [{"email_subject_pattern": "(Planned|Emergency)"}]))
+
+
+class IMAPServerTest(unittest.TestCase):
+    """IMAP class test case against a local IMAP server."""
+
+    def test_fetch_over_plain_connection(self):
+        """Test searching and chunked fetches over a real socket."""
+        with FakeIMAPServer(FakeMailbox(make_raw_message(number) for number in range(1, 8))) as server:
+            imap = IMAP(username="user", password="pass", address=server.address[0], port=server.address[1], use_ssl=False)
+            imap.connect()
+            try:
+                self.assertEqual(imap.select_folder("INBOX"), 1)
+                email_ids = imap.list_message_ids_in_folder("INBOX", since="1-Oct-2017")
+                self.assertEqual(email_ids, [str(number).encode("ascii") for number in range(1, 8)])
+                raw_messages = list(imap.fetch_raw_messages_from_folder("INBOX", email_ids, chunk_size=3))
+                self.assertEqual(raw_messages, [make_raw_message(number) for number in range(1, 8)])
+                self.assertEqual(imap.list_message_ids_in_folder("INBOX", min_uid=8), [])
+            finally:
+                imap.logout()
+        self.assertEqual([command for command, _ in server.mailbox.commands if command == "UID"], ["UID"] * 5)
+
+    def test_wait_for_changes(self):
+        """Test IDLE sees new mail reported during an earlier command, buffered with the continuation, or after DONE."""
+        with FakeIMAPServer(FakeMailbox(make_raw_message(number) for number in range(1, 3))) as server:
+            imap = IMAP(username="user", password="pass", address=server.address[0], port=server.address[1], use_ssl=False)
+            imap.connect()
+            try:
+                self.assertFalse(imap.wait_for_changes("INBOX", timeout=0.1))
+                server.mailbox.append(make_raw_message(3))
+                self.assertEqual(imap.list_message_ids_in_folder("INBOX", min_uid=3), [b"3"])
+                self.assertTrue(imap.wait_for_changes("INBOX", timeout=5))
+                self.assertEqual([command for command, _ in server.mailbox.commands].count("IDLE"), 1)
+                server.mailbox.append(make_raw_message(4))
+                self.assertTrue(imap.wait_for_changes("INBOX", timeout=5))
+                # Reported after DONE, when the wait has already timed out
+                timer = threading.Timer(0.05, server.mailbox.append, (make_raw_message(5),))
+                timer.start()
+                self.assertTrue(imap.wait_for_changes("INBOX", timeout=0.3))
+                timer.join()
+            finally:
+                imap.logout()
+
+
+class IMAPCheckpointStoreTest(unittest.TestCase):
+    """IMAPCheckpointStore class test case."""
+
+    def test_checkpoint_round_trip(self):
+        """Test checkpoints persist and are discarded when UIDVALIDITY changes."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "checkpoints.json")
+            IMAPCheckpointStore(file_path).set("user@localhost/INBOX", 7, 42)
+            store = IMAPCheckpointStore(file_path)
+            self.assertEqual(store.get("user@localhost/INBOX", 7), 42)
+            self.assertIsNone(store.get("user@localhost/INBOX", 8))
+            self.assertIsNone(store.get("user@localhost/Other", 7))
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
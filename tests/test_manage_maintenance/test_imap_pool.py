@@ -0,0 +1,80 @@
+"""Test the IMAP connection pool."""
+import threading
+import unittest
+
+from manage_maintenance.imap_pool import IMAPConnectionPool, MailboxSource
+from tests.fake_imap_server import FakeIMAPServer, FakeMailbox
+from tests.test_manage_maintenance.test_manage import make_ntt_notice
+
+
+def make_source(server, folder="INBOX"):
+    """Build a MailboxSource for a fake server."""
+    return MailboxSource(username="user", password="pass", address=server.address[0], folder=folder, port=server.address[1], use_ssl=False)
+
+
+class IMAPConnectionPoolTest(unittest.TestCase):
+    """IMAPConnectionPool class test case."""
+
+    def setUp(self):
+        """Serve two folders."""
+        self.folders = {"NOC": FakeMailbox([make_ntt_notice("000001", 1)]), "Partners": FakeMailbox([make_ntt_notice("000002", 2)] * 2)}
+        self.server = FakeIMAPServer(folders=self.folders)
+        self.server.__enter__()
+
+    def tearDown(self):
+        """Stop the server."""
+        self.server.__exit__()
+
+    def test_reuses_connections_across_folders(self):
+        """Test one account's folders share a connection, each selected when lent."""
+        with IMAPConnectionPool(max_connections=2) as pool:
+            with pool.connection(make_source(self.server, "NOC")) as imap:
+                self.assertEqual(imap.list_message_ids_in_folder("NOC"), [b"1"])
+            with pool.connection(make_source(self.server, "Partners")) as imap:
+                self.assertEqual(imap.list_message_ids_in_folder("Partners"), [b"1", b"2"])
+            self.assertEqual(self.server.connection_count, 1)
+
+    def test_bounded(self):
+        """Test a borrower waits while every connection is lent out."""
+        pool = IMAPConnectionPool(max_connections=1)
+        lent = threading.Event()
+        second_lent = threading.Event()
+
+        def borrow():
+            with pool.connection(make_source(self.server, "Partners")):
+                second_lent.set()
+        with pool.connection(make_source(self.server, "NOC")):
+            lent.set()
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            self.assertFalse(second_lent.wait(0.2))
+        thread.join(5)
+        self.assertTrue(second_lent.is_set())
+        pool.close()
+
+    def test_reconnects_dropped_sessions(self):
+        """Test a connection the server dropped is replaced after a health check."""
+        with IMAPConnectionPool(max_connections=1) as pool:
+            with pool.connection(make_source(self.server, "NOC")):
+                pass
+            self.server.drop_connections()
+            with pool.connection(make_source(self.server, "NOC"), check_health=True) as imap:
+                self.assertEqual(imap.list_message_ids_in_folder("NOC"), [b"1"])
+
+    def test_makes_room_for_other_accounts(self):
+        """Test an idle connection of another account is closed when the pool is full."""
+        with FakeIMAPServer(FakeMailbox([make_ntt_notice("000003", 3)])) as other_server, IMAPConnectionPool(max_connections=1) as pool:
+            with pool.connection(make_source(self.server, "NOC")):
+                pass
+            with pool.connection(make_source(other_server)) as imap:
+                self.assertEqual(imap.list_message_ids_in_folder("INBOX"), [b"1"])
+            self.assertIn(("LOGOUT", ""), self.folders["NOC"].commands)
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Test inventory."""
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from manage_maintenance.inventory import CircuitEndpoint, CircuitInventory, normalize_cid
+from manage_maintenance.manage import MaintenanceNotification, ManageMaintenance
+from manage_maintenance.schedule import ScheduleStore
+
+
+EXAMPLE_CSV = os.path.join(os.path.dirname(os.path.dirname(__file__)), "examples", "circuit-db-1.csv")
+
+
+class CircuitInventoryTest(unittest.TestCase):
+    """CircuitInventory class test case."""
+
+    def setUp(self):
+        """Work in a temporary directory."""
+        self.directory = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.directory, "circuit_inventory.idx")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_normalize_cid(self):
+        """Test CIDs are compared without case or separators."""
+        self.assertEqual(normalize_cid(" abc-1234 xyz"), "ABC1234XYZ")
+
+    def test_lookup_from_csv(self):
+        """Test the example CSV is indexed, skipping its header comment."""
+        inventory = CircuitInventory.build_from_csv(EXAMPLE_CSV)
+        self.assertEqual(len(inventory), 1)
+        self.assertEqual(inventory.lookup("abc-1234-xyz"), (CircuitEndpoint("switch01.lab.local", "Ethernet1"),))
+        self.assertEqual(inventory.lookup("UNKNOWN"), ())
+        self.assertNotIn("UNKNOWN", inventory)
+
+    def test_multiple_endpoints(self):
+        """Test a CID with several endpoints returns all of them in file order."""
+        rows = [("CID{}".format(i), "switch{:02}".format(i % 7), "Ethernet{}".format(i)) for i in range(1000)]
+        rows.append(("CID5", "router01", "xe-0/0/0"))
+        inventory = CircuitInventory.build(rows)
+        self.assertEqual(len(inventory), 1000)
+        self.assertEqual(inventory.lookup("cid5"), (("switch05", "Ethernet5"), ("router01", "xe-0/0/0")))
+        for i in range(1000):
+            self.assertIn("CID{}".format(i), inventory)
+
+    def test_open_rebuilds_stale_index(self):
+        """Test a saved index is reused until the CSV changes."""
+        csv_path = os.path.join(self.directory, "circuits.csv")
+        shutil.copy(EXAMPLE_CSV, csv_path)
+        self.assertEqual(len(CircuitInventory.open(csv_path, self.index_path)), 1)
+        self.assertTrue(os.path.exists(self.index_path))
+        self.assertEqual(CircuitInventory.load(self.index_path).lookup("ABC1234XYZ")[0].hostname, "switch01.lab.local")
+
+        with open(csv_path, "a") as f:
+            f.write("\nDEF5678,switch02.lab.local,Ethernet2\n")
+        inventory = CircuitInventory.open(csv_path, self.index_path)
+        self.assertEqual(len(inventory), 2)
+        self.assertEqual(inventory.lookup("DEF5678"), (("switch02.lab.local", "Ethernet2"),))
+
+    def test_open_ignores_corrupt_index(self):
+        """Test an unreadable index file is rebuilt."""
+        with open(self.index_path, "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(len(CircuitInventory.open(EXAMPLE_CSV, self.index_path)), 1)
+
+
+class MaintenanceImpactTest(unittest.TestCase):
+    """Notification enrichment test case."""
+
+    def setUp(self):
+        """Build a notification for the example circuit."""
+        self.inventory = CircuitInventory.build_from_csv(EXAMPLE_CSV)
+        self.notification = MaintenanceNotification(
+            subject="Maintenance", start_time=datetime(2017, 12, 1, 1), end_time=datetime(2017, 12, 1, 3),
+            cid="ABC1234XYZ", partner="NTT", original_message="body", event_uuid="0123456789abcdef")
+
+    def test_add_impact(self):
+        """Test affected devices are added to notifications and their calendar description."""
+        manager = ManageMaintenance("user", "password", "imap.example.com", "INBOX", circuit_inventory=self.inventory)
+        notification = manager.add_impact(self.notification)
+        self.assertEqual(notification.affected_devices, (("switch01.lab.local", "Ethernet1"),))
+        description = ManageMaintenance._maintenance_event_fields(notification)["event_description"]
+        self.assertIn("Affected devices:\nswitch01.lab.local Ethernet1", description)
+
+        without_inventory = ManageMaintenance("user", "password", "imap.example.com", "INBOX")
+        self.assertEqual(without_inventory.add_impact(self.notification).affected_devices, ())
+
+    def test_schedule_round_trip(self):
+        """Test affected devices are stored with the schedule row."""
+        directory = tempfile.mkdtemp()
+        try:
+            with ScheduleStore(os.path.join(directory, "schedule.sqlite3")) as store:
+                store.upsert(self.notification._replace(affected_devices=self.inventory.lookup("ABC1234XYZ")))
+                self.assertEqual(store.get("0123456789abcdef")["affected_devices"], (("switch01.lab.local", "Ethernet1"),))
+        finally:
+            shutil.rmtree(directory)
@@ -1,14 +1,29 @@
 """Test manage."""
 import json
 import os
+import subprocess
+import sys
+import tempfile
 import unittest
 import pickle
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from datetime import datetime
 
 from tinydb import TinyDB
 
 import manage_maintenance.manage
+import run
+from benchmarks.corpus import generate_corpus
 from manage_maintenance.config import TestConfig
+from manage_maintenance.google_calendar import EventWriteResult, GoogleCalendar
 from manage_maintenance.manage import ManageMaintenance, MaintenanceNotification
+from manage_maintenance.request_scheduler import RequestScheduler
+from manage_maintenance.schedule import migrate_from_tinydb
+from tests.fake_calendar_api import FakeCalendarServer
+from tests.fake_imap_server import FakeIMAPServer, FakeMailbox
+from tests.test_manage_maintenance.test_coalesce import make_notification
 
 
 class ManageMaintenanceTest(unittest.TestCase):
@@ -19,16 +34,18 @@ class ManageMaintenanceTest(unittest.TestCase):
         self._previous_config = manage_maintenance.manage.config
         manage_maintenance.manage.config = self.config = TestConfig()
         self.notification = MaintenanceNotification(subject="Yo stuff is goin' down!",
-                                                    start_time="2017-12-01T01:00:00",
-                                                    end_time="2017-12-01T02:00:00",
+                                                    start_time=datetime(2017, 12, 1, 1, 0, 0),
+                                                    end_time=datetime(2017, 12, 1, 2, 0, 0),
                                                     cid="ABC1234XYZ",
                                                     partner="Netflix",
-                                                    original_message="Stuff is going down!")
-        with self.db() as db:
-            db.purge()
+                                                    original_message="Stuff is going down!",
+                                                    event_uuid="0123456789abcdef")
+        for file_name in (self.config.SCHEDULE_DB_FILE_NAME, self.config.SCHEDULE_FILE_NAME):
+            if os.path.exists(os.path.join(self.config.SCHEDULE_FILE_PATH, file_name)):
+                os.remove(os.path.join(self.config.SCHEDULE_FILE_PATH, file_name))
 
     def db(self):
-        return TinyDB(os.path.join(self.config.SCHEDULE_FILE_PATH, self.config.SCHEDULE_FILE_NAME))
+        return ManageMaintenance.open_schedule()
 
     def tearDown(self):
         manage_maintenance.manage.config = self._previous_config
@@ -39,6 +56,206 @@ class ManageMaintenanceTest(unittest.TestCase):
         with self.db() as db:
             self.assertIn(self.notification._asdict(), db.all())
 
+    def test_bulk_upsert_and_queries(self):
+        """Test reruns don't duplicate rows and time range and CID queries."""
+        notifications = [self.notification._replace(event_uuid="uuid{}".format(day), cid="CID{}".format(day % 2),
+                                                    start_time=datetime(2017, 12, day, 1), end_time=datetime(2017, 12, day, 5))
+                         for day in range(1, 11)]
+        ManageMaintenance.add_maintenances_to_schedule(notifications)
+        ManageMaintenance.add_maintenances_to_schedule(notifications)
+        with self.db() as db:
+            self.assertEqual(len(db), 10)
+            active = db.active_between(datetime(2017, 12, 3, 4), datetime(2017, 12, 4, 2))
+            self.assertEqual([row["event_uuid"] for row in active], ["uuid3", "uuid4"])
+            self.assertEqual([row["event_uuid"] for row in db.windows_for_cid("CID1")], ["uuid1", "uuid3", "uuid5", "uuid7", "uuid9"])
+
+    def test_migrate_from_tinydb(self):
+        """Test rows are copied from a TinyDB schedule."""
+        tinydb_file_path = os.path.join(self.config.SCHEDULE_FILE_PATH, self.config.SCHEDULE_FILE_NAME)
+        with TinyDB(tinydb_file_path) as tinydb:
+            tinydb.insert(dict(self.notification._asdict(), start_time="2017-12-01T01:00:00", end_time="2017-12-01T02:00:00"))
+            tinydb.insert(dict(self.notification._asdict(), start_time="2017-12-02T01:00:00", end_time="2017-12-02T02:00:00", event_uuid=None))
+        with self.db() as db:
+            self.assertEqual(migrate_from_tinydb(tinydb_file_path, db), 2)
+            self.assertEqual(db.get("0123456789abcdef"), self.notification._asdict())
+            self.assertEqual(len(db.windows_for_cid("ABC1234XYZ")), 2)
+
+
+def make_ntt_notice(cid, day, subject="Maintenance Notice"):
+    """Build a raw NTT maintenance notice."""
+    message = MIMEText("Circuit: {} Tokyo *Start Date/Time*: 2017-12-{:02d} 01:00 UTC *End Date/Time*: 2017-12-{:02d} 05:00 UTC".format(cid, day, day))
+    message["From"] = "NTT NOC <coins@noc.us.ntt.net>"
+    message["Subject"] = subject
+    return message.as_bytes()
+
+
+class ListMaintenancesTest(unittest.TestCase):
+    """Message parsing test case."""
+
+    def setUp(self):
+        """Setup notices."""
+        self.raw_messages = [make_ntt_notice("{:06d}".format(number), number) for number in range(1, 21)]
+        self.raw_messages.insert(5, make_ntt_notice("999999", 1, subject="Unrelated"))
+
+    def manager(self, parse_workers=0):
+        """Build a manager."""
+        return ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX", parse_workers=parse_workers)
+
+    def test_parse_messages(self):
+        """Test matching messages become notifications."""
+        manager = self.manager()
+        notifications = list(manager._parse_messages(self.raw_messages))
+        self.assertEqual([notification.cid for notification in notifications], ["{:06d}".format(number) for number in range(1, 21)])
+        self.assertEqual(notifications[0].partner, "NTT")
+        self.assertEqual(notifications[0].start_time.isoformat(), "2017-12-01T01:00:00")
+        statistics = {entry["pattern_id"]: entry for entry in manager.notification_pattern_statistics()}
+        self.assertEqual(statistics["ntt.yml#0"]["extractions"], 20)
+
+    def test_extract_prefers_declared_part_and_charset(self):
+        """Test the declared part type is searched first and decoded with its charset."""
+        message = MIMEMultipart()
+        message["From"] = "NTT NOC <coins@noc.us.ntt.net>"
+        message["Subject"] = "Maintenance Notice"
+        message.attach(MIMEText("<p>Circuit: 000000 Tokyo</p>", "html"))
+        message.attach(MIMEImage(b"GIF89a" + b"\x00" * 1024, "gif"))
+        message.attach(MIMEText("Circuit: 123456 Zürich\n*Start Date/Time*: 2017-12-01 01:00 UTC\n*End Date/Time*: 2017-12-01 05:00 UTC", "plain", "iso-8859-1"))
+        manager = self.manager()
+        notification_pattern = manager._match_message_headers(message)[0]
+        cid, windows, original_message = ManageMaintenance._extract_info_from_message(message, notification_pattern)
+        self.assertEqual((cid, windows[0].start_time, windows[0].end_time), ("123456", "2017-12-01 01:00", "2017-12-01 05:00"))
+        self.assertTrue(original_message.startswith("Circuit: 123456 Zürich\n"))
+
+    def test_list_maintenances_from_corpus(self):
+        """Test every notice in a synthetic mailbox is found over IMAP, and only once."""
+        previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = config = TestConfig()
+        checkpoint_file = os.path.join(config.SCHEDULE_FILE_PATH, config.IMAP_CHECKPOINT_FILE_NAME)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        corpus = list(generate_corpus(60, seed=1))
+        try:
+            with FakeIMAPServer(FakeMailbox(raw_message for _, raw_message in corpus)) as server:
+                manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address=server.address[0], imap_folder="INBOX",
+                                            imap_port=server.address[1], imap_ssl=False, imap_fetch_chunk_size=7)
+                notifications = list(manager.list_maintenances(since="1-Oct-2017"))
+                self.assertEqual(len(notifications), sum(1 for kind, _ in corpus if kind != "unrelated"))
+                self.assertEqual({notification.partner for notification in notifications}, {"NTT", "Level 3"})
+                self.assertEqual(list(manager.list_maintenances(since="1-Oct-2017")), [])
+                manager.disconnect_imap()
+        finally:
+            manage_maintenance.manage.config = previous_config
+
+    def test_deferred_checkpoint(self):
+        """Test a deferred checkpoint only advances once no write failed transiently."""
+        previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = config = TestConfig()
+        checkpoint_file = os.path.join(config.SCHEDULE_FILE_PATH, config.IMAP_CHECKPOINT_FILE_NAME)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        corpus = list(generate_corpus(10, seed=2, mix=(("ntt_plain", 1.0),)))
+        try:
+            with FakeIMAPServer(FakeMailbox(raw_message for _, raw_message in corpus)) as server:
+                manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address=server.address[0], imap_folder="INBOX",
+                                            imap_port=server.address[1], imap_ssl=False)
+                notifications = list(manager.list_maintenances(since="1-Oct-2017", defer_checkpoint=True))
+                self.assertEqual(len(notifications), 10)
+                results = [EventWriteResult(notification.event_uuid, "insert", "created", None, None) for notification in notifications]
+                self.assertFalse(manager.commit_checkpoints(results[:9] + [results[9]._replace(status="queued")]))
+                self.assertEqual(list(manager.list_maintenances(since="1-Oct-2017", defer_checkpoint=True)), notifications)
+                self.assertTrue(manager.commit_checkpoints(results[:9] + [results[9]._replace(status="failed")]))
+                self.assertEqual(list(manager.list_maintenances(since="1-Oct-2017")), [])
+                manager.disconnect_imap()
+        finally:
+            manage_maintenance.manage.config = previous_config
+
+    def test_failed_calendar_writes_are_listed_again(self):
+        """Test notices whose calendar inserts failed transiently are listed again by the next run, and those that failed for good aren't."""
+        previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = config = TestConfig()
+        checkpoint_file = os.path.join(config.SCHEDULE_FILE_PATH, config.IMAP_CHECKPOINT_FILE_NAME)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        corpus = list(generate_corpus(3, seed=2, mix=(("ntt_plain", 1.0),)))
+        try:
+            with FakeIMAPServer(FakeMailbox(raw_message for _, raw_message in corpus)) as imap_server, FakeCalendarServer() as calendar_server, \
+                    tempfile.TemporaryDirectory() as temp_dir:
+                calendar = GoogleCalendar(service=calendar_server.build_service(), mirror_file_path=os.path.join(temp_dir, "calendar_mirror.json"),
+                                          retry_queue_file=os.path.join(temp_dir, "calendar_retry_queue.json"),
+                                          scheduler=RequestScheduler(requests_per_second=None, max_retries=1, sleep=lambda seconds: None))
+                calendar.sync_mirror()
+                manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address=imap_server.address[0], imap_folder="INBOX",
+                                            imap_port=imap_server.address[1], imap_ssl=False, google_calendar=calendar)
+                # Still failing after the retry, so queued for the next run, which replays them and sees them listed again
+                calendar_server.api.fail_next(6, 503, "backendError")
+                self.assertEqual([result.status for result in run.write_maintenances(manager)], ["queued"] * 3)
+                self.assertEqual([result.status for result in run.write_maintenances(manager)], ["exists"] * 3)
+                self.assertEqual(len(calendar_server.api.events()), 3)
+                self.assertEqual(run.write_maintenances(manager), [])
+
+                imap_server.mailbox.append(list(generate_corpus(4, seed=5, mix=(("ntt_plain", 1.0),)))[-1][1])
+                calendar_server.api.fail_next(1, 400, "badRequest")
+                self.assertEqual([result.status for result in run.write_maintenances(manager)], ["failed"])
+                self.assertEqual(run.write_maintenances(manager), [])
+                manager.disconnect_imap()
+        finally:
+            manage_maintenance.manage.config = previous_config
+
+    def test_batch_writes_leave_retry_queue(self):
+        """Test batch writes don't replay queued writes, which are sent once per run instead."""
+        with FakeCalendarServer() as calendar_server, tempfile.TemporaryDirectory() as temp_dir:
+            calendar = GoogleCalendar(service=calendar_server.build_service(), mirror_file_path=os.path.join(temp_dir, "calendar_mirror.json"),
+                                      retry_queue_file=os.path.join(temp_dir, "calendar_retry_queue.json"),
+                                      scheduler=RequestScheduler(requests_per_second=None, max_retries=1, sleep=lambda seconds: None))
+            calendar.sync_mirror()
+            manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX", google_calendar=calendar)
+            calendar_server.api.fail_next(2, 503, "backendError")
+            self.assertEqual([result.status for result in manager.add_maintenances_to_calendar([make_notification(1, 9)])], ["queued"])
+            self.assertEqual([result.status for result in manager.add_maintenances_to_calendar([make_notification(2, 9)])], ["created"])
+            self.assertEqual(len(calendar.retry_queue), 1)
+            self.assertEqual([result.status for result in manager.replay_failed_calendar_writes()], ["created"])
+            self.assertEqual(len(calendar_server.api.events()), 2)
+
+    def test_header_first_fetch(self):
+        """Test only messages whose headers match a pattern are downloaded."""
+        previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = config = TestConfig()
+        checkpoint_file = os.path.join(config.SCHEDULE_FILE_PATH, config.IMAP_CHECKPOINT_FILE_NAME)
+        corpus = list(generate_corpus(60, seed=3, mix=(("ntt_plain", 0.2), ("unrelated", 0.8))))
+        try:
+            with FakeIMAPServer(FakeMailbox(raw_message for _, raw_message in corpus)) as server:
+                results = []
+                for header_first_fetch in (False, True):
+                    if os.path.exists(checkpoint_file):
+                        os.remove(checkpoint_file)
+                    del server.mailbox.commands[:]
+                    fetched_bytes = server.mailbox.fetched_bytes
+                    manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address=server.address[0], imap_folder="INBOX",
+                                                imap_port=server.address[1], imap_ssl=False, imap_fetch_chunk_size=7, header_first_fetch=header_first_fetch)
+                    notifications = list(manager.list_maintenances(since="1-Oct-2017"))
+                    manager.disconnect_imap()
+                    body_uids = [uid for command, arguments in server.mailbox.commands if command == "UID" and "BODY.PEEK[]" in arguments
+                                 for uid in server.mailbox.message_set(arguments.split()[1])]
+                    results.append((notifications, body_uids, server.mailbox.fetched_bytes - fetched_bytes))
+            (notifications, _, all_bytes), (screened_notifications, body_uids, screened_bytes) = results
+            self.assertEqual(screened_notifications, notifications)
+            self.assertEqual(len(body_uids), sum(1 for kind, _ in corpus if kind == "ntt_plain"))
+            self.assertLess(screened_bytes, all_bytes / 2)
+        finally:
+            manage_maintenance.manage.config = previous_config
+
+    def test_parse_messages_in_pool(self):
+        """Test the process pool yields the same notifications in mailbox order."""
+        serial = list(self.manager()._parse_messages(self.raw_messages))
+        parallel = list(self.manager(parse_workers=2)._parse_messages_in_pool(self.raw_messages))
+        self.assertEqual(parallel, serial)
+
+    def test_import_leaves_google_client_unloaded(self):
+        """Test importing manage or the entry points doesn't import the Google API client, which only calendar writes need."""
+        code = ("import sys, manage_maintenance.manage, run, run_daemon; "
+                "print(sorted(name for name in sys.modules if name.split('.')[0] in ('apiclient', 'googleapiclient', 'oauth2client')))")
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        self.assertEqual(output.strip(), b"[]")
+
 
 def main():
     """Main."""
@@ -0,0 +1,122 @@
+"""Test metrics."""
+import json
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.metrics import METRICS, Metrics
+from tests.test_manage_maintenance.test_manage import make_ntt_notice
+
+
+class MetricsTest(unittest.TestCase):
+    """Metrics class test case."""
+
+    def test_disabled_records_nothing(self):
+        """Test a disabled instance ignores counters and timers."""
+        metrics = Metrics()
+        metrics.increment("messages_total")
+        with metrics.timer("fetch_seconds"):
+            pass
+        self.assertEqual(metrics.summary(), {"counters": [], "timers": []})
+
+    def test_prometheus_text(self):
+        """Test counters and histograms render in the Prometheus text format."""
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.enable()
+        metrics.increment("notifications_extracted_total", partner="NTT")
+        metrics.increment("notifications_extracted_total", 2, partner="NTT")
+        metrics.observe("calendar_api_call_seconds", 0.5, method="insert")
+        metrics.observe("calendar_api_call_seconds", 2.0, method="insert")
+        self.assertEqual(metrics.prometheus_text().splitlines(), [
+            "# TYPE manage_maintenance_notifications_extracted_total counter",
+            'manage_maintenance_notifications_extracted_total{partner="NTT"} 3',
+            "# TYPE manage_maintenance_calendar_api_call_seconds histogram",
+            'manage_maintenance_calendar_api_call_seconds_bucket{method="insert",le="0.1"} 0',
+            'manage_maintenance_calendar_api_call_seconds_bucket{method="insert",le="1.0"} 1',
+            'manage_maintenance_calendar_api_call_seconds_bucket{method="insert",le="+Inf"} 2',
+            'manage_maintenance_calendar_api_call_seconds_sum{method="insert"} 2.5',
+            'manage_maintenance_calendar_api_call_seconds_count{method="insert"} 2',
+        ])
+
+    def test_drain_and_merge(self):
+        """Test state drained from one instance adds up in another."""
+        worker = Metrics()
+        worker.enable()
+        worker.increment("messages_total")
+        worker.observe("parse_seconds", 0.2)
+        parent = Metrics()
+        parent.enable()
+        parent.increment("messages_total")
+        parent.merge(worker.drain())
+        self.assertEqual(parent.counter_value("messages_total"), 2)
+        self.assertEqual(parent.timer_count("parse_seconds"), 1)
+        self.assertEqual(worker.summary(), {"counters": [], "timers": []})
+
+    def test_write_and_serve(self):
+        """Test the JSON summary file and the HTTP endpoint."""
+        metrics = Metrics()
+        metrics.enable()
+        metrics.increment("imap_reconnects_total")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "metrics.json")
+            metrics.write_json(file_path)
+            with open(file_path) as f:
+                self.assertEqual(json.load(f)["counters"], [{"name": "imap_reconnects_total", "labels": {}, "value": 1}])
+        server = metrics.serve(0, address="127.0.0.1")
+        try:
+            with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1])) as response:
+                self.assertIn(b"manage_maintenance_imap_reconnects_total 1", response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class ParseMetricsTest(unittest.TestCase):
+    """Parse instrumentation test case."""
+
+    def setUp(self):
+        """Enable the shared metrics."""
+        METRICS.reset()
+        METRICS.enable()
+        incomplete = make_ntt_notice("000001", 1).replace(b"*End Date/Time*", b"*Ends*")
+        self.raw_messages = [make_ntt_notice("{:06d}".format(number), number) for number in range(2, 6)] + [incomplete]
+        self.raw_messages.append(make_ntt_notice("999999", 1, subject="Unrelated"))
+
+    def tearDown(self):
+        METRICS.disable()
+        METRICS.reset()
+
+    def manager(self, parse_workers=0):
+        """Build a manager."""
+        return ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX", parse_workers=parse_workers)
+
+    def assert_parse_metrics(self):
+        """Check the counters and timers recorded for self.raw_messages."""
+        self.assertEqual(METRICS.counter_value("pattern_header_matches_total", partner="NTT"), 5)
+        self.assertEqual(METRICS.counter_value("pattern_header_misses_total", partner="NTT"), 1)
+        self.assertEqual(METRICS.counter_value("notifications_extracted_total", partner="NTT"), 4)
+        self.assertEqual(METRICS.counter_value("notifications_incomplete_total", partner="NTT"), 1)
+        self.assertEqual(METRICS.timer_count("time_parse_seconds", partner="NTT"), 5)
+        self.assertGreaterEqual(METRICS.timer_count("pattern_match_seconds", pattern="ntt.yml#0"), 5)
+        self.assertGreaterEqual(METRICS.timer_count("mime_walk_seconds"), 10)
+
+    def test_serial_parse(self):
+        """Test parsing records per-partner counters and stage timers."""
+        list(self.manager()._parse_messages(self.raw_messages))
+        self.assert_parse_metrics()
+
+    def test_pool_parse(self):
+        """Test metrics recorded in parse worker processes reach the parent."""
+        list(self.manager(parse_workers=2)._parse_messages_in_pool(self.raw_messages))
+        self.assert_parse_metrics()
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
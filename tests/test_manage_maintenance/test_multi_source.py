@@ -0,0 +1,87 @@
+"""Test reading maintenances from several mailbox sources."""
+import imaplib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import manage_maintenance.multi_source
+from manage_maintenance.config import TestConfig
+from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.multi_source import MultiSourceMaintenance
+from tests.fake_imap_server import FakeIMAPServer, FakeMailbox
+from tests.test_manage_maintenance.test_imap_pool import make_source
+from tests.test_manage_maintenance.test_manage import make_ntt_notice
+
+
+class MultiSourceMaintenanceTest(unittest.TestCase):
+    """MultiSourceMaintenance class test case."""
+
+    def setUp(self):
+        """Serve two folders of one account and the inbox of another, with one notice in both accounts."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.previous_config = manage_maintenance.multi_source.config
+        manage_maintenance.multi_source.config = TestConfig()
+        manage_maintenance.multi_source.config.SCHEDULE_FILE_PATH = self.temp_dir.name
+        shared_notice = make_ntt_notice("000099", 9)
+        self.noc_server = FakeIMAPServer(folders={
+            "NOC": FakeMailbox([make_ntt_notice("{:06d}".format(number), number) for number in range(1, 8)] + [shared_notice]),
+            "Partners": FakeMailbox([make_ntt_notice("{:06d}".format(number), number) for number in range(10, 15)]),
+        })
+        self.other_server = FakeIMAPServer(FakeMailbox([shared_notice, make_ntt_notice("000020", 20), make_ntt_notice("999999", 1, subject="Unrelated")]))
+        self.noc_server.__enter__()
+        self.other_server.__enter__()
+        self.sources = [make_source(self.noc_server, "NOC"), make_source(self.noc_server, "Partners"), make_source(self.other_server)]
+
+    def tearDown(self):
+        """Stop the servers and restore the config."""
+        self.noc_server.__exit__()
+        self.other_server.__exit__()
+        manage_maintenance.multi_source.config = self.previous_config
+        self.temp_dir.cleanup()
+
+    def list_maintenances(self, sources=None):
+        """Read every source once."""
+        multi_source = MultiSourceMaintenance(sources or self.sources, max_connections=2, shard_size=3)
+        try:
+            return list(multi_source.list_maintenances(since="1-Oct-2017"))
+        finally:
+            multi_source.close()
+
+    def test_merged_and_deduplicated(self):
+        """Test every source is read, each event once, and checkpoints stop repeats."""
+        notifications = self.list_maintenances()
+        self.assertEqual(sorted(notification.cid for notification in notifications),
+                         ["{:06d}".format(number) for number in list(range(1, 8)) + list(range(10, 15)) + [20, 99]])
+        self.assertEqual(self.list_maintenances(), [])
+
+    def test_retries_dropped_shard(self):
+        """Test a shard whose session drops is fetched again on a fresh connection."""
+        fetch_raw_messages = ManageMaintenance.fetch_raw_messages
+        calls = []
+
+        def flaky_fetch(manager, email_ids, imap=None):
+            calls.append(email_ids)
+            if len(calls) == 1:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            return fetch_raw_messages(manager, email_ids, imap=imap)
+        with mock.patch.object(ManageMaintenance, "fetch_raw_messages", flaky_fetch):
+            notifications = self.list_maintenances()
+        self.assertEqual(len(notifications), 14)
+
+    def test_failed_source(self):
+        """Test a failing source doesn't stop the others, which are checkpointed, and its error is raised at the end."""
+        sources = self.sources + [make_source(self.noc_server, "Missing")]
+        with self.assertRaises(Exception):
+            self.list_maintenances(sources)
+        self.assertEqual(self.list_maintenances(), [])
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, TestConfig.IMAP_CHECKPOINT_FILE_NAME)))
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Test overlap."""
+import unittest
+from datetime import datetime, timezone
+
+from manage_maintenance.overlap import OverlapIndex, parse_event_interval
+
+
+def make_event(event_id, start, end, summary=None):
+    """Build a Calendar API event from 'YYYY-MM-DD HH:MM' strings or all-day dates."""
+    def event_time(value):
+        return {"date": value} if len(value) == 10 else {"dateTime": value.replace(" ", "T") + ":00Z"}
+    return {"id": event_id, "summary": summary or "Scheduled Maintenance: NTT {}".format(event_id), "start": event_time(start), "end": event_time(end)}
+
+
+class OverlapIndexTest(unittest.TestCase):
+    """OverlapIndex class test case."""
+
+    def setUp(self):
+        """Index a handful of events."""
+        self.events = [
+            make_event("a", "2017-12-01 01:00", "2017-12-01 03:00"),
+            make_event("b", "2017-12-01 02:00", "2017-12-01 04:00"),
+            make_event("c", "2017-12-01 04:00", "2017-12-01 05:00"),
+            make_event("d", "2017-12-03", "2017-12-04", summary="Holiday"),
+            make_event("e", "2017-12-03 10:00", "2017-12-03 11:00"),
+            make_event("f", "2017-11-01 00:00", "2017-12-31 00:00"),
+            {"id": "broken", "start": {}, "end": {}},
+        ]
+        self.index = OverlapIndex(self.events)
+
+    def test_parse_all_day_event(self):
+        """Test all-day events parse from their dates."""
+        interval = parse_event_interval(make_event("d", "2017-12-03", "2017-12-04"))
+        self.assertEqual(interval.start, datetime(2017, 12, 3, tzinfo=timezone.utc))
+
+    def test_find_overlap_groups(self):
+        """Test each overlapping group is reported once and back-to-back events don't overlap."""
+        index = OverlapIndex([event for event in self.events if event["id"] != "f"])
+        self.assertEqual([[interval.event_id for interval in group] for group in index.find_overlap_groups()], [["a", "b"], ["d", "e"]])
+        self.assertEqual(len(self.index.find_overlap_groups()), 1)
+
+    def test_overlapping_window(self):
+        """Test window and CID queries."""
+        overlapping = self.index.overlapping(datetime(2017, 12, 1, 3, 30), datetime(2017, 12, 1, 4, 30))
+        self.assertEqual([interval.event_id for interval in overlapping], ["f", "b", "c"])
+        overlapping = self.index.overlapping(datetime(2017, 12, 1, 0, 0), datetime(2017, 12, 2, 0, 0), cids=["a", "e"])
+        self.assertEqual([interval.event_id for interval in overlapping], ["a"])
+        self.assertEqual(self.index.overlapping(datetime(2018, 1, 1), datetime(2018, 1, 2)), [])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Test the parse cache."""
+import os
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+import manage_maintenance.manage
+from benchmarks.corpus import generate_corpus
+from manage_maintenance.config import TestConfig
+from manage_maintenance.manage import ManageMaintenance, MaintenanceNotification
+from manage_maintenance.parse_cache import CachedMaintenance, ParseCache, pattern_source_fingerprints
+from manage_maintenance.patterns import NotificationPatternEngine
+from tests.fake_imap_server import FakeIMAPServer, FakeMailbox
+
+
+def make_maintenance(cid, start_time=datetime(2017, 12, 1, 1), partner="NTT"):
+    """Build a maintenance notification."""
+    end_time = start_time + timedelta(hours=4)
+    return MaintenanceNotification(subject="Maintenance Notice", start_time=start_time, end_time=end_time, cid=cid, partner=partner, original_message="body",
+                                   event_uuid=ManageMaintenance._generate_maintenance_uuid(cid, start_time, end_time))
+
+
+class ParseCacheTest(unittest.TestCase):
+    """ParseCache class test case."""
+
+    def setUp(self):
+        """Open a cache in a temporary directory."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ParseCache(os.path.join(self.temp_dir.name, "parse_cache.sqlite3"), max_entries=6)
+        self.fingerprints = {"ntt.yml": "a", "level3.yml": "b"}
+
+    def tearDown(self):
+        """Remove the cache."""
+        self.cache.close()
+        self.temp_dir.cleanup()
+
+    def test_round_trip(self):
+        """Test only the compact fields are stored and times keep their UTC offset."""
+        aware = make_maintenance("000002", start_time=datetime(2017, 12, 2, 1, tzinfo=timezone(timedelta(hours=9))))
+        self.cache.put_many([("message-id:<1@ntt>", {"ntt.yml": [make_maintenance("000001"), aware]}), ("message-id:<2@ntt>", {})], self.fingerprints)
+        cached = self.cache.get_many(["message-id:<1@ntt>", "message-id:<2@ntt>", "message-id:<3@ntt>"], self.fingerprints)
+        self.assertEqual(cached["message-id:<2@ntt>"], {"ntt.yml": [], "level3.yml": []})
+        self.assertNotIn("message-id:<3@ntt>", cached)
+        self.assertEqual(cached["message-id:<1@ntt>"]["level3.yml"], [])
+        first, second = cached["message-id:<1@ntt>"]["ntt.yml"]
+        self.assertEqual(first, CachedMaintenance(cid="000001", start_time=datetime(2017, 12, 1, 1), end_time=datetime(2017, 12, 1, 5), partner="NTT",
+                                                  event_uuid=make_maintenance("000001").event_uuid, reference=None, cancelled=False))
+        self.assertEqual(second.start_time, aware.start_time)
+        self.assertEqual(second.start_time.utcoffset(), timedelta(hours=9))
+
+    def test_changed_source_invalidates(self):
+        """Test only the rows of a source whose fingerprint changed are left out."""
+        self.cache.put_many([("message-id:<1@ntt>", {"ntt.yml": [make_maintenance("000001")]})], self.fingerprints)
+        self.assertEqual(set(self.cache.get("message-id:<1@ntt>", dict(self.fingerprints, **{"level3.yml": "changed"}))), {"ntt.yml"})
+        self.assertEqual(set(self.cache.get("message-id:<1@ntt>", dict(self.fingerprints, **{"zayo.yml": "c"}))), {"ntt.yml", "level3.yml"})
+        self.assertIsNone(self.cache.get("message-id:<1@ntt>", {"ntt.yml": "changed"}))
+
+    def test_eviction(self):
+        """Test the least recently used messages go once the cache is full."""
+        self.cache.put_many([("message-id:<{}@ntt>".format(number), {}) for number in range(3)], self.fingerprints)
+        self.cache.get("message-id:<0@ntt>", self.fingerprints)
+        self.cache.put_many([("message-id:<3@ntt>", {})], self.fingerprints)
+        self.assertEqual(len(self.cache), 6)
+        self.assertIsNotNone(self.cache.get("message-id:<0@ntt>", self.fingerprints))
+        self.assertIsNone(self.cache.get("message-id:<1@ntt>", self.fingerprints))
+
+    def test_fingerprints_per_source(self):
+        """Test editing one pattern only changes its own source's fingerprint."""
+        engine = NotificationPatternEngine()
+        engine.add({"partner_name": "NTT", "maintenance_cid_pattern": "(.*)", "maintenance_start_time_pattern": "(.*)", "maintenance_end_time_pattern": "(.*)"}, "ntt.yml#0")
+        engine.add({"partner_name": "Zayo", "maintenance_cid_pattern": "(.*)", "maintenance_start_time_pattern": "(.*)", "maintenance_end_time_pattern": "(.*)"}, "zayo.yml#0")
+        before = pattern_source_fingerprints(engine)
+        list(engine)[1].config["email_subject_pattern"] = "Maintenance"
+        after = pattern_source_fingerprints(engine)
+        self.assertEqual(before["ntt.yml"], after["ntt.yml"])
+        self.assertNotEqual(before["zayo.yml"], after["zayo.yml"])
+
+
+class ListMaintenancesWithCacheTest(unittest.TestCase):
+    """list_maintenances with a parse cache test case."""
+
+    def setUp(self):
+        """Serve a synthetic mailbox and point the checkpoints at a temporary directory."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = TestConfig()
+        manage_maintenance.manage.config.SCHEDULE_FILE_PATH = self.temp_dir.name
+        self.corpus = list(generate_corpus(40, seed=2))
+        self.server = FakeIMAPServer(FakeMailbox(raw_message for _, raw_message in self.corpus))
+        self.server.__enter__()
+        self.cache = ParseCache(os.path.join(self.temp_dir.name, "parse_cache.sqlite3"))
+
+    def tearDown(self):
+        """Stop the server and restore the config."""
+        self.cache.close()
+        self.server.__exit__()
+        manage_maintenance.manage.config = self.previous_config
+        self.temp_dir.cleanup()
+
+    def list_maintenances(self):
+        """List the mailbox from scratch, returning the manager and what fetch_bodies_while returns."""
+        checkpoint_file = os.path.join(self.temp_dir.name, TestConfig.IMAP_CHECKPOINT_FILE_NAME)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address=self.server.address[0], imap_folder="INBOX",
+                                    imap_port=self.server.address[1], imap_ssl=False, imap_fetch_chunk_size=9, parse_cache=self.cache)
+        return manager, self.fetch_bodies_while(lambda: list(manager.list_maintenances(since="1-Oct-2017")), manager)
+
+    def fetch_bodies_while(self, function, manager):
+        """Return function's result, the body FETCH commands it sent and the bytes it fetched."""
+        fetched_bytes = self.server.mailbox.fetched_bytes
+        del self.server.mailbox.commands[:]
+        result = function()
+        manager.disconnect_imap()
+        body_fetches = [arguments for command, arguments in self.server.mailbox.commands if command == "UID" and "BODY.PEEK[]" in arguments]
+        return result, body_fetches, self.server.mailbox.fetched_bytes - fetched_bytes
+
+    def test_cached_messages_skip_bodies(self):
+        """Test a second pass fetches headers only and finds the same maintenances."""
+        _, (first, _, first_bytes) = self.list_maintenances()
+        _, (second, body_fetches, second_bytes) = self.list_maintenances()
+        self.assertEqual(len(first), sum(1 for kind, _ in self.corpus if kind != "unrelated"))
+        self.assertEqual([(notification.cid, notification.event_uuid, notification.subject) for notification in second],
+                         [(notification.cid, notification.event_uuid, notification.subject) for notification in first])
+        self.assertEqual(body_fetches, [])
+        self.assertLess(second_bytes, first_bytes / 5)
+
+    def test_edited_patterns_reparse_their_messages(self):
+        """Test editing one partner's patterns only re-parses messages for that partner."""
+        manager, (first, _, _) = self.list_maintenances()
+        ntt_patterns = [notification_pattern for notification_pattern in manager._notification_patterns if notification_pattern.partner_name == "NTT"]
+        ntt_uids = {uid for uid, raw_message in self.server.mailbox.messages.items() if b"ntt.net" in raw_message}
+
+        original_engine = NotificationPatternEngine.from_directory
+
+        def edited_engine(patterns_glob):
+            engine = original_engine(patterns_glob)
+            for notification_pattern in engine:
+                if notification_pattern.source == ntt_patterns[0].source:
+                    notification_pattern.config["comment"] = "edited"
+            return engine
+        with mock.patch.object(NotificationPatternEngine, "from_directory", edited_engine):
+            _, (second, body_fetches, _) = self.list_maintenances()
+        refetched_uids = {uid for arguments in body_fetches for uid in self.server.mailbox.message_set(arguments.split()[1])}
+        self.assertEqual(refetched_uids, ntt_uids)
+        self.assertEqual([notification.event_uuid for notification in second], [notification.event_uuid for notification in first])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
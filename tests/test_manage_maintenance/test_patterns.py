@@ -0,0 +1,73 @@
+"""Test patterns."""
+import os
+import unittest
+
+from manage_maintenance.patterns import NotificationPatternEngine, sender_domain_from_pattern
+
+
+PATTERNS_GLOB = os.path.join(os.path.dirname(__file__), "..", "..", "notification_patterns", "*.yml")
+
+
+class NotificationPatternEngineTest(unittest.TestCase):
+    """NotificationPatternEngine class test case."""
+
+    def setUp(self):
+        """Load the shipped notification patterns."""
+        self.engine = NotificationPatternEngine.from_directory(PATTERNS_GLOB)
+
+    def test_sender_domain_from_pattern(self):
+        """Test literal sender patterns pinned to the whole domain are indexed by it."""
+        self.assertEqual(sender_domain_from_pattern("coins@noc\\.us\\.ntt\\.net>?$"), "noc.us.ntt.net")
+        self.assertEqual(sender_domain_from_pattern("\\.level3\\.com>"), "level3.com")
+        self.assertIsNone(sender_domain_from_pattern("coins@noc\\.us\\.ntt\\.net"))
+        self.assertIsNone(sender_domain_from_pattern("level3\\.com$"))
+        self.assertIsNone(sender_domain_from_pattern(".*@(level3|centurylink)\\.com$"))
+
+    def test_partial_domain_patterns(self):
+        """Test patterns naming part of a domain are always candidates, so they match like a regex scan would."""
+        engine = NotificationPatternEngine([
+            {"partner_name": "NTT", "email_domain_pattern": "noc\\.us\\.ntt", "maintenance_cid_pattern": "(\\d+)",
+             "maintenance_start_time_pattern": "(\\d+)", "maintenance_end_time_pattern": "(\\d+)"},
+            {"partner_name": "Level 3", "email_domain_pattern": "@level3\\.co", "maintenance_cid_pattern": "(\\d+)",
+             "maintenance_start_time_pattern": "(\\d+)", "maintenance_end_time_pattern": "(\\d+)"},
+        ])
+        self.assertEqual([pattern.partner_name for pattern in engine.match("NTT NOC <coins@noc.us.ntt.net>", "Maintenance")], ["NTT"])
+        self.assertEqual([pattern.partner_name for pattern in engine.match("no-reply@level3.com", "Initial")], ["Level 3"])
+
+    def test_candidates_by_sender_domain(self):
+        """Test only patterns indexed under the sender's domain are candidates."""
+        candidates = self.engine.candidates("NTT NOC <coins@noc.us.ntt.net>")
+        self.assertEqual([pattern.partner_name for pattern in candidates], ["NTT"])
+        self.assertEqual(self.engine.candidates("someone@example.com"), [])
+
+    def test_fallback_patterns_and_statistics(self):
+        """Test regex-only senders are always candidates and matches are counted."""
+        fallback = self.engine.add({
+            "partner_name": "Example",
+            "email_domain_pattern": "@(example|sample)\\.com",
+            "maintenance_cid_pattern": "(\\d+)",
+            "maintenance_start_time_pattern": "(\\d+)",
+            "maintenance_end_time_pattern": "(\\d+)",
+        }, pattern_id="inline#0")
+        self.assertEqual(self.engine.match("noc@sample.com", "Maintenance"), [fallback])
+        self.assertEqual(self.engine.match("no-reply@level3.com", "Initial notice")[0].partner_name, "Level 3")
+        statistics = {entry["pattern_id"]: entry for entry in self.engine.match_statistics()}
+        self.assertEqual(statistics["inline#0"]["candidates"], 2)
+        self.assertEqual(statistics["inline#0"]["header_matches"], 1)
+        self.assertEqual(statistics["ntt.yml#0"]["candidates"], 0)
+
+    def test_matches_any(self):
+        """Test screening headers finds matches without counting them."""
+        self.assertTrue(self.engine.matches_any("NTT NOC <coins@noc.us.ntt.net>", "Maintenance Notice"))
+        self.assertFalse(self.engine.matches_any("NTT NOC <coins@noc.us.ntt.net>", "Maintenance Notice", sources={"level3.yml"}))
+        self.assertFalse(self.engine.matches_any("someone@example.com", "Maintenance Notice"))
+        self.assertEqual({entry["candidates"] for entry in self.engine.match_statistics()}, {0})
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Test pipeline."""
+import os
+import threading
+import unittest
+from collections import namedtuple
+
+import manage_maintenance.manage
+from manage_maintenance.config import TestConfig
+from manage_maintenance.imap import IMAP
+from manage_maintenance.manage import ManageMaintenance
+from manage_maintenance.pipeline import MaintenancePipeline
+from tests.test_manage_maintenance.test_imap import FakeIMAP4
+from tests.test_manage_maintenance.test_manage import make_ntt_notice
+
+
+class RecordingSink(object):
+    """Thread-safe sink that records the notifications it is handed."""
+
+    def __init__(self, on_batch=None):
+        self.batches = []
+        self.on_batch = on_batch
+        self._lock = threading.Lock()
+
+    def __call__(self, maintenance_notifications):
+        """Record a batch."""
+        with self._lock:
+            self.batches.append(maintenance_notifications)
+        if self.on_batch:
+            self.on_batch(maintenance_notifications)
+        return [maintenance_notification.cid for maintenance_notification in maintenance_notifications]
+
+    def cids(self):
+        """Return every recorded CID, sorted."""
+        return sorted(maintenance_notification.cid for batch in self.batches for maintenance_notification in batch)
+
+
+class WriteResult(namedtuple("WriteResult", ("cid", "status"))):
+    """Sink result with a status."""
+
+
+class MaintenancePipelineTest(unittest.TestCase):
+    """MaintenancePipeline class test case."""
+
+    def setUp(self):
+        """Setup a manager reading NTT notices from a fake IMAP server."""
+        self._previous_config = manage_maintenance.manage.config
+        manage_maintenance.manage.config = self.config = TestConfig()
+        checkpoint_file = os.path.join(self.config.SCHEDULE_FILE_PATH, self.config.IMAP_CHECKPOINT_FILE_NAME)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+        self.fake = FakeIMAP4(message_count=0)
+        self.fake.messages = {number: make_ntt_notice("{:06d}".format(number), number % 28 + 1) for number in range(1, 41)}
+        self.manager = ManageMaintenance(imap_username="user", imap_password="pass", imap_address="localhost", imap_folder="INBOX", imap_fetch_chunk_size=3)
+        self.manager._ManageMaintenance__imap_server = self.imap()
+        self.manager.open_imap_folder = self.imap
+
+    def tearDown(self):
+        manage_maintenance.manage.config = self._previous_config
+
+    def imap(self):
+        """Return an IMAP wrapper around the fake server."""
+        imap = IMAP(username="user", password="pass", address="localhost")
+        imap._imap = self.fake
+        return imap
+
+    def test_run_processes_every_message_once(self):
+        """Test every notice reaches the sink with several workers per stage and tiny queues."""
+        sink = RecordingSink()
+        pipeline = MaintenancePipeline(self.manager, sink=sink, fetch_workers=3, parse_workers=1, sink_workers=2, queue_size=2, fetch_chunk_size=4, sink_batch_size=5)
+        results = pipeline.run()
+        self.assertEqual(sink.cids(), ["{:06d}".format(number) for number in range(1, 41)])
+        self.assertEqual(sorted(results), sink.cids())
+        self.assertTrue(all(len(batch) <= 5 for batch in sink.batches))
+
+        # The checkpoint moved past every UID, so a second run has nothing to do
+        self.assertEqual(MaintenancePipeline(self.manager, sink=sink).run(), [])
+
+    def test_parse_in_process_pool(self):
+        """Test parsing in the process pool finds the same notices."""
+        sink = RecordingSink()
+        MaintenancePipeline(self.manager, sink=sink, parse_workers=2, fetch_chunk_size=10).run()
+        self.assertEqual(sink.cids(), ["{:06d}".format(number) for number in range(1, 41)])
+
+    def test_stop_drains_without_checkpoint(self):
+        """Test a stopped run drains fetched messages but leaves them to be read again."""
+        pipeline = MaintenancePipeline(self.manager, queue_size=1, fetch_chunk_size=2)
+        sink = pipeline._sink = RecordingSink(on_batch=lambda batch: pipeline.stop())
+        pipeline.run()
+        self.assertLess(len(sink.cids()), 40)
+        self.assertGreater(len(sink.cids()), 0)
+        self.assertEqual(len(sink.cids()), len(set(sink.cids())))
+
+        sink = RecordingSink()
+        MaintenancePipeline(self.manager, sink=sink).run()
+        self.assertEqual(len(sink.cids()), 40)
+
+    def test_failed_writes_hold_checkpoint(self):
+        """Test a run whose sink reports a transiently failed write leaves the checkpoint alone, and a permanent failure doesn't."""
+        sink = RecordingSink()
+        results = MaintenancePipeline(self.manager, sink=lambda batch: [WriteResult(cid, "queued" if cid == "000007" else "created") for cid in sink(batch)]).run()
+        self.assertEqual(len(results), 40)
+        self.assertIsNone(self.manager._imap_checkpoints.get("user@localhost/INBOX", 1))
+        results = MaintenancePipeline(self.manager, sink=lambda batch: [WriteResult(cid, "failed" if cid == "000007" else "created") for cid in sink(batch)]).run()
+        self.assertEqual(len(results), 40)
+        self.assertIsNotNone(self.manager._imap_checkpoints.get("user@localhost/INBOX", 1))
+        self.assertEqual(MaintenancePipeline(self.manager, sink=sink).run(), [])
+
+    def test_sink_failure_cancels_run(self):
+        """Test a failing stage stops the others and the error reaches the caller."""
+        def fail(maintenance_notifications):
+            raise RuntimeError("calendar is down")
+        with self.assertRaises(RuntimeError):
+            MaintenancePipeline(self.manager, sink=fail, queue_size=1, fetch_chunk_size=2).run()
+        self.assertIsNone(self.manager._imap_checkpoints.get("user@localhost/INBOX", 1))
+
+    def test_invalid_concurrency(self):
+        """Test stages need at least one worker."""
+        with self.assertRaises(ValueError):
+            MaintenancePipeline(self.manager, sink_workers=0)
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Test request_scheduler."""
+import os
+import random
+import tempfile
+import unittest
+
+from manage_maintenance.google_calendar import GoogleCalendar
+from manage_maintenance.request_scheduler import AIMDLimiter, RequestScheduler, TokenBucket
+from tests.fake_calendar_api import FakeCalendarAPI, FakeCalendarServer
+from tests.test_manage_maintenance.test_google_calendar import make_event_body
+
+
+class FakeClock(object):
+    """A clock that only moves when slept on."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the clock."""
+        self.now += seconds
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    """RequestScheduler class test case."""
+
+    def setUp(self):
+        """Point GoogleCalendars at a fake Calendar API server, without sleeping between retries."""
+        self.server = FakeCalendarServer(FakeCalendarAPI()).__enter__()
+        self.addCleanup(self.server.__exit__)
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.sleeps = []
+        self.calendar = self.make_calendar()
+
+    def make_calendar(self, max_retries=3):
+        """Build a GoogleCalendar against the fake server."""
+        scheduler = RequestScheduler(requests_per_second=None, max_retries=max_retries, sleep=self.sleeps.append, rng=random.Random(0))
+        return GoogleCalendar(service=self.server.build_service(), mirror_file_path=os.path.join(self.temp_dir, "calendar_mirror.json"),
+                              scheduler=scheduler, retry_queue_file=os.path.join(self.temp_dir, "calendar_retry_queue.json"))
+
+    def test_token_bucket(self):
+        """Test a burst goes through at once and later requests wait for their tokens."""
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=5, clock=clock, sleep=clock.sleep)
+        self.assertEqual([bucket.acquire() for _ in range(5)], [0.0] * 5)
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertAlmostEqual(bucket.acquire(50), 0.5)   # Capped at capacity
+
+    def test_aimd_limiter(self):
+        """Test the limit halves on throttling and grows back by one per limit's worth of successes."""
+        limiter = AIMDLimiter(initial=8, maximum=10)
+        limiter.throttled()
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(4):
+            limiter.succeeded()
+        self.assertEqual(int(limiter.limit), 4)
+        limiter.succeeded()
+        self.assertEqual(int(limiter.limit), 5)
+        for _ in range(3):
+            limiter.throttled()
+        self.assertEqual(limiter.limit, 1)
+
+    def test_retry_direct_request(self):
+        """Test a throttled then failing insert is retried with growing backoff and halves the concurrency limit."""
+        self.server.api.fail_next(1, 429)
+        self.server.api.fail_next(1, 503, "backendError")
+        event = self.calendar.create_calendar_event(make_event_body(1))
+        self.assertEqual(event["id"], "event0001")
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertLessEqual(self.sleeps[1], 2.0)
+        self.assertLess(self.calendar.scheduler.limiter.limit, 4)
+
+    def test_retry_batch_calls(self):
+        """Test only the throttled calls of a batch are sent again."""
+        self.calendar.sync_mirror()
+        del self.server.api.requests[:]
+        self.server.api.fail_next(3, 403, "rateLimitExceeded")
+        with self.calendar.batch() as batch:
+            for number in range(10):
+                batch.insert(make_event_body(number))
+        self.assertEqual([result.status for result in batch.results], ["created"] * 10)
+        self.assertEqual(self.server.api.batch_requests, 2)
+        self.assertEqual(len(self.server.api.requests), 13)
+        self.assertEqual(len(self.server.api.events()), 10)
+
+    def test_queue_and_replay(self):
+        """Test writes still failing after retries are queued on disk and sent by a later run."""
+        calendar = self.make_calendar(max_retries=1)
+        calendar.sync_mirror()
+        self.server.api.fail_next(4, 503, "backendError")
+        with calendar.batch() as batch:
+            batch.insert(make_event_body(1))
+            batch.insert(make_event_body(2))
+        self.assertEqual([result.status for result in batch.results], ["queued", "queued"])
+        self.server.api.fail_next(1, 403, "forbidden")
+        self.assertIsNone(calendar.update_calendar_event("event0003", make_event_body(3)))
+        self.assertEqual(len(calendar.retry_queue), 2)
+
+        calendar = self.make_calendar()
+        self.assertEqual([result.status for result in calendar.replay_failed_writes()], ["created", "created"])
+        self.assertEqual(sorted(self.server.api.events()), ["event0001", "event0002"])
+        self.assertEqual(len(calendar.retry_queue), 0)
+        self.assertEqual(calendar.replay_failed_writes(), [])
+
+
+def main():
+    """Main."""
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()